@@ -0,0 +1,182 @@
+# reproducible throughput benchmark: runs tiledl.py and fontdl.py against a local mockserver.py
+# and reports tiles/s, client request latency percentiles, the latency of the mock's own handler, bytes written and peak RSS
+# for each scenario. client latencies are raw samples: each downloader runs in a child process of this script (--run-timed)
+# with transport.get wrapped, so every request is timed from send until its body has been read.
+# results are written as JSON so regressions can be tracked between commits.
+# usage: python3 benchmarks/bench_throughput.py --workers 1 4 16 --latency 30 -o bench_results.json
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+from typing import List, Dict, Callable
+from dataclasses import asdict
+REPO_DIR: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR) # run from anywhere
+import mockserver
+import ratelimit
+
+# constants:
+BENCH_KEY: str = "benchmark-key"
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the downloaders against a local mock API.")
+    parser.add_argument("-w", "--workers", type=int, nargs="+", default=[1, 4, 16], help="Worker counts to benchmark tiledl.py with")
+    parser.add_argument("-t", "--type", type=str, default="sat", help="Tile type to request")
+    parser.add_argument("-z", "--zoom", type=int, default=13, help="Zoom level of the benchmark area")
+    parser.add_argument("-b", "--bounds", type=float, nargs=4, default=[103.5, 0.9, 104.2, 1.6], metavar=("MINLON", "MINLAT", "MAXLON", "MAXLAT"),
+                        help="Bounding box of the benchmark area")
+    parser.add_argument("--format", type=str, default="dir", help="tiledl.py output format")
+    parser.add_argument("--fonts", type=int, default=1, help="Number of fonts to download with fontdl.py, 0 to skip")
+    parser.add_argument("--max-rate", type=float, default=1000.0, help="Rate limit passed to the downloaders (requests/s)")
+    parser.add_argument("--cold-start", action="store_true", help="Start the rate controller from scratch instead of at --max-rate")
+    parser.add_argument("--latency", type=float, default=mockserver.MockConfig().latency_ms, help="Mock latency (ms)")
+    parser.add_argument("--jitter", type=float, default=mockserver.MockConfig().jitter_ms, help="Mock latency jitter (ms)")
+    parser.add_argument("--p204", type=float, default=0.05, help="Mock probability of 204")
+    parser.add_argument("--p429", type=float, default=0.0, help="Mock probability of 429")
+    parser.add_argument("--p5xx", type=float, default=0.0, help="Mock probability of 503")
+    parser.add_argument("--tile-size", type=int, default=mockserver.MockConfig().tile_size, help="Mock tile size (bytes)")
+    parser.add_argument("--glyph-size", type=int, default=mockserver.MockConfig().glyph_size, help="Mock glyph range size (bytes)")
+    parser.add_argument("--seed", type=int, default=0, help="Mock random seed")
+    parser.add_argument("-o", "--output", type=str, default="bench_results.json", help="Where to write the JSON results")
+    return parser.parse_args()
+def get_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+def get_dir_size(path: str) -> int:
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names if not name.startswith("."))
+def write_rate_state(path: str, rate: float, concurrency: int) -> None: # skip the slow start, measure steady state
+    with open(path, "w") as f:
+        json.dump({ratelimit.key_id(BENCH_KEY): {"rate": rate, "concurrency": concurrency}}, f)
+def run_timed(latency_path: str, script: str, script_args: List[str]) -> None:
+    # child mode: runs a downloader script as __main__ and writes the latency of each of its requests (ms, one per line) at exit
+    import atexit
+    import runpy
+    import transport
+    latencies: List[float] = []
+    get: Callable = transport.get
+    def timed_get(url: str, timeout: float, **kwargs):
+        start: float = time.perf_counter()
+        try:
+            response = get(url, timeout=timeout, **kwargs)
+        except BaseException: # timeouts and connection errors are requests too
+            latencies.append((time.perf_counter() - start) * 1000.0)
+            raise
+        if not kwargs.get("stream"): # the body has been read already
+            latencies.append((time.perf_counter() - start) * 1000.0)
+            return response
+        close: Callable = response.close
+        def timed_close() -> None: # a streamed body is done once the downloader closes the response
+            if response.close is timed_close:
+                latencies.append((time.perf_counter() - start) * 1000.0)
+                response.close = close
+            close()
+        response.close = timed_close
+        return response
+    transport.get = timed_get
+    def write_latencies() -> None:
+        with open(latency_path, "w") as f:
+            f.writelines(f"{latency:.3f}\n" for latency in latencies)
+    atexit.register(write_latencies)
+    sys.argv = [script, *script_args]
+    runpy.run_path(os.path.join(REPO_DIR, script), run_name="__main__")
+def read_latencies(path: str) -> List[float]:
+    try:
+        with open(path) as f:
+            return sorted(float(line) for line in f if line.strip())
+    except (OSError, ValueError):
+        return []
+def run_scenario(name: str, command: List[str], server: mockserver.MockServer, out_dir: str, latency_path: str) -> Dict:
+    timed_command: List[str] = [command[0], os.path.abspath(__file__), "--run-timed", latency_path, *command[1:]]
+    with server.stats.lock:
+        server.stats = mockserver.MockStats()
+    print(f"Running {name}...", flush=True)
+    with tempfile.TemporaryFile() as stderr_file:
+        start: float = time.perf_counter()
+        process = subprocess.Popen(timed_command, cwd=REPO_DIR, stdout=subprocess.DEVNULL, stderr=stderr_file)
+        _, status, usage = os.wait4(process.pid, 0) # per-child resource usage, unlike RUSAGE_CHILDREN
+        wall_sec: float = time.perf_counter() - start
+        stderr_file.seek(0)
+        stderr: str = stderr_file.read().decode("utf-8", errors="replace")
+    served: dict = mockserver.summarize_stats(server.stats)
+    ok_count: int = served["status_counts"].get("200", 0)
+    client: List[float] = read_latencies(latency_path)
+    return {
+        "name": name,
+        "command": " ".join(command),
+        "exit_code": os.waitstatus_to_exitcode(status),
+        "wall_sec": round(wall_sec, 3),
+        "requests": served["requests"],
+        "status_counts": served["status_counts"],
+        "items_per_sec": round(ok_count / wall_sec, 2) if wall_sec > 0 else 0.0,
+        # client side, as seen by the downloader: from sending the request until its body was read
+        "client_latency_mean_ms": round(sum(client) / len(client), 2) if client else None,
+        "client_latency_p50_ms": round(mockserver.percentile(client, 50), 2) if client else None,
+        "client_latency_p99_ms": round(mockserver.percentile(client, 99), 2) if client else None,
+        # server side, time spent in the mock's handler (injected latency included, network and client queueing not)
+        "server_latency_p50_ms": round(served["latency_ms"]["p50"], 2),
+        "server_latency_p99_ms": round(served["latency_ms"]["p99"], 2),
+        "bytes_written": get_dir_size(out_dir),
+        "peak_rss_kb": usage.ru_maxrss, # kilobytes on Linux
+        "stderr_tail": stderr[-2000:],
+    }
+def main() -> None:
+    args = parse_arguments()
+    mock_config = mockserver.MockConfig(latency_ms=args.latency, jitter_ms=args.jitter, p204=args.p204, p429=args.p429, p5xx=args.p5xx,
+                                        tile_size=args.tile_size, glyph_size=args.glyph_size, seed=args.seed)
+    server: mockserver.MockServer = mockserver.start_server(mock_config)
+    api_url: str = f"http://127.0.0.1:{server.server_address[1]}"
+    work_dir: str = tempfile.mkdtemp(prefix="maptilerdl-bench-")
+    results: List[Dict] = []
+    try:
+        scenarios: List[tuple] = []
+        for workers in args.workers:
+            scenarios.append((f"tiledl workers={workers}", workers, [
+                sys.executable, "tiledl.py", "-k", BENCH_KEY, "-t", args.type, "-z", str(args.zoom), "-b", *map(str, args.bounds),
+                "--format", args.format, "--workers", str(workers)]))
+        if args.fonts > 0:
+            fonts: List[str] = [f"Bench Font {i}" for i in range(args.fonts)]
+            font_workers: int = max(args.workers)
+            scenarios.append((f"fontdl fonts={args.fonts} workers={font_workers}", font_workers, [
+                sys.executable, "fontdl.py", "-k", BENCH_KEY, "-f", *fonts, "--workers", str(font_workers), "--glyph-index", ""]))
+        for i, (name, workers, command) in enumerate(scenarios):
+            out_dir: str = os.path.join(work_dir, f"run{i}")
+            rate_state: str = os.path.join(work_dir, f"ratelimit{i}.json")
+            if not args.cold_start:
+                write_rate_state(rate_state, args.max_rate, workers)
+            command = command + ["-d", out_dir, "--api-url", api_url, "--max-rate", str(args.max_rate), "--rate-state", rate_state]
+            results.append(run_scenario(name, command, server, out_dir, os.path.join(work_dir, f"latencies{i}.txt")))
+    finally:
+        server.shutdown()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "commit": get_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "mock": asdict(mock_config),
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"{'scenario':<32} {'exit':>4} {'wall s':>8} {'items/s':>9} {'client mean':>11} {'client p50':>10} {'client p99':>10} "
+          f"{'server p50':>10} {'server p99':>10} {'MB written':>10} {'peak RSS MB':>11}")
+    for r in results:
+        client: str = " ".join(f"{r[key]:>{width}.1f}" if r[key] is not None else f"{'-':>{width}}" for key, width in
+                               (("client_latency_mean_ms", 11), ("client_latency_p50_ms", 10), ("client_latency_p99_ms", 10)))
+        print(f"{r['name']:<32} {r['exit_code']:>4} {r['wall_sec']:>8.2f} {r['items_per_sec']:>9.1f} {client} {r['server_latency_p50_ms']:>10.1f} "
+              f"{r['server_latency_p99_ms']:>10.1f} {r['bytes_written'] / 1e6:>10.2f} {r['peak_rss_kb'] / 1024:>11.1f}")
+    print("Latencies in ms; client latencies are timed in the downloader, server latencies are the mock's handler times.")
+    print(f"Results written to {args.output}.")
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--run-timed"]: # python3 bench_throughput.py --run-timed LATENCY_FILE SCRIPT [ARGS...]
+        run_timed(sys.argv[2], sys.argv[3], sys.argv[4:])
+    else:
+        main()
@@ -0,0 +1,46 @@
+# micro-benchmark: scalar lnglat_to_tile_coords vs vectorized lnglat_to_tile_coords_np
+# usage: python3 benchmarks/bench_tilemath.py [-n POINTS] [-z ZOOM ...]
+import os
+import sys
+import time
+import argparse
+from typing import List
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # run from anywhere
+import numpy as np
+from tilemath import MIN_LON, MAX_LON, MIN_LAT, MAX_LAT, lnglat_to_tile_coords, lnglat_to_tile_coords_np, tile_coords_to_bounds_np
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark scalar vs NumPy tile coordinate math.")
+    parser.add_argument("-n", "--points", type=int, default=1_000_000, help="Number of random points per zoom level")
+    parser.add_argument("-z", "--zooms", type=int, nargs="+", default=[0, 10, 16, 22], help="Zoom levels to benchmark")
+    parser.add_argument("-s", "--seed", type=int, default=0, help="Random seed")
+    return parser.parse_args()
+def make_points(n: int, rng: np.random.Generator) -> tuple:
+    # mostly inside the valid range, plus some outside it to exercise the clamping, plus exact tile edges
+    lng = rng.uniform(MIN_LON - 10, MAX_LON + 10, n)
+    lat = rng.uniform(MIN_LAT - 10, MAX_LAT + 10, n)
+    edges = min(n // 10, 10_000)
+    _, edge_lat, _, _ = tile_coords_to_bounds_np(0, rng.integers(0, 2 ** 16, edges), 16)
+    lat[:edges] = edge_lat
+    return lng, lat
+def main() -> None:
+    args = parse_arguments()
+    rng = np.random.default_rng(args.seed)
+    lng, lat = make_points(args.points, rng)
+    lng_list: List[float] = lng.tolist()
+    lat_list: List[float] = lat.tolist()
+    print(f"{args.points} points per zoom level")
+    print(f"{'zoom':>4} {'scalar s':>10} {'numpy s':>10} {'speedup':>8} {'mismatches':>10}")
+    for z in args.zooms:
+        start = time.perf_counter()
+        scalar = [lnglat_to_tile_coords(lo, la, z) for lo, la in zip(lng_list, lat_list)]
+        scalar_sec = time.perf_counter() - start
+        start = time.perf_counter()
+        x, y = lnglat_to_tile_coords_np(lng, lat, z)
+        numpy_sec = time.perf_counter() - start
+        expected = np.array(scalar, dtype=np.int64).reshape(-1, 2)
+        mismatches = int(np.count_nonzero((expected[:, 0] != x) | (expected[:, 1] != y)))
+        print(f"{z:>4} {scalar_sec:>10.3f} {numpy_sec:>10.3f} {scalar_sec / numpy_sec:>7.1f}x {mismatches:>10}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+# sidecar index of HTTP cache validators for tiledl.py:
+# the ETag / Last-Modified of every downloaded tile and when it was last checked, kept next to the tiles in
+# {dir}/.{type}.validators (SQLite), so --refresh can revalidate only stale tiles, with conditional requests
+# that come back as 304 Not Modified, without a body, for tiles that did not change upstream.
+import time
+import sqlite3
+import threading
+from email.utils import formatdate
+from typing import Optional, Dict
+from dataclasses import dataclass
+
+# types, classes and data structures:
+@dataclass(frozen=True, slots=True, kw_only=True)
+class Validators:
+    etag: Optional[str]
+    last_modified: Optional[str]
+    checked: float # unix time of the last download or revalidation
+
+# constants:
+SCHEMA: str = """
+CREATE TABLE IF NOT EXISTS validators (z INTEGER, x INTEGER, y INTEGER, etag TEXT, last_modified TEXT, checked REAL,
+                                       PRIMARY KEY (z, x, y)) WITHOUT ROWID;
+"""
+
+class CacheIndex:
+    def __init__(self, path: str, batch_size: int = 500, read_only: bool = False) -> None:
+        self.path = path
+        self.batch_size = batch_size
+        self.pending_count = 0 # writes since the last commit
+        self.lock = threading.Lock() # one connection shared by all download workers
+        if read_only: # e.g. another worker's index, only get() is used
+            self.connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+            return
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level="DEFERRED")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        self.connection.executescript(SCHEMA)
+        self.connection.commit()
+    def get(self, z: int, x: int, y: int) -> Optional[Validators]:
+        with self.lock:
+            row = self.connection.execute("SELECT etag, last_modified, checked FROM validators WHERE z = ? AND x = ? AND y = ?", (z, x, y)).fetchone()
+        return None if row is None else Validators(etag=row[0], last_modified=row[1], checked=row[2])
+    def put(self, z: int, x: int, y: int, etag: Optional[str], last_modified: Optional[str], checked: Optional[float] = None) -> None:
+        # checked: when the tile was downloaded, if not now (e.g. copied from another index)
+        self.execute("INSERT OR REPLACE INTO validators (z, x, y, etag, last_modified, checked) VALUES (?, ?, ?, ?, ?, ?)",
+                     (z, x, y, etag, last_modified, checked if checked is not None else time.time()))
+    def execute(self, sql: str, parameters: tuple) -> None:
+        with self.lock:
+            self.connection.execute(sql, parameters)
+            self.pending_count += 1
+            if self.pending_count >= self.batch_size:
+                self.connection.commit()
+                self.pending_count = 0
+    def close(self) -> None:
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+def conditional_headers(validators: Optional[Validators], modified_time: Optional[float]) -> Dict[str, str]:
+    # modified_time: when the local copy was written, for tiles downloaded before the index existed
+    headers: Dict[str, str] = {}
+    if validators is not None and validators.etag:
+        headers["If-None-Match"] = validators.etag
+    if validators is not None and validators.last_modified:
+        headers["If-Modified-Since"] = validators.last_modified
+    elif not headers and modified_time is not None:
+        headers["If-Modified-Since"] = formatdate(modified_time, usegmt=True)
+    return headers
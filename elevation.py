@@ -0,0 +1,236 @@
+# elevation mosaic for the terrain-RGB tiles of tiledl.py:
+# decodes every terrain-rgb-v2 tile of one zoom level, in a process pool, into a single float32 raster on disk,
+# so elevation queries are memory-mapped array reads instead of decoding a webp tile per query.
+# file layout: a HEADER_SIZE block (MAGIC, then a JSON georeferencing header) followed by a row-major little-endian
+# float32 array of height x width pixels on the Web Mercator (EPSG:3857) pixel grid of the zoom level; NaN where no tile was downloaded.
+# usage: python3 elevation.py build -d ~/tiles/trgb -z 12 -o ~/tiles/sg_z12.elev
+#        python3 elevation.py query -i ~/tiles/sg_z12.elev 103.8198,1.3521 103.7764,1.2966
+import io
+import os
+import json
+import math
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, Future, wait, FIRST_COMPLETED
+from typing import Optional, Tuple, List, Dict, Iterator
+from dataclasses import dataclass, asdict
+import overviews
+import tilestore
+from tilemath import TileBounds, TileRange, get_tile_range, lnglat_to_tile_fraction_np
+try:
+    import numpy as np
+except ImportError: # numpy is only needed here, not by the downloaders; Pillow is imported when building, lookups only need numpy
+    np = None
+
+# types, classes and data structures:
+@dataclass(frozen=True, slots=True, kw_only=True)
+class MosaicHeader:
+    zoom: int
+    tile_size: int  # pixels per tile side
+    minx: int       # tile column of the first pixel column
+    miny: int       # tile row of the first pixel row
+    width: int      # pixels
+    height: int     # pixels
+    crs: str = "EPSG:3857"
+    geotransform: Tuple[float, ...] = () # GDAL order: origin x, pixel width, 0, origin y, 0, -pixel height (metres)
+    dtype: str = "<f4"
+    nodata: str = "NaN"
+
+# constants:
+MAGIC: bytes = b"MTDLELV1"
+HEADER_SIZE: int = 4096 # keeps the raster page aligned
+TERRAIN_TYPE: str = "terrain-rgb-v2"
+TERRAIN_EXT: str = "webp"
+WORLD_SIZE: float = 2 * math.pi * 6378137.0 # Web Mercator metres across the world
+worker_raster: Optional["np.memmap"] = None # the mosaic mapped once per pool process
+
+def require_numpy() -> None:
+    if np is None:
+        raise ImportError("numpy is required for elevation mosaics, install it with 'pip install numpy'")
+def require_pillow() -> None:
+    try:
+        import PIL
+    except ImportError:
+        raise ImportError("Pillow is required to build elevation mosaics, install it with 'pip install pillow'") from None
+def make_header(zoom: int, tile_size: int, minx: int, miny: int, maxx: int, maxy: int) -> MosaicHeader:
+    resolution: float = WORLD_SIZE / (tile_size << zoom)
+    origin_x: float = minx * tile_size * resolution - WORLD_SIZE / 2
+    origin_y: float = WORLD_SIZE / 2 - miny * tile_size * resolution
+    return MosaicHeader(zoom=zoom, tile_size=tile_size, minx=minx, miny=miny, width=(maxx - minx + 1) * tile_size, height=(maxy - miny + 1) * tile_size,
+                        geotransform=(origin_x, resolution, 0.0, origin_y, 0.0, -resolution))
+def write_header(path: str, header: MosaicHeader) -> None: # creates the file at its full (sparse) size
+    encoded: bytes = MAGIC + json.dumps(asdict(header)).encode("utf-8") + b"\n"
+    if len(encoded) > HEADER_SIZE:
+        raise ValueError("elevation header too large")
+    with open(path, "wb") as f:
+        f.write(encoded.ljust(HEADER_SIZE, b" "))
+        f.truncate(HEADER_SIZE + header.width * header.height * 4)
+def read_header(path: str) -> MosaicHeader:
+    with open(path, "rb") as f:
+        block: bytes = f.read(HEADER_SIZE)
+    if not block.startswith(MAGIC):
+        raise ValueError(f"{path} is not an elevation mosaic")
+    fields: dict = json.loads(block[len(MAGIC):].decode("utf-8"))
+    fields["geotransform"] = tuple(fields["geotransform"])
+    return MosaicHeader(**fields)
+def open_raster(path: str, header: MosaicHeader, mode: str) -> "np.memmap":
+    return np.memmap(path, dtype=header.dtype, mode=mode, offset=HEADER_SIZE, shape=(header.height, header.width))
+def init_worker(path: str, header: MosaicHeader) -> None:
+    global worker_raster
+    worker_raster = open_raster(path, header, "r+")
+def decode_tile(data: bytes, row: int, col: int, tile_size: int) -> bool:
+    # runs in a pool process, writes the tile's elevations straight into the shared mapping; False if the tile cannot be decoded
+    from PIL import Image
+    try:
+        image = Image.open(io.BytesIO(data))
+        if image.size != (tile_size, tile_size):
+            image = image.resize((tile_size, tile_size), Image.Resampling.NEAREST) # interpolating packed RGB would corrupt elevations
+        elevation = overviews.decode_terrain(image)
+    except (OSError, ValueError):
+        worker_raster[row:row + tile_size, col:col + tile_size] = np.nan
+        return False
+    worker_raster[row:row + tile_size, col:col + tile_size] = elevation
+    return True
+def build_mosaic(store: tilestore.DirectoryTileStore | tilestore.MBTilesTileStore, zoom: int, tiles: List[Tuple[int, int]], path: str, workers: int) -> Tuple[int, int]:
+    # returns (decoded, undecodable); written to {path}.part and renamed into place, like tiles
+    from PIL import Image
+    tile_size: int = 512 # terrain-rgb-v2 tiles, unless the first tile says otherwise
+    try:
+        tile_size = Image.open(io.BytesIO(store.read(zoom, *tiles[0]) or b"")).size[0]
+    except OSError:
+        pass
+    header: MosaicHeader = make_header(zoom, tile_size, min(x for x, _ in tiles), min(y for _, y in tiles), max(x for x, _ in tiles), max(y for _, y in tiles))
+    part_path: str = path + tilestore.PART_SUFFIX
+    write_header(part_path, header)
+    raster = open_raster(part_path, header, "r+")
+    present = set(tiles)
+    for x in range(header.minx, header.minx + header.width // tile_size): # holes in the grid are nodata
+        for y in range(header.miny, header.miny + header.height // tile_size):
+            if (x, y) not in present:
+                raster[(y - header.miny) * tile_size:(y - header.miny + 1) * tile_size, (x - header.minx) * tile_size:(x - header.minx + 1) * tile_size] = np.nan
+    decoded: int = 0
+    undecodable: int = 0
+    jobs: Iterator[Tuple[int, int]] = iter(tiles)
+    pending: Dict[Future, Tuple[int, int]] = {}
+    max_pending: int = workers * 4 # tiles are read lazily, never a whole level at once
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(part_path, header)) as pool:
+        while True:
+            while len(pending) < max_pending:
+                job: Optional[Tuple[int, int]] = next(jobs, None)
+                if job is None:
+                    break
+                x, y = job
+                data: Optional[bytes] = store.read(zoom, x, y)
+                pending[pool.submit(decode_tile, data or b"", (y - header.miny) * tile_size, (x - header.minx) * tile_size, tile_size)] = job
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.pop(future)
+                if future.result():
+                    decoded += 1
+                else:
+                    undecodable += 1
+    raster.flush() # the pool processes wrote through the same page cache
+    del raster
+    with open(part_path, "rb+") as f:
+        os.fsync(f.fileno())
+    os.replace(part_path, path)
+    return decoded, undecodable
+
+class ElevationMosaic:
+    def __init__(self, path: str) -> None:
+        require_numpy()
+        self.path = path
+        self.header: MosaicHeader = read_header(path)
+        self.raster = open_raster(path, self.header, "r") # pages are loaded on first access and shared between processes
+    def pixel_coords(self, lon, lat) -> Tuple["np.ndarray", "np.ndarray"]: # fractional (column, row) in the raster
+        fx, fy = lnglat_to_tile_fraction_np(lon, lat, self.header.zoom)
+        return (fx - self.header.minx) * self.header.tile_size, (fy - self.header.miny) * self.header.tile_size
+    def lookup(self, lon, lat, bilinear: bool = False) -> "np.ndarray":
+        # elevation in metres for arrays of points, NaN outside the mosaic or where no tile was downloaded;
+        # nearest pixel by default, or bilinear between the four surrounding pixel centres
+        col, row = self.pixel_coords(lon, lat)
+        if not bilinear:
+            return self.sample(np.floor(col).astype(np.int64), np.floor(row).astype(np.int64))
+        inside = (col >= 0) & (col < self.header.width) & (row >= 0) & (row < self.header.height)
+        # pixel values are at pixel centres; the outer half pixel of the mosaic is clamped to the edge pixels' own values
+        col, row = np.clip(col - 0.5, 0, self.header.width - 1), np.clip(row - 0.5, 0, self.header.height - 1)
+        col0, row0 = np.floor(col).astype(np.int64), np.floor(row).astype(np.int64)
+        col1, row1 = np.minimum(col0 + 1, self.header.width - 1), np.minimum(row0 + 1, self.header.height - 1)
+        dx, dy = col - col0, row - row0
+        top = self.sample(col0, row0) * (1 - dx) + self.sample(col1, row0) * dx
+        bottom = self.sample(col0, row1) * (1 - dx) + self.sample(col1, row1) * dx
+        return np.where(inside, top * (1 - dy) + bottom * dy, np.nan)
+    def sample(self, col: "np.ndarray", row: "np.ndarray") -> "np.ndarray":
+        inside = (col >= 0) & (col < self.header.width) & (row >= 0) & (row < self.header.height)
+        values = np.full(np.shape(col), np.nan, dtype=np.float64)
+        values[inside] = self.raster[row[inside], col[inside]]
+        return values
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Build and query a memory-mapped elevation mosaic from downloaded terrain-RGB tiles.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build", help="Decode the terrain-RGB tiles of one zoom level into a mosaic")
+    build.add_argument("-d", "--dir", type=str, required=True, help="Tile directory of tiledl.py -t trgb (or the directory of its terrain-rgb-v2.mbtiles)")
+    build.add_argument("--format", type=str, choices=tilestore.FORMAT_CHOICES, default="dir", help="Tile store format, as given to tiledl.py")
+    build.add_argument("-z", "--zoom", type=int, choices=range(0, 23), metavar="ZOOM", required=True, help="Zoom level to build the mosaic from")
+    build.add_argument("-b", "--bounds", type=float, nargs=4, metavar=("MINLON", "MINLAT", "MAXLON", "MAXLAT"), default=None,
+                       help="Only use tiles within this bounding box (default: every tile of the zoom level)")
+    build.add_argument("-o", "--output", type=str, required=True, help="Mosaic file to write")
+    build.add_argument("-w", "--workers", type=int, default=os.cpu_count() or 1, help="Number of decoding processes")
+    query = commands.add_parser("query", help="Print the elevation at lon/lat points")
+    query.add_argument("-i", "--input", type=str, required=True, help="Mosaic file")
+    query.add_argument("points", type=str, nargs="+", metavar="LON,LAT", help="Points to look up")
+    query.add_argument("--bilinear", action="store_true", help="Interpolate between pixels instead of taking the nearest one")
+    args = parser.parse_args()
+    if args.command == "build" and args.workers < 1:
+        parser.error("--workers must be at least 1")
+    try:
+        require_numpy()
+        if args.command == "build":
+            require_pillow()
+    except ImportError as e:
+        parser.error(str(e))
+    return args
+def build_command(args: argparse.Namespace) -> None:
+    if not os.path.isdir(args.dir):
+        print(f"Directory {args.dir} does not exist. Exiting.")
+        exit(1)
+    store: tilestore.DirectoryTileStore | tilestore.MBTilesTileStore = tilestore.open_tile_store(args.format, args.dir, TERRAIN_TYPE, TERRAIN_EXT)
+    try:
+        tiles: List[Tuple[int, int]] = sorted(store.iter_tiles(args.zoom))
+        if args.bounds is not None:
+            bounds: TileBounds = tuple(args.bounds)
+            tile_range: Optional[TileRange] = get_tile_range(bounds, args.zoom)
+            if tile_range is None:
+                print(f"Bounds {bounds} are outside zoom level {args.zoom}. Exiting.")
+                exit(1)
+            tiles = [(x, y) for x, y in tiles if tile_range.minx <= x <= tile_range.maxx and tile_range.miny <= y <= tile_range.maxy]
+        if not tiles:
+            print(f"No {TERRAIN_TYPE} tiles found at zoom level {args.zoom} in {args.dir}. Exiting.")
+            exit(1)
+        print(f"Decoding {len(tiles)} tiles of zoom level {args.zoom} with {args.workers} worker(s)...")
+        start: float = time.monotonic()
+        decoded, undecodable = build_mosaic(store, args.zoom, tiles, args.output, args.workers)
+    finally:
+        store.close()
+    header: MosaicHeader = read_header(args.output)
+    print(f"Wrote {args.output}: {header.width} x {header.height} pixels, {header.geotransform[1]:.2f} m per pixel,"
+          f" {decoded} tiles in {time.monotonic() - start:.1f} s" + (f", {undecodable} undecodable tiles left as NaN." if undecodable else "."))
+def query_command(args: argparse.Namespace) -> None:
+    try:
+        lon, lat = np.array([[float(value) for value in point.split(",")] for point in args.points]).T
+    except ValueError:
+        print("Points must be given as LON,LAT. Exiting.")
+        exit(1)
+    mosaic: ElevationMosaic = ElevationMosaic(args.input)
+    for point_lon, point_lat, elevation in zip(lon, lat, mosaic.lookup(lon, lat, bilinear=args.bilinear)):
+        print(f"{point_lon},{point_lat},{elevation:.1f}")
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    if args.command == "build":
+        build_command(args)
+    else:
+        query_command(args)
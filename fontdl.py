@@ -6,15 +6,55 @@
 # for example, to download noto-sans-bold font stack, we need files from 0-255, 256-511, ..., up to 65280-65535
 # key such as: QOCNp1pWErFc8sgXrGwI
 import requests
+import transport
+import journal
+import ratelimit
+import metrics
+import glyphindex
+import tilestore
 import os
+import re
 import time
 import argparse
-from typing import Optional, Tuple, List
-from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from typing import Optional, Tuple, List, Dict, Iterator, Iterable, Callable
+from dataclasses import dataclass, replace
 
 # constants:
-URL_TEMPLATE: str = "https://api.maptiler.com/fonts/{font}/{range}.pbf?key={key}"
+API_URL: str = "https://api.maptiler.com"
+URL_TEMPLATE: str = "{api}/fonts/{font}/{range}.pbf?key={key}"
 DEFAULT_FONTS: List[str] = ["noto-sans-regular", "noto-sans-italic", "noto-sans-bold"]
+UNICODE_BLOCKS: Dict[str, List[Tuple[int, int]]] = { # names accepted by --ranges, inclusive code point ranges
+    "latin": [(0x0000, 0x024F), (0x1E00, 0x1EFF)], # basic latin, latin-1, extended-a/b and extended additional
+    "basic-latin": [(0x0000, 0x007F)],
+    "latin-1": [(0x0080, 0x00FF)],
+    "latin-extended": [(0x0100, 0x024F), (0x1E00, 0x1EFF)],
+    "ipa": [(0x0250, 0x02FF)], # with spacing modifier letters
+    "diacritics": [(0x0300, 0x036F)],
+    "greek": [(0x0370, 0x03FF), (0x1F00, 0x1FFF)],
+    "cyrillic": [(0x0400, 0x052F)],
+    "armenian": [(0x0530, 0x058F)],
+    "hebrew": [(0x0590, 0x05FF)],
+    "arabic": [(0x0600, 0x06FF), (0x0750, 0x077F), (0xFB50, 0xFDFF), (0xFE70, 0xFEFF)],
+    "devanagari": [(0x0900, 0x097F)],
+    "bengali": [(0x0980, 0x09FF)],
+    "tamil": [(0x0B80, 0x0BFF)],
+    "thai": [(0x0E00, 0x0E7F)],
+    "lao": [(0x0E80, 0x0EFF)],
+    "tibetan": [(0x0F00, 0x0FFF)],
+    "myanmar": [(0x1000, 0x109F)],
+    "georgian": [(0x10A0, 0x10FF)],
+    "ethiopic": [(0x1200, 0x139F)],
+    "khmer": [(0x1780, 0x17FF)],
+    "punctuation": [(0x2000, 0x206F)],
+    "symbols": [(0x2070, 0x2BFF)], # super/subscripts, currency, letterlike, arrows, math, shapes, dingbats...
+    "cjk": [(0x2E80, 0x2FDF), (0x3000, 0x303F), (0x3400, 0x4DBF), (0x4E00, 0x9FFF), (0xF900, 0xFAFF)],
+    "kana": [(0x3040, 0x30FF), (0x31F0, 0x31FF)],
+    "hangul": [(0x1100, 0x11FF), (0x3130, 0x318F), (0xAC00, 0xD7AF)],
+    "private-use": [(0xE000, 0xF8FF)],
+    "fullwidth": [(0xFF00, 0xFFEF)],
+}
+CODE_POINT_RANGE = re.compile(r"^(?:U\+|0x)?([0-9A-Fa-f]+)-(?:U\+|0x)?([0-9A-Fa-f]+)$") # hexadecimal, e.g. U+0400-U+04FF or 400-4ff
 # types, classes and data structures:
 @dataclass(frozen=True, slots=True, kw_only=True)
 class FontDLArguments:
@@ -22,23 +62,31 @@ class FontDLArguments:
     dir: str
     fonts: List[str]
     config: str
+    retry_failed: bool
+    api_url: str
+    max_rate: float
+    rate_state: str
+    pool_size: int
+    keep_alive: bool
+    workers: int
+    ranges: List[Tuple[int, int]] # glyph ranges to download, (begin, end) of 256 code points each
+    glyph_index: str
+    progress_interval: Optional[float]
+    metrics_file: str
+    metrics_format: str
+    metrics_interval: float
 @dataclass(frozen=True, slots=True, kw_only=True)
 class BackoffConfig:
-    initial_wait: float = 1.0
-    max_wait: float = 60.0
-    min_wait: float = 1.0
-    fail_factor: float = 1.5
-    success_factor: float = 0.9
     max_retries: int = 5
     timeout: int = 5
 @dataclass(frozen=False, slots=True, kw_only=True)
 class GlobalVariables:
-    wait_sec: float = 1.0
+    rate: ratelimit.RateController
+    stats: metrics.Metrics
+    reporter: metrics.Reporter
+    index: glyphindex.GlyphIndex
     downloaded_count: int = 0
     total_downloaded_count: int = 0
-    current_range_begin: int = 0
-    current_range_end: int = 0
-    current_fontname: str = ""
 
 def justify_fontname(fontname: str) -> str: # input fontname such as "Noto Sans Bold", output "noto-sans-bold"
     return fontname.lower().replace(" ", "-")
@@ -48,13 +96,65 @@ def parse_arguments() -> FontDLArguments:
     parser.add_argument("-d", "--dir", type=str, default="./fonts", help="Directory to save downloaded font files.")
     parser.add_argument("-f", "--fonts", type=str, default=DEFAULT_FONTS, nargs='+', help="Font stack name(s) to download (e.g., 'Noto Sans Bold').")
     parser.add_argument("-c", "--config", type=str, default="", help="Path to configuration file")
+    parser.add_argument("--retry-failed", action="store_true", help="Only retry items that the resume journal recorded as failed")
+    parser.add_argument("--api-url", type=str, default=API_URL, help="Base URL of the font API, e.g. a local mockserver.py for testing")
+    parser.add_argument("--max-rate", type=float, default=ratelimit.RateConfig().max_rate, help="Upper limit for the adaptive request rate (requests/s)")
+    parser.add_argument("--rate-state", type=str, default=ratelimit.DEFAULT_STATE_PATH, help="File where the last safe request rate is kept per API key")
+    parser.add_argument("--pool-size", type=int, default=10, help="Max kept-alive HTTP connections in the shared pool")
+    parser.add_argument("--no-keep-alive", action="store_true", help="Close the HTTP connection after every request")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="Number of concurrent download workers, shared by all fonts")
+    parser.add_argument("--ranges", type=str, nargs="+", default=[], metavar="RANGE",
+                        help=f"Only download the glyph ranges covering these Unicode blocks ({', '.join(UNICODE_BLOCKS)}) or hexadecimal code point ranges (e.g. U+0400-U+04FF)")
+    parser.add_argument("--glyph-index", type=str, default=glyphindex.DEFAULT_INDEX_PATH,
+                        help="File where empty and tiny glyph ranges are remembered across runs, '' to disable")
+    parser.add_argument("--progress-interval", type=float, default=None,
+                        help=f"Seconds between progress updates (default: {metrics.TTY_REFRESH:g} on a terminal, {metrics.LOG_REFRESH:g} otherwise)")
+    parser.add_argument("--metrics-file", type=str, default="", help="File to export run metrics to")
+    parser.add_argument("--metrics-format", type=str, choices=metrics.METRICS_FORMAT_CHOICES, default="jsonl",
+                        help="Metrics file format: 'jsonl' appends a JSON snapshot per interval, 'prometheus' rewrites a text exposition file")
+    parser.add_argument("--metrics-interval", type=float, default=metrics.METRICS_INTERVAL, help="Seconds between metrics exports")
     args = parser.parse_args()
+    if args.progress_interval is not None and args.progress_interval <= 0:
+        parser.error("--progress-interval must be positive")
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    try:
+        ranges: List[Tuple[int, int]] = get_glyph_ranges(args.ranges)
+    except ValueError as e:
+        parser.error(str(e))
     return FontDLArguments(
         key=args.key,
         dir=args.dir,
         fonts=[justify_fontname(fn) for fn in args.fonts],
-        config=args.config
+        config=args.config,
+        retry_failed=args.retry_failed,
+        api_url=args.api_url.rstrip("/"),
+        max_rate=args.max_rate,
+        rate_state=args.rate_state,
+        pool_size=args.pool_size,
+        keep_alive=not args.no_keep_alive,
+        workers=args.workers,
+        ranges=ranges,
+        glyph_index=args.glyph_index,
+        progress_interval=args.progress_interval,
+        metrics_file=args.metrics_file,
+        metrics_format=args.metrics_format,
+        metrics_interval=args.metrics_interval
     )
+def get_glyph_ranges(specs: List[str]) -> List[Tuple[int, int]]: # all 256 ranges if no blocks are given
+    if not specs:
+        return [(i, i + 255) for i in range(0, 65536, 256)]
+    begins: set = set()
+    for spec in specs:
+        code_points: Optional[List[Tuple[int, int]]] = UNICODE_BLOCKS.get(spec.lower())
+        if code_points is None:
+            match = CODE_POINT_RANGE.match(spec)
+            if match is None or int(match.group(1), 16) > int(match.group(2), 16) or int(match.group(2), 16) > 0xFFFF:
+                raise ValueError(f"invalid glyph range '{spec}', expected one of {', '.join(UNICODE_BLOCKS)} or a code point range such as U+0400-U+04FF")
+            code_points = [(int(match.group(1), 16), int(match.group(2), 16))]
+        for first, last in code_points:
+            begins.update(range(first // 256 * 256, last + 1, 256))
+    return [(begin, begin + 255) for begin in sorted(begins)]
 def load_config(path: str) -> List[str]:
     file_content: str
     try:
@@ -78,64 +178,132 @@ def load_config(path: str) -> List[str]:
     return fonts
 def restore_fontname(fontname: str) -> str: # input fontname such as "noto-sans-bold", output "Noto Sans Bold"
     return " ".join([word.capitalize() for word in fontname.split("-")])
-def get_response_dynamic_backoff(gvar: GlobalVariables, bcfg: BackoffConfig, url: str) -> Optional[requests.Response]:
-    for _ in range(bcfg.max_retries):
+def get_response_dynamic_backoff(gvar: GlobalVariables, bcfg: BackoffConfig, url: str, write_body: Callable[[transport.BodyStream], None]) -> Optional[requests.Response]:
+    # pacing between requests and after failures is left to the shared rate controller, there is no fixed sleep;
+    # failed attempts are counted in the metrics, only the final failure is logged.
+    # a 200 body is streamed into write_body within the attempt, so a truncated or invalid body is retried like any other failure
+    last_error: str = ""
+    for attempt in range(bcfg.max_retries):
+        retried: bool = attempt < bcfg.max_retries - 1
+        gvar.rate.acquire()
+        start: float = time.perf_counter()
+        response: Optional[requests.Response] = None
+        body: Optional[transport.BodyStream] = None
         try:
-            response = requests.get(url, timeout=bcfg.timeout)
-            if response.status_code == 200:
-                gvar.wait_sec = max(bcfg.min_wait, gvar.wait_sec * bcfg.success_factor)  # decrease wait time on success
-                return response
-            elif response.status_code == 204:
-                print(f"\n\tNo content (204), skipping this tile.")
-                return None
-            else:
-                print(f"\n\tError {response.status_code}.")
-                print(f"\tRetrying in {gvar.wait_sec:.2f} seconds... ", end="", flush=True)
+            response = transport.get(url, timeout=bcfg.timeout, stream=True)
+            with response:
+                if response.status_code == 200:
+                    body = transport.BodyStream(response)
+                    write_body(body)
+                else:
+                    response.content # small error bodies are read, so the connection goes back to the pool
         except requests.Timeout:
-            print(f"\n\tRequest timed out after {bcfg.timeout} seconds.")
-            print(f"\tRetrying in {gvar.wait_sec:.2f} seconds... ", end="", flush=True)
-        except requests.RequestException as e:
-            print(f"\n\t{e}.")
-            print(f"\tRetrying in {gvar.wait_sec:.2f} seconds... ", end="", flush=True)
-        time.sleep(gvar.wait_sec)
-        gvar.wait_sec = min(bcfg.max_wait, gvar.wait_sec * bcfg.fail_factor)  # increase wait time on failure
-    print("\n\tMax retries reached.")
+            gvar.rate.release(timed_out=True)
+            gvar.stats.observe_request("timeout", time.perf_counter() - start, retried=retried)
+            last_error = f"timed out after {bcfg.timeout} seconds"
+            continue
+        except (requests.RequestException, tilestore.InvalidTile) as e: # includes connections lost mid-body and incomplete bodies
+            gvar.rate.release()
+            gvar.stats.observe_request("error", time.perf_counter() - start, body.size if body is not None else 0, retried=retried)
+            last_error = str(e)
+            continue
+        except BaseException: # e.g. the disk is full, not the server's fault
+            gvar.rate.release(response.status_code if response is not None else None, response.headers if response is not None else None)
+            raise
+        gvar.rate.release(response.status_code, response.headers)
+        success: bool = response.status_code in (200, 204) # 204: no content, the caller records it as empty
+        gvar.stats.observe_request(str(response.status_code), time.perf_counter() - start, body.size if body is not None else 0, retried=retried and not success and ratelimit.is_congestion(response.status_code))
+        if success:
+            return response
+        last_error = f"error {response.status_code}"
+        if not ratelimit.is_congestion(response.status_code): # e.g. 403 or 404, retrying would get the same answer
+            gvar.reporter.log(f"\tFailed {url.split('?')[0]}: {last_error}.")
+            return None
+    gvar.reporter.log(f"\tMax retries reached for {url.split('?')[0]}: {last_error}.")
     return None
-def download_one_pbf(gvar: GlobalVariables, args: FontDLArguments, bcfg: BackoffConfig) -> int:
-    font_dir: str = os.path.join(args.dir, restore_fontname(gvar.current_fontname))
-    tile_path: str = os.path.join(font_dir, f"{gvar.current_range_begin}-{gvar.current_range_end}.pbf")
-    if os.path.exists(tile_path):
+def write_pbf(font_dir: str, tile_path: str, chunks: Iterable[bytes]) -> int: # renamed into place once complete
+    os.makedirs(font_dir, exist_ok=True)
+    return tilestore.write_atomic(tile_path, chunks, "pbf")
+def download_one_pbf(gvar: GlobalVariables, args: FontDLArguments, bcfg: BackoffConfig, job_journal: journal.Journal, fontname: str, range_begin: int, range_end: int) -> int:
+    font_dir: str = os.path.join(args.dir, restore_fontname(fontname))
+    tile_path: str = os.path.join(font_dir, f"{range_begin}-{range_end}.pbf")
+    status: Optional[str] = job_journal.status(fontname, range_begin)
+    if args.retry_failed:
+        if status != journal.FAILED:
+            return 0 # only ranges that failed in an earlier run are retried
+    elif status is not None:
+        return 0 # range finished in an earlier run (downloaded, empty or failed), will skip downloading
+    elif tilestore.is_complete_file(tile_path, "pbf"):
+        job_journal.record(journal.DONE, fontname, range_begin) # file written before the journal existed
         return 0 # tile already exists, will skip downloading
-    url: str = URL_TEMPLATE.format(font=gvar.current_fontname, range=f"{gvar.current_range_begin}-{gvar.current_range_end}", key=args.key)
-    response: Optional[requests.Response] = get_response_dynamic_backoff(gvar, bcfg, url)
-    if response is not None:
-        os.makedirs(font_dir, exist_ok=True)
-        with open(tile_path, "wb") as f:
-            f.write(response.content)
-        return response.status_code # return status code in case of success
-    return -1 # failed to download after retries, tile not downloaded
-def download_one_font(gvar: GlobalVariables, args: FontDLArguments, bcfg: BackoffConfig) -> None:
-    ranges: List[Tuple[int, int]] = [(i, i + 255) for i in range(0, 65536, 256)]
-    len_ranges: int = len(ranges)
-    print(f"Downloading font stack '{restore_fontname(gvar.current_fontname)}' with {len_ranges} files...")
-    for i, (range_begin, range_end) in enumerate(ranges):
-        gvar.current_range_begin = range_begin
-        gvar.current_range_end = range_end
-        tile_progress: str = f"{i + 1:>{len(str(len_ranges))}}/{len_ranges:>{len(str(len_ranges))}}"
-        print(f"\033[2K\tDownloading {tile_progress}: range {range_begin}-{range_end}... ", end="", flush=True)
-        status_code: int = download_one_pbf(gvar, args, bcfg)
-        if status_code == 0: # tile already exists, skip it
-            print(f"SKP", end="\r")
-            continue
-        elif status_code == 200: # tile downloaded successfully
-            gvar.downloaded_count += 1
-            print(f"OK ", end="\r")
-        else: # error message and a new line
-            print(f"\r\tError downloading range {range_begin}-{range_end}: {status_code}{' ':>{len(str(len_ranges))}}")
-        time.sleep(gvar.wait_sec) # wait before next request
-    print(f"\n\t...{gvar.downloaded_count} new files downloaded.")
+    known: Optional[bytes] = gvar.index.get(fontname, range_begin)
+    if known is not None: # empty or tiny range seen in an earlier run, possibly into another directory
+        if known:
+            write_pbf(font_dir, tile_path, [known])
+        job_journal.record(journal.DONE if known else journal.EMPTY, fontname, range_begin)
+        return 0 # not downloaded
+    url: str = URL_TEMPLATE.format(api=args.api_url, font=fontname, range=f"{range_begin}-{range_end}", key=args.key)
+    response: Optional[requests.Response] = get_response_dynamic_backoff(gvar, bcfg, url, lambda body: write_pbf(font_dir, tile_path, body))
+    if response is None:
+        job_journal.record(journal.FAILED, fontname, range_begin)
+        return -1 # failed to download after retries, tile not downloaded
+    if response.status_code == 204:
+        gvar.index.record(fontname, range_begin, b"")
+        job_journal.record(journal.EMPTY, fontname, range_begin)
+        return response.status_code # no content, nothing to write
+    if os.path.getsize(tile_path) <= gvar.index.tiny_size:
+        with open(tile_path, "rb") as f:
+            gvar.index.record(fontname, range_begin, f.read())
+    job_journal.record(journal.DONE, fontname, range_begin) # the file was written (and checked) while streaming
+    return response.status_code # return status code in case of success
+def iter_font_jobs(args: FontDLArguments) -> Iterator[Tuple[str, int, int]]:
+    for range_begin, range_end in args.ranges: # range by range across all fonts, so the common (latin) ranges of every font come first
+        for fontname in args.fonts:
+            yield fontname, range_begin, range_end
+def download_fonts(gvar: GlobalVariables, args: FontDLArguments, bcfg: BackoffConfig, job_journal: journal.Journal) -> None:
+    len_files: int = len(args.fonts) * len(args.ranges)
+    print(f"Downloading {len(args.ranges)} glyph ranges of {len(args.fonts)} font stack(s), {len_files} files...")
+    gvar.stats.add_planned(len_files)
+    gvar.reporter.start() # progress is rendered by the reporter thread at a fixed refresh rate, not per range
+    jobs: Iterator[Tuple[str, int, int]] = iter_font_jobs(args)
+    pending: Dict[Future, Tuple[str, int, int]] = {}
+    max_pending: int = args.workers * 2 # keep the pool busy without materializing every job up front
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        try:
+            while True:
+                while len(pending) < max_pending:
+                    job: Optional[Tuple[str, int, int]] = next(jobs, None)
+                    if job is None:
+                        break
+                    pending[pool.submit(download_one_pbf, gvar, args, bcfg, job_journal, *job)] = job
+                if not pending:
+                    break
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    fontname, range_begin, range_end = pending.pop(future)
+                    try:
+                        status_code: int = future.result()
+                    except OSError as e:
+                        gvar.reporter.log(f"\t{e}.")
+                        status_code = -1
+                    if status_code == 0: # file already exists or is known to be empty / tiny, skip it
+                        gvar.stats.observe_item("skipped")
+                    elif status_code == 200: # file downloaded successfully
+                        gvar.downloaded_count += 1
+                        gvar.stats.observe_item("ok")
+                    elif status_code == 204: # no content, recorded as empty
+                        gvar.stats.observe_item("empty")
+                    else: # error message on its own line
+                        gvar.stats.observe_item("failed")
+                        gvar.reporter.log(f"\tError downloading '{restore_fontname(fontname)}' range {range_begin}-{range_end}: {status_code}")
+        except KeyboardInterrupt:
+            pool.shutdown(wait=False, cancel_futures=True) # drop queued ranges, let in-flight ones finish
+            raise
+        finally:
+            gvar.reporter.stop() # final progress line and metrics snapshot
+    print(f"\t...{gvar.downloaded_count} new files downloaded, {gvar.index.written} written from the glyph index, {gvar.index.skipped} known empty ranges skipped.")
     gvar.total_downloaded_count += gvar.downloaded_count
-    gvar.downloaded_count = 0 # reset for next font
+    gvar.downloaded_count = 0
 
 if __name__ == "__main__":
     args: FontDLArguments = parse_arguments()
@@ -146,7 +314,14 @@ if __name__ == "__main__":
         print(f"Directory {args.dir} is not writable. Exiting.")
         exit(1)
     bcfg: BackoffConfig = BackoffConfig()
-    gvars: GlobalVariables = GlobalVariables()
+    transport.configure(transport.TransportConfig(pool_size=max(args.pool_size, args.workers), keep_alive=args.keep_alive))
+    rate_config: ratelimit.RateConfig = ratelimit.RateConfig(max_rate=args.max_rate, max_concurrency=args.workers)
+    rate_controller: ratelimit.RateController = ratelimit.load_controller(args.rate_state, args.key, rate_config)
+    run_metrics: metrics.Metrics = metrics.Metrics("fontdl", rate=rate_controller)
+    reporter: metrics.Reporter = metrics.Reporter(run_metrics, refresh=args.progress_interval, metrics_path=args.metrics_file,
+                                                  metrics_format=args.metrics_format, metrics_interval=args.metrics_interval)
+    gvars: GlobalVariables = GlobalVariables(rate=rate_controller, stats=run_metrics, reporter=reporter, index=glyphindex.GlyphIndex(args.glyph_index, args.api_url))
+    print(f"Starting at {gvars.rate.rate:.2f} requests/s with up to {gvars.rate.concurrency} concurrent requests.")
     if args.config != "": # if using config file, load font names from there and ignore command line font names
         if not os.path.exists(args.config):
             print(f"Configuration file {args.config} does not exist. Exiting.")
@@ -159,18 +334,21 @@ if __name__ == "__main__":
         if not config_fonts or len(config_fonts) == 0:
             print(f"No valid font names found in configuration file {args.config}. Exiting.")
             exit(1)
-        args = FontDLArguments(
-            key=args.key,
-            dir=args.dir,
-            fonts=config_fonts,
-            config=""
-        )
-    for fontname in args.fonts:
-        gvars.current_fontname = fontname
-        try:
-            download_one_font(gvars, args, bcfg)
-        except KeyboardInterrupt:
-            print(f"\n\t...{gvars.downloaded_count} new files downloaded.\nInterrupted by user.")
-            gvars.total_downloaded_count += gvars.downloaded_count
-            break
-    print(f"Done. Total new files downloaded: {gvars.total_downloaded_count}.")
\ No newline at end of file
+        args = replace(args, fonts=config_fonts, config="")
+    journal_path: str = os.path.join(args.dir, ".fontdl.journal")
+    job_journal: journal.Journal = journal.Journal(journal_path)
+    print(f"Resume journal {journal_path}: {job_journal.count(journal.DONE)} done, {job_journal.count(journal.EMPTY)} empty, {job_journal.count(journal.FAILED)} failed.")
+    if args.glyph_index:
+        print(f"Glyph index {args.glyph_index}: {gvars.index.count()} empty or tiny ranges known for this API.")
+    print(f"Downloading with {args.workers} worker(s)...")
+    try:
+        download_fonts(gvars, args, bcfg, job_journal)
+    except KeyboardInterrupt:
+        print(f"\t...{gvars.downloaded_count} new files downloaded.\nInterrupted by user.")
+        gvars.total_downloaded_count += gvars.downloaded_count
+    finally:
+        job_journal.close()
+        gvars.index.save()
+        ratelimit.save_controller(args.rate_state, args.key, gvars.rate) # the next run starts at the last known safe rate
+    print(f"Done. Total new files downloaded: {gvars.total_downloaded_count}.")
+    print(f"HTTP: {transport.format_stats()}")
\ No newline at end of file
@@ -0,0 +1,72 @@
+# persistent index of empty and tiny glyph ranges for fontdl.py:
+# most fonts have no glyphs in most of the 256 ranges, and the API answers those with 204 or with a PBF of a few dozen bytes.
+# the index keeps these answers (the payload itself for tiny ones) per API and font, across runs and output directories,
+# so later runs write them locally instead of requesting them again.
+import os
+import json
+import base64
+import threading
+from typing import Optional, Dict
+
+# constants:
+DEFAULT_INDEX_PATH: str = os.path.join(os.path.expanduser("~"), ".cache", "maptilerdl", "glyphs.json")
+TINY_SIZE: int = 128 # bytes, a glyph range PBF with only the font stack name and range in it
+
+class GlyphIndex:
+    def __init__(self, path: str, api_url: str, tiny_size: int = TINY_SIZE) -> None:
+        self.path = path
+        self.api_url = api_url # the same font may differ between APIs (e.g. a mock server)
+        self.tiny_size = tiny_size
+        self.entries: Dict[str, Dict[int, bytes]] = {} # font -> range begin -> payload, b"" for 204 No Content
+        self.written: int = 0 # tiny ranges answered from the index
+        self.skipped: int = 0 # known 204 ranges, nothing to write
+        self.dirty: bool = False
+        self.lock = threading.Lock()
+        self.load()
+    def load(self) -> None:
+        if not self.path:
+            return # index disabled
+        try:
+            with open(self.path, "r") as f:
+                fonts: Dict[str, Dict[str, str]] = json.load(f).get(self.api_url, {})
+            self.entries = {font: {int(begin): base64.b64decode(payload) for begin, payload in ranges.items()} for font, ranges in fonts.items()}
+        except (OSError, ValueError) as e:
+            if os.path.exists(self.path):
+                print(f"Ignoring unreadable glyph index {self.path}: {e}")
+    def get(self, font: str, range_begin: int) -> Optional[bytes]:
+        with self.lock:
+            payload: Optional[bytes] = self.entries.get(font, {}).get(range_begin)
+            if payload:
+                self.written += 1
+            elif payload is not None:
+                self.skipped += 1
+            return payload
+    def record(self, font: str, range_begin: int, payload: bytes) -> None: # payload b"" for 204 No Content
+        if not self.path or len(payload) > self.tiny_size:
+            return
+        with self.lock:
+            self.entries.setdefault(font, {})[range_begin] = payload
+            self.dirty = True
+    def count(self) -> int:
+        with self.lock:
+            return sum(len(ranges) for ranges in self.entries.values())
+    def save(self) -> None:
+        if not self.path or not self.dirty:
+            return
+        states: Dict[str, Dict[str, Dict[str, str]]] = {}
+        try:
+            with open(self.path, "r") as f:
+                states = json.load(f)
+        except (OSError, ValueError):
+            pass
+        with self.lock:
+            states[self.api_url] = {font: {str(begin): base64.b64encode(payload).decode("ascii") for begin, payload in sorted(ranges.items())}
+                                    for font, ranges in sorted(self.entries.items())}
+            self.dirty = False
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path + ".tmp", "w") as f:
+                json.dump(states, f)
+            os.replace(self.path + ".tmp", self.path)
+        except OSError as e:
+            print(f"Could not save glyph index to {self.path}: {e}")
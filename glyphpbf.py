@@ -0,0 +1,91 @@
+# minimal protobuf reader/writer for glyph range PBFs, as downloaded by fontdl.py:
+#   glyphs { repeated fontstack stacks = 1; }
+#   fontstack { string name = 1; string range = 2; repeated glyph glyphs = 3; }
+#   glyph { uint32 id = 1; bytes bitmap = 2; uint32 width = 3; ... }
+# only what is needed to combine several fonts into one stack: glyph messages are kept as raw bytes, only their id is decoded.
+from typing import Optional, Tuple, List, Dict, Iterator
+
+# constants:
+VARINT: int = 0
+FIXED64: int = 1
+LENGTH_DELIMITED: int = 2
+FIXED32: int = 5
+# types, classes and data structures:
+class GlyphPBFError(ValueError):
+    pass
+
+def read_varint(data: bytes, pos: int) -> Tuple[int, int]: # value, position after it
+    result: int = 0
+    shift: int = 0
+    while True:
+        if pos >= len(data):
+            raise GlyphPBFError("truncated varint")
+        byte: int = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+        if shift > 63:
+            raise GlyphPBFError("varint too long")
+def iter_fields(data: bytes) -> Iterator[Tuple[int, int, int | bytes]]: # (field number, wire type, value)
+    pos: int = 0
+    while pos < len(data):
+        key, pos = read_varint(data, pos)
+        field, wire_type = key >> 3, key & 7
+        if wire_type == VARINT:
+            value, pos = read_varint(data, pos)
+            yield field, wire_type, value
+        elif wire_type == LENGTH_DELIMITED:
+            length, pos = read_varint(data, pos)
+            if pos + length > len(data):
+                raise GlyphPBFError("truncated field")
+            yield field, wire_type, data[pos:pos + length]
+            pos += length
+        elif wire_type == FIXED64:
+            pos += 8
+        elif wire_type == FIXED32:
+            pos += 4
+        else:
+            raise GlyphPBFError(f"unsupported wire type {wire_type}")
+def encode_varint(value: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte: int = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+def encode_field(field: int, payload: bytes) -> bytes: # length-delimited field
+    return encode_varint(field << 3 | LENGTH_DELIMITED) + encode_varint(len(payload)) + payload
+def parse_glyphs(data: bytes) -> Tuple[str, str, Dict[int, bytes]]: # (font stack name, range, glyph id -> raw glyph message)
+    name: str = ""
+    glyph_range: str = ""
+    glyphs: Dict[int, bytes] = {}
+    for field, wire_type, stack in iter_fields(data):
+        if field != 1 or wire_type != LENGTH_DELIMITED:
+            continue
+        for stack_field, stack_wire_type, value in iter_fields(stack):
+            if stack_wire_type != LENGTH_DELIMITED:
+                continue
+            if stack_field == 1:
+                name = value.decode("utf-8")
+            elif stack_field == 2:
+                glyph_range = value.decode("utf-8")
+            elif stack_field == 3:
+                glyph_id: Optional[int] = next((v for f, w, v in iter_fields(value) if f == 1 and w == VARINT), None)
+                if glyph_id is not None:
+                    glyphs.setdefault(glyph_id, value)
+    return name, glyph_range, glyphs
+def combine_glyphs(pbfs: List[bytes], name: str, glyph_range: str) -> bytes:
+    # one stack with the glyphs of every font, the first font that has a glyph wins, like a CSS font stack
+    glyphs: Dict[int, bytes] = {}
+    for pbf in pbfs:
+        _, _, font_glyphs = parse_glyphs(pbf)
+        for glyph_id, glyph in font_glyphs.items():
+            glyphs.setdefault(glyph_id, glyph)
+    stack: bytes = encode_field(1, name.encode("utf-8")) + encode_field(2, glyph_range.encode("utf-8"))
+    stack += b"".join(encode_field(3, glyphs[glyph_id]) for glyph_id in sorted(glyphs))
+    return encode_field(1, stack)
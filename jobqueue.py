@@ -0,0 +1,270 @@
+# shared work queue for splitting one tiledl.py job across processes, hosts and API keys:
+# - plan:  tiledl.py --plan-queue writes its deduplicated tile plan as batches (aligned squares of tiles) into a SQLite file
+# - work:  any number of tiledl.py --queue workers, each with its own API key, rate limiter and output location,
+#          claim one batch at a time under a lease that they renew while downloading; an expired lease (a crashed worker)
+#          puts the batch back up for grabs
+# - merge: python3 jobqueue.py merge copies the tiles of every finished batch from the worker that finished it
+#          into one output tree or MBTiles file, with a resume journal and validator index like a single tiledl.py run
+# the queue file must be on storage with working file locks (a local disk, or NFS with locking), SQLite serializes the claims.
+# usage: python3 jobqueue.py status -q /shared/sg.queue
+#        python3 jobqueue.py merge -q /shared/sg.queue -o ~/tiles/sat --format mbtiles
+import os
+import gzip
+import json
+import time
+import socket
+import sqlite3
+import argparse
+import threading
+from typing import Optional, Tuple, List, Dict, Iterator
+from dataclasses import dataclass
+import journal
+import tilestore
+import cacheindex
+from tilemath import TileRange, iter_tile_coords
+
+# types, classes and data structures:
+@dataclass(frozen=True, slots=True, kw_only=True)
+class Batch:
+    id: int
+    tile_range: TileRange
+@dataclass(frozen=True, slots=True, kw_only=True)
+class WorkerOutput:
+    id: str
+    dir: str
+    format: str
+
+# constants:
+PENDING: str = "pending"
+CLAIMED: str = "claimed"
+DONE: str = "done"
+BATCH_SIZE: int = 4096 # tiles per batch, rounded down to a square with a power of two side
+LEASE: float = 600.0 # seconds a claim lasts without renewal
+RENEW_EVERY: float = 60.0
+BUSY_TIMEOUT: float = 60.0 # seconds to wait for another process's write lock
+SCHEMA: str = """
+CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS batches (id INTEGER PRIMARY KEY, zoom INTEGER, minx INTEGER, miny INTEGER, maxx INTEGER, maxy INTEGER,
+                                    status TEXT NOT NULL DEFAULT 'pending', worker TEXT, lease_until REAL, attempts INTEGER NOT NULL DEFAULT 0,
+                                    ok INTEGER, empty INTEGER, failed INTEGER, finished REAL);
+CREATE INDEX IF NOT EXISTS batches_status ON batches (status, lease_until);
+CREATE TABLE IF NOT EXISTS workers (id TEXT PRIMARY KEY, host TEXT, dir TEXT, format TEXT, key_id TEXT, started REAL, last_seen REAL);
+"""
+
+def split_range(tile_range: TileRange, batch_size: int) -> Iterator[TileRange]:
+    # squares aligned to multiples of their side, so neighbouring tiles (and their directories) land in the same batch
+    side: int = 1
+    while (side * 2) ** 2 <= batch_size:
+        side *= 2
+    for bx in range(tile_range.minx // side, tile_range.maxx // side + 1):
+        for by in range(tile_range.miny // side, tile_range.maxy // side + 1):
+            yield TileRange(zoom=tile_range.zoom, minx=max(tile_range.minx, bx * side), miny=max(tile_range.miny, by * side),
+                            maxx=min(tile_range.maxx, (bx + 1) * side - 1), maxy=min(tile_range.maxy, (by + 1) * side - 1))
+def make_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}-{os.urandom(3).hex()}"
+class WorkQueue:
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.lock = threading.Lock() # the lease renewal thread shares the connection
+        # autocommit, every write below takes the database lock explicitly with BEGIN IMMEDIATE
+        self.connection = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+        self.connection.executescript(SCHEMA)
+    def meta(self) -> Dict[str, str]:
+        with self.lock:
+            return dict(self.connection.execute("SELECT name, value FROM meta").fetchall())
+    def plan(self, tile_plan: List[TileRange], meta: Dict[str, str], batch_size: int = BATCH_SIZE) -> int:
+        # tile_plan must be disjoint (tilecover.merge_ranges), so no tile is in two batches; returns the batch count
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                if self.connection.execute("SELECT 1 FROM batches LIMIT 1").fetchone() is not None:
+                    raise ValueError(f"work queue {self.path} already has a plan")
+                self.connection.executemany("INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)", list(meta.items()))
+                self.connection.executemany("INSERT INTO batches (zoom, minx, miny, maxx, maxy) VALUES (?, ?, ?, ?, ?)",
+                                            ((r.zoom, r.minx, r.miny, r.maxx, r.maxy) for tile_range in tile_plan for r in split_range(tile_range, batch_size)))
+                count: int = self.connection.execute("SELECT COUNT(*) FROM batches").fetchone()[0]
+                self.connection.execute("COMMIT")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+        return count
+    def register(self, worker: WorkerOutput, key_id: str) -> None:
+        now: float = time.time()
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO workers (id, host, dir, format, key_id, started, last_seen) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                    (worker.id, socket.gethostname(), os.path.abspath(worker.dir), worker.format, key_id, now, now))
+    def claim(self, worker_id: str) -> Optional[Batch]:
+        now: float = time.time()
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE") # one claim at a time across all processes and hosts
+            try:
+                row = self.connection.execute(f"SELECT id, zoom, minx, miny, maxx, maxy FROM batches WHERE status = '{PENDING}' ORDER BY id LIMIT 1").fetchone()
+                if row is None: # batches of crashed or stopped workers
+                    row = self.connection.execute(f"SELECT id, zoom, minx, miny, maxx, maxy FROM batches WHERE status = '{CLAIMED}' AND lease_until < ? ORDER BY id LIMIT 1",
+                                                  (now,)).fetchone()
+                if row is not None:
+                    self.connection.execute(f"UPDATE batches SET status = '{CLAIMED}', worker = ?, lease_until = ?, attempts = attempts + 1 WHERE id = ?",
+                                            (worker_id, now + LEASE, row[0]))
+                self.connection.execute("UPDATE workers SET last_seen = ? WHERE id = ?", (now, worker_id))
+                self.connection.execute("COMMIT")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None
+        return Batch(id=row[0], tile_range=TileRange(zoom=row[1], minx=row[2], miny=row[3], maxx=row[4], maxy=row[5]))
+    def renew(self, worker_id: str, batch_id: int) -> bool: # False if the lease expired and another worker took the batch
+        now: float = time.time()
+        with self.lock:
+            cursor = self.connection.execute(f"UPDATE batches SET lease_until = ? WHERE id = ? AND worker = ? AND status = '{CLAIMED}'",
+                                             (now + LEASE, batch_id, worker_id))
+            self.connection.execute("UPDATE workers SET last_seen = ? WHERE id = ?", (now, worker_id))
+        return cursor.rowcount == 1
+    def complete(self, worker_id: str, batch_id: int, ok: int, empty: int, failed: int) -> bool:
+        # only the worker holding the claim finishes a batch, so the merge reads each batch from exactly one worker
+        with self.lock:
+            cursor = self.connection.execute(f"UPDATE batches SET status = '{DONE}', lease_until = NULL, ok = ?, empty = ?, failed = ?, finished = ? "
+                                             f"WHERE id = ? AND worker = ? AND status = '{CLAIMED}'", (ok, empty, failed, time.time(), batch_id, worker_id))
+        return cursor.rowcount == 1
+    def release(self, worker_id: str, batch_id: int) -> None: # e.g. on Ctrl+C, so the batch does not wait for its lease to expire
+        with self.lock:
+            self.connection.execute(f"UPDATE batches SET status = '{PENDING}', worker = NULL, lease_until = NULL WHERE id = ? AND worker = ? AND status = '{CLAIMED}'",
+                                    (batch_id, worker_id))
+    def status(self) -> Dict[str, Tuple[int, int]]: # status -> (batches, tiles)
+        with self.lock:
+            rows = self.connection.execute("SELECT status, COUNT(*), SUM((maxx - minx + 1) * (maxy - miny + 1)) FROM batches GROUP BY status").fetchall()
+        return {status: (batches, tiles) for status, batches, tiles in rows}
+    def done_batches(self) -> Dict[str, List[TileRange]]: # worker -> ranges of the batches it finished
+        with self.lock:
+            rows = self.connection.execute(f"SELECT worker, zoom, minx, miny, maxx, maxy FROM batches WHERE status = '{DONE}' ORDER BY id").fetchall()
+        batches: Dict[str, List[TileRange]] = {}
+        for worker, zoom, minx, miny, maxx, maxy in rows:
+            batches.setdefault(worker, []).append(TileRange(zoom=zoom, minx=minx, miny=miny, maxx=maxx, maxy=maxy))
+        return batches
+    def workers(self) -> Dict[str, WorkerOutput]:
+        with self.lock:
+            rows = self.connection.execute("SELECT id, dir, format FROM workers").fetchall()
+        return {worker_id: WorkerOutput(id=worker_id, dir=dir, format=format) for worker_id, dir, format in rows}
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
+class LeaseRenewer: # keeps the claim on the current batch alive while it downloads
+    def __init__(self, queue: WorkQueue, worker_id: str, batch_id: int) -> None:
+        self.queue = queue
+        self.worker_id = worker_id
+        self.batch_id = batch_id
+        self.lost: bool = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+    def __enter__(self) -> "LeaseRenewer":
+        self.thread.start()
+        return self
+    def __exit__(self, *exc_info) -> None:
+        self.stopped.set()
+        self.thread.join()
+    def run(self) -> None:
+        while not self.stopped.wait(RENEW_EVERY):
+            try:
+                if not self.queue.renew(self.worker_id, self.batch_id):
+                    self.lost = True
+            except sqlite3.Error as e: # e.g. the shared storage is briefly unavailable, the lease has minutes to spare
+                print(f"\tCould not renew the lease on batch {self.batch_id}: {e}")
+
+def merge(queue: WorkQueue, output_dir: str, format: str) -> Tuple[int, int, int]:
+    # copies every finished batch from its worker's output; tiles already merged are skipped, so a merge can be rerun
+    # as more batches finish. returns (tiles copied, empty, failed)
+    meta: Dict[str, str] = queue.meta()
+    name, ext = meta["type"], meta["ext"]
+    flush_every: Optional[int] = None if format == "mbtiles" else journal.FLUSH_EVERY
+    merged_journal: journal.Journal = journal.Journal(os.path.join(output_dir, f".{name}.journal"), flush_every=flush_every)
+    merged_store: tilestore.DirectoryTileStore | tilestore.MBTilesTileStore = tilestore.open_tile_store(format, output_dir, name, ext, on_commit=merged_journal.flush)
+    merged_index: cacheindex.CacheIndex = cacheindex.CacheIndex(os.path.join(output_dir, f".{name}.validators"))
+    if "mbtiles_metadata" in meta:
+        merged_store.set_metadata(json.loads(meta["mbtiles_metadata"]))
+    workers: Dict[str, WorkerOutput] = queue.workers()
+    copied: int = 0
+    empty: int = 0
+    failed: int = 0
+    try:
+        for worker_id, tile_ranges in queue.done_batches().items():
+            worker: Optional[WorkerOutput] = workers.get(worker_id)
+            if worker is None or not os.path.isdir(worker.dir):
+                print(f"Output of worker {worker_id} ({worker.dir if worker else 'unknown'}) is not reachable, skipping its {len(tile_ranges)} batches.")
+                continue
+            print(f"Merging {len(tile_ranges)} batches from {worker.dir} ({worker.format})...")
+            # worker outputs are only read: nothing is created, migrated or committed in them
+            worker_journal: journal.Journal = journal.Journal(os.path.join(worker.dir, f".{name}.journal"), read_only=True)
+            worker_store: tilestore.DirectoryTileStore | tilestore.MBTilesReader
+            if worker.format == "mbtiles":
+                worker_store = tilestore.MBTilesReader(os.path.join(worker.dir, f"{name}.mbtiles"))
+            else:
+                worker_store = tilestore.DirectoryTileStore(worker.dir, ext)
+            index_path: str = os.path.join(worker.dir, f".{name}.validators")
+            worker_index: Optional[cacheindex.CacheIndex] = cacheindex.CacheIndex(index_path, read_only=True) if os.path.exists(index_path) else None
+            try:
+                for tile_range in tile_ranges:
+                    group: str = str(tile_range.zoom)
+                    for x, y in iter_tile_coords(tile_range):
+                        key: int = journal.tile_key(tile_range.zoom, x, y)
+                        status: Optional[str] = worker_journal.status(group, key)
+                        if status is None or merged_journal.status(group, key) == status:
+                            continue
+                        if status == journal.DONE:
+                            data: Optional[bytes] = worker_store.read(tile_range.zoom, x, y)
+                            if data is None:
+                                continue
+                            if ext == "pbf" and worker.format == "mbtiles" and format == "dir" and data.startswith(tilestore.GZIP_MAGIC):
+                                data = gzip.decompress(data) # MBTiles keeps vector tiles gzip-compressed, tile directories do not
+                            merged_store.write(tile_range.zoom, x, y, data)
+                            copied += 1
+                        elif status == journal.EMPTY:
+                            empty += 1
+                        else:
+                            failed += 1
+                        validators: Optional[cacheindex.Validators] = worker_index.get(tile_range.zoom, x, y) if worker_index is not None else None
+                        if validators is not None: # so --refresh on the merged output knows when each tile was checked
+                            merged_index.put(tile_range.zoom, x, y, validators.etag, validators.last_modified, validators.checked)
+                        merged_journal.record(status, group, key)
+            finally:
+                worker_journal.close()
+                worker_store.close()
+                if worker_index is not None:
+                    worker_index.close()
+    finally:
+        merged_store.close() # commits the last MBTiles batch, then flushes the journal
+        merged_journal.close()
+        merged_index.close()
+    return copied, empty, failed
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Inspect and merge a tiledl.py work queue (see --plan-queue and --queue of tiledl.py).")
+    commands = parser.add_subparsers(dest="command", required=True)
+    status = commands.add_parser("status", help="Show how many batches and tiles are pending, claimed and done")
+    status.add_argument("-q", "--queue", type=str, required=True, help="Work queue file")
+    merge_parser = commands.add_parser("merge", help="Copy the tiles of every finished batch into one output")
+    merge_parser.add_argument("-q", "--queue", type=str, required=True, help="Work queue file")
+    merge_parser.add_argument("-o", "--output", type=str, required=True, help="Directory to merge into")
+    merge_parser.add_argument("--format", type=str, choices=tilestore.FORMAT_CHOICES, default="dir",
+                              help="Output format: 'dir' for {z}/{x}/{y}.{ext} files, 'mbtiles' for a single {type}.mbtiles file")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    if not os.path.exists(args.queue):
+        print(f"Work queue {args.queue} does not exist. Exiting.")
+        exit(1)
+    work_queue: WorkQueue = WorkQueue(args.queue)
+    if args.command == "status":
+        counts: Dict[str, Tuple[int, int]] = work_queue.status()
+        for status in (PENDING, CLAIMED, DONE):
+            batches, tiles = counts.get(status, (0, 0))
+            print(f"{status:>8}: {batches} batches, {tiles} tiles")
+        print(f"{len(work_queue.workers())} workers registered.")
+    else:
+        if not os.path.exists(args.output):
+            print(f"Directory {args.output} does not exist. Creating it...")
+            os.makedirs(args.output)
+        copied, empty, failed = merge(work_queue, args.output, args.format)
+        pending: int = sum(batches for status, (batches, _) in work_queue.status().items() if status != DONE)
+        print(f"Done. {copied} tiles copied, {empty} empty, {failed} failed" + (f", {pending} batches not finished yet." if pending else "."))
+    work_queue.close()
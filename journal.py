@@ -0,0 +1,105 @@
+# per-job resume journal for tiledl.py and fontdl.py:
+# an append-only text log with one "{status} {group} {key}" line per finished item,
+# e.g. "D 16 3363831234" for tile 16/x/y (key = x << zoom | y) or "E noto-sans-bold 5120" for a font range.
+# on startup the log is replayed into per-group bitmaps, so reruns skip finished items without any filesystem lookup.
+import os
+import threading
+from typing import Optional, Dict, List, TextIO
+
+# constants:
+DONE: str = "D"    # downloaded and written
+EMPTY: str = "E"   # server answered 204 No Content
+FAILED: str = "F"  # failed after all retries
+STATUSES = (DONE, EMPTY, FAILED)
+CHUNK_BITS: int = 4096 # keys per bitmap chunk, tiles of one x column are contiguous keys
+FLUSH_EVERY: int = 100 # records buffered before the log is written out
+
+class Bitset: # sparse bitmap: only chunks that contain a set bit are allocated
+    def __init__(self) -> None:
+        self.chunks: Dict[int, bytearray] = {}
+        self.count: int = 0
+    def __contains__(self, key: int) -> bool:
+        chunk: Optional[bytearray] = self.chunks.get(key // CHUNK_BITS)
+        if chunk is None:
+            return False
+        offset: int = key % CHUNK_BITS
+        return bool(chunk[offset >> 3] & (1 << (offset & 7)))
+    def add(self, key: int) -> None:
+        chunk: bytearray = self.chunks.setdefault(key // CHUNK_BITS, bytearray(CHUNK_BITS // 8))
+        offset: int = key % CHUNK_BITS
+        if not chunk[offset >> 3] & (1 << (offset & 7)):
+            chunk[offset >> 3] |= 1 << (offset & 7)
+            self.count += 1
+    def discard(self, key: int) -> None:
+        chunk: Optional[bytearray] = self.chunks.get(key // CHUNK_BITS)
+        offset: int = key % CHUNK_BITS
+        if chunk is not None and chunk[offset >> 3] & (1 << (offset & 7)):
+            chunk[offset >> 3] &= ~(1 << (offset & 7)) & 0xFF
+            self.count -= 1
+class Journal:
+    def __init__(self, path: str, flush_every: Optional[int] = FLUSH_EVERY, read_only: bool = False) -> None:
+        self.path = path
+        self.flush_every = flush_every # None: only written out by flush(), e.g. after the tile store commits
+        self.index: Dict[str, Dict[str, Bitset]] = {} # group -> status -> keys
+        self.lock = threading.Lock()
+        self.buffer: List[str] = []
+        self.offset: int = 0 # bytes of the log replayed so far
+        self.load()
+        self.file: Optional[TextIO] = None if read_only else open(path, "a") # read_only: e.g. another worker's journal, never created or appended to
+    def load(self) -> None: # replays the log from self.offset, so a reader can pick up records another process appended
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            data: bytes = f.read()
+        end: int = data.rfind(b"\n") + 1 # a last line without newline may still be being written
+        self.offset += end
+        with self.lock:
+            for line in data[:end].decode("utf-8", errors="replace").splitlines():
+                parts = line.split()
+                if len(parts) != 3 or parts[0] not in STATUSES:
+                    continue # tolerate a torn last line after a crash
+                try:
+                    self.mark(parts[0], parts[1], int(parts[2]))
+                except ValueError:
+                    continue
+    def reload(self) -> None: # read_only journals of a download that is still running
+        if os.path.exists(self.path) and os.path.getsize(self.path) > self.offset:
+            self.load()
+    def mark(self, status: str, group: str, key: int) -> None:
+        statuses: Optional[Dict[str, Bitset]] = self.index.get(group)
+        if statuses is None:
+            statuses = self.index[group] = {s: Bitset() for s in STATUSES}
+        for s, keys in statuses.items():
+            if s == status:
+                keys.add(key)
+            else:
+                keys.discard(key) # a later record supersedes an earlier one, e.g. a retried failure
+    def status(self, group: str, key: int) -> Optional[str]:
+        statuses: Optional[Dict[str, Bitset]] = self.index.get(group)
+        if statuses is None:
+            return None
+        return next((s for s, keys in statuses.items() if key in keys), None)
+    def record(self, status: str, group: str, key: int) -> None:
+        with self.lock:
+            self.mark(status, group, key)
+            self.buffer.append(f"{status} {group} {key}\n")
+            if self.flush_every is not None and len(self.buffer) >= self.flush_every:
+                self.write_buffer()
+    def write_buffer(self) -> None: # caller holds the lock
+        self.file.writelines(self.buffer)
+        self.file.flush()
+        self.buffer.clear()
+    def flush(self) -> None:
+        with self.lock:
+            self.write_buffer()
+    def count(self, status: str) -> int:
+        return sum(statuses[status].count for statuses in self.index.values())
+    def close(self) -> None:
+        if self.file is None:
+            return
+        with self.lock:
+            self.write_buffer()
+            self.file.close()
+def tile_key(zoom: int, x: int, y: int) -> int:
+    return (x << zoom) | y
@@ -0,0 +1,218 @@
+# run metrics and progress reporting for tiledl.py and fontdl.py:
+# workers only update counters and a latency histogram under a lock; a single reporter thread renders the
+# progress line at a fixed refresh rate (a plain line every few seconds when stdout is not a terminal)
+# and periodically exports snapshots as JSON lines or as a Prometheus text file.
+import os
+import sys
+import json
+import time
+import threading
+from typing import Optional, Tuple, List, Dict, TextIO
+from dataclasses import dataclass, field
+import ratelimit
+
+# constants:
+OUTCOMES: List[str] = ["skipped", "ok", "empty", "unchanged", "failed"]
+LATENCY_BUCKETS: Tuple[float, ...] = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0) # seconds, upper bounds
+METRICS_FORMAT_CHOICES: List[str] = ["jsonl", "prometheus"]
+TTY_REFRESH: float = 0.5   # seconds between progress redraws on a terminal
+LOG_REFRESH: float = 30.0  # seconds between progress lines when stdout is redirected (nohup, files)
+METRICS_INTERVAL: float = 10.0
+# types, classes and data structures:
+@dataclass(frozen=False, slots=True, kw_only=True)
+class Histogram:
+    bounds: Tuple[float, ...] = LATENCY_BUCKETS
+    counts: List[int] = field(default_factory=lambda: [0] * (len(LATENCY_BUCKETS) + 1)) # last bucket is +Inf
+    total: float = 0.0
+    count: int = 0
+    def observe(self, value: float) -> None:
+        i: int = 0
+        while i < len(self.bounds) and value > self.bounds[i]:
+            i += 1
+        self.counts[i] += 1
+        self.total += value
+        self.count += 1
+    def quantile(self, q: float) -> float: # upper bound of the bucket holding the q-quantile
+        if self.count == 0:
+            return 0.0
+        rank: float = q * self.count
+        seen: int = 0
+        for i, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return self.bounds[i] if i < len(self.bounds) else float("inf")
+        return float("inf")
+class Metrics:
+    def __init__(self, name: str, rate: Optional[ratelimit.RateController] = None) -> None:
+        self.name = name # "tiledl" or "fontdl", used as the Prometheus label
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.start: float = time.monotonic()
+        self.planned: int = 0
+        self.items: Dict[str, int] = {outcome: 0 for outcome in OUTCOMES}
+        self.responses: Dict[str, int] = {} # status code (or "timeout" / "error") -> count
+        self.retries: Dict[str, int] = {}   # same keys, attempts that were retried
+        self.bytes_downloaded: int = 0
+        self.latency = Histogram()
+    def add_planned(self, count: int) -> None:
+        with self.lock:
+            self.planned += count
+    def observe_request(self, status: str, seconds: float, size: int = 0, retried: bool = False) -> None:
+        with self.lock:
+            self.responses[status] = self.responses.get(status, 0) + 1
+            if retried:
+                self.retries[status] = self.retries.get(status, 0) + 1
+            self.bytes_downloaded += size
+            self.latency.observe(seconds)
+    def observe_item(self, outcome: str) -> None:
+        with self.lock:
+            self.items[outcome] += 1
+    def snapshot(self) -> dict:
+        with self.lock:
+            elapsed: float = max(1e-9, time.monotonic() - self.start)
+            finished: int = sum(self.items.values())
+            snapshot: dict = {
+                "time": time.time(),
+                "tool": self.name,
+                "elapsed_sec": elapsed,
+                "planned": self.planned,
+                "finished": finished,
+                "items": dict(self.items),
+                "responses": dict(self.responses),
+                "retries": dict(self.retries),
+                "bytes_downloaded": self.bytes_downloaded,
+                "bytes_per_sec": self.bytes_downloaded / elapsed,
+                "items_per_sec": finished / elapsed,
+                "latency": {"count": self.latency.count, "sum": self.latency.total, "p50": self.latency.quantile(0.5),
+                            "p99": self.latency.quantile(0.99), "buckets": list(self.latency.counts)},
+            }
+        if self.rate is not None:
+            snapshot["backoff"] = self.rate.gauges()
+        return snapshot
+class Reporter:
+    def __init__(self, metrics: Metrics, refresh: Optional[float] = None, metrics_path: str = "", metrics_format: str = "jsonl",
+                 metrics_interval: float = METRICS_INTERVAL, stream: TextIO = sys.stdout) -> None:
+        self.metrics = metrics
+        self.stream = stream
+        self.tty: bool = stream.isatty()
+        self.refresh: float = refresh if refresh is not None else (TTY_REFRESH if self.tty else LOG_REFRESH)
+        self.metrics_path = metrics_path
+        self.metrics_format = metrics_format
+        self.metrics_interval = metrics_interval
+        self.last_render: float = 0.0
+        self.last_export: float = 0.0
+        self.lock = threading.Lock() # serializes output of the reporter thread and log()
+        self.stopped = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+    def start(self) -> None:
+        self.stopped.clear() # may be restarted, e.g. once per zoom level with --build-overviews
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+    def stop(self) -> None: # renders the final progress and writes the final snapshot
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.tick(final=True)
+    def run(self) -> None:
+        interval: float = min(self.refresh, self.metrics_interval) if self.metrics_path else self.refresh
+        while not self.stopped.wait(interval):
+            self.tick()
+    def tick(self, final: bool = False) -> None:
+        now: float = time.monotonic()
+        render: bool = final or now - self.last_render >= self.refresh * 0.99 # the waits are never exactly on time
+        export: bool = bool(self.metrics_path) and (final or now - self.last_export >= self.metrics_interval * 0.99)
+        if not render and not export:
+            return
+        snapshot: dict = self.metrics.snapshot()
+        if render:
+            self.last_render = now
+            with self.lock:
+                if self.tty:
+                    self.stream.write(f"\033[2K\t{format_progress(snapshot)}" + ("\n" if final else "\r"))
+                else:
+                    self.stream.write(f"\t{format_progress(snapshot)}\n")
+                self.stream.flush()
+        if export:
+            self.last_export = now
+            export_snapshot(snapshot, self.metrics_path, self.metrics_format)
+    def log(self, message: str) -> None: # a line that stays, printed above the progress line
+        with self.lock:
+            self.stream.write(("\033[2K" if self.tty else "") + message + "\n")
+            self.stream.flush()
+
+def format_bytes(size: float) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1000.0:
+            return f"{size:.1f} {unit}"
+        size /= 1000.0
+    return f"{size:.1f} TB"
+def format_progress(snapshot: dict) -> str:
+    planned, finished, items = snapshot["planned"], snapshot["finished"], snapshot["items"]
+    percent: float = 100.0 * finished / planned if planned else 0.0
+    eta: str = ""
+    if 0 < snapshot["items_per_sec"] and finished < planned:
+        eta = f", ETA {time.strftime('%H:%M:%S', time.gmtime((planned - finished) / snapshot['items_per_sec']))}"
+    line: str = f"Finished {finished}/{planned} ({percent:.1f}%): {items['ok']} OK, {items['skipped']} SKP, {items['empty']} NIL, "
+    if items["unchanged"]: # only in --refresh runs
+        line += f"{items['unchanged']} 304, "
+    line += (f"{items['failed']} ERR | {snapshot['items_per_sec']:.1f} items/s, {format_bytes(snapshot['bytes_per_sec'])}/s,"
+             f" p50 {snapshot['latency']['p50'] * 1000:.0f} ms")
+    backoff: Optional[dict] = snapshot.get("backoff")
+    if backoff is not None:
+        line += f" | {backoff['rate']:.1f} req/s x {backoff['concurrency']}"
+        if backoff["blocked_for"] > 0:
+            line += f", paused {backoff['blocked_for']:.0f} s"
+    return line + eta
+def format_prometheus(snapshot: dict) -> str:
+    tool: str = f'tool="{snapshot["tool"]}"'
+    lines: List[str] = [
+        "# HELP maptilerdl_items_planned Items (tiles or glyph ranges) planned for this run.",
+        "# TYPE maptilerdl_items_planned gauge",
+        f"maptilerdl_items_planned{{{tool}}} {snapshot['planned']}",
+        "# HELP maptilerdl_items_total Finished items by outcome.",
+        "# TYPE maptilerdl_items_total counter",
+        *(f'maptilerdl_items_total{{{tool},outcome="{outcome}"}} {count}' for outcome, count in snapshot["items"].items()),
+        "# HELP maptilerdl_responses_total HTTP responses by status code, or timeout / error without a response.",
+        "# TYPE maptilerdl_responses_total counter",
+        *(f'maptilerdl_responses_total{{{tool},status="{status}"}} {count}' for status, count in sorted(snapshot["responses"].items())),
+        "# HELP maptilerdl_retries_total Requests that were retried, by the status code of the failed attempt.",
+        "# TYPE maptilerdl_retries_total counter",
+        *(f'maptilerdl_retries_total{{{tool},status="{status}"}} {count}' for status, count in sorted(snapshot["retries"].items())),
+        "# HELP maptilerdl_downloaded_bytes_total Response bytes received.",
+        "# TYPE maptilerdl_downloaded_bytes_total counter",
+        f"maptilerdl_downloaded_bytes_total{{{tool}}} {snapshot['bytes_downloaded']}",
+        "# HELP maptilerdl_request_duration_seconds Request latency.",
+        "# TYPE maptilerdl_request_duration_seconds histogram",
+    ]
+    cumulative: int = 0
+    for bound, count in zip(list(LATENCY_BUCKETS) + ["+Inf"], snapshot["latency"]["buckets"]):
+        cumulative += count
+        lines.append(f'maptilerdl_request_duration_seconds_bucket{{{tool},le="{bound}"}} {cumulative}')
+    lines.append(f"maptilerdl_request_duration_seconds_sum{{{tool}}} {snapshot['latency']['sum']}")
+    lines.append(f"maptilerdl_request_duration_seconds_count{{{tool}}} {snapshot['latency']['count']}")
+    backoff: Optional[dict] = snapshot.get("backoff")
+    if backoff is not None:
+        lines += [
+            "# HELP maptilerdl_rate_limit Current request rate limit of the adaptive controller (requests/s).",
+            "# TYPE maptilerdl_rate_limit gauge",
+            f"maptilerdl_rate_limit{{{tool}}} {backoff['rate']}",
+            "# HELP maptilerdl_concurrency_limit Current in-flight request limit of the adaptive controller.",
+            "# TYPE maptilerdl_concurrency_limit gauge",
+            f"maptilerdl_concurrency_limit{{{tool}}} {backoff['concurrency']}",
+            "# HELP maptilerdl_backoff_seconds Seconds until requests resume after Retry-After / exhausted rate limit headers.",
+            "# TYPE maptilerdl_backoff_seconds gauge",
+            f"maptilerdl_backoff_seconds{{{tool}}} {backoff['blocked_for']}",
+        ]
+    return "\n".join(lines) + "\n"
+def export_snapshot(snapshot: dict, path: str, metrics_format: str) -> None:
+    try:
+        if metrics_format == "prometheus": # replaced atomically, e.g. for node_exporter's textfile collector
+            with open(path + ".tmp", "w") as f:
+                f.write(format_prometheus(snapshot))
+            os.replace(path + ".tmp", path)
+        else:
+            with open(path, "a") as f:
+                f.write(json.dumps(snapshot) + "\n")
+    except OSError as e:
+        print(f"Could not write metrics to {path}: {e}")
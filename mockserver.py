@@ -0,0 +1,211 @@
+# local stand-in for the MapTiler API, for load-testing tiledl.py and fontdl.py without spending quota:
+# serves the same URL shapes as their URL_TEMPLATEs, with configurable latency, payload sizes and
+# injected 204 / 429 / 5xx responses. GET /__stats returns what was served, GET /__reset clears it.
+# usage: python3 mockserver.py --port 8080 --latency 30 --p429 0.01
+#        python3 tiledl.py -k test --api-url http://127.0.0.1:8080 ...
+import re
+import zlib
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs, unquote
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Optional, Dict, List
+from dataclasses import dataclass, field
+from glyphpbf import encode_field, encode_varint
+
+# types, classes and data structures:
+@dataclass(frozen=True, slots=True, kw_only=True)
+class MockConfig:
+    latency_ms: float = 20.0   # mean added latency per request
+    jitter_ms: float = 5.0     # uniform +/- jitter around the mean
+    p204: float = 0.0          # probability of 204 No Content (tiles only, like empty areas upstream)
+    p429: float = 0.0          # probability of 429 Too Many Requests
+    p5xx: float = 0.0          # probability of 503 Service Unavailable
+    ptruncate: float = 0.0     # probability of a 200 whose body is cut off halfway, then the connection is closed
+    changed: float = 0.0       # fraction of tiles with a new version since BASE_MODIFIED, fixed per tile; the rest answer conditional requests with 304
+    retry_after: float = 1.0   # Retry-After seconds sent with 429 / 503, 0 to omit the header
+    tile_size: int = 20_000    # payload bytes per tile
+    glyph_size: int = 5_000    # payload bytes per glyph range
+    empty_glyphs: float = 0.0  # fraction of glyph ranges answered with a PBF without glyphs, fixed per font and range
+    seed: Optional[int] = None
+@dataclass(frozen=False, slots=True, kw_only=True)
+class MockStats:
+    status_counts: Dict[int, int] = field(default_factory=dict)
+    bytes_sent: int = 0
+    latencies_ms: List[float] = field(default_factory=list) # time from request parsed to response written
+    lock: threading.Lock = field(default_factory=threading.Lock)
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+    def __init__(self, address: tuple, config: MockConfig) -> None:
+        super().__init__(address, MockHandler)
+        self.config = config
+        self.stats = MockStats()
+        self.random = random.Random(config.seed)
+        self.random_lock = threading.Lock()
+        self.started: float = time.time()
+        self.filler: bytes = random.Random(config.seed).randbytes(max(config.tile_size, config.glyph_size))
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # keep-alive, like the real API
+    disable_nagle_algorithm = True # headers and body are separate writes, Nagle + delayed ACK would add ~40 ms to each keep-alive response
+    server: MockServer
+    def log_message(self, format: str, *args) -> None:
+        pass # keep the benchmark output clean
+    def do_GET(self) -> None:
+        start: float = time.perf_counter()
+        url = urlsplit(self.path)
+        if url.path == "/__stats":
+            return self.send_json(summarize_stats(self.server.stats))
+        if url.path == "/__reset":
+            with self.server.stats.lock:
+                self.server.stats = MockStats()
+            return self.send_json({"reset": True})
+        config: MockConfig = self.server.config
+        tile = TILE_PATH.match(url.path)
+        glyphs = FONT_PATH.match(url.path)
+        if tile is None and glyphs is None:
+            return self.finish_request(start, 404, b"")
+        if not parse_qs(url.query).get("key"):
+            return self.finish_request(start, 403, b"Invalid key")
+        with self.server.random_lock:
+            delay: float = max(0.0, config.latency_ms + self.server.random.uniform(-config.jitter_ms, config.jitter_ms)) / 1000.0
+            roll: float = self.server.random.random()
+        time.sleep(delay)
+        if roll < config.p429:
+            return self.finish_request(start, 429, b"Too Many Requests", retry_after=True)
+        if roll < config.p429 + config.p5xx:
+            return self.finish_request(start, 503, b"Service Unavailable", retry_after=True)
+        if tile is not None and roll < config.p429 + config.p5xx + config.p204:
+            return self.finish_request(start, 204, b"")
+        truncate: bool = roll >= 1.0 - config.ptruncate
+        if tile is not None:
+            changed: bool = zlib.crc32(b"changed" + url.path.encode("utf-8")) % 1000 < config.changed * 1000
+            etag: str = f'"{zlib.crc32(url.path.encode("utf-8")):08x}-{2 if changed else 1}"'
+            last_modified: float = self.server.started if changed else BASE_MODIFIED
+            if is_not_modified(self.headers, etag, last_modified):
+                return self.finish_request(start, 304, b"", validators=(etag, last_modified))
+            body: bytes = make_payload(tile.group("e"), url.path, config.tile_size, self.server.filler)
+            return self.finish_request(start, 200, body, content_type=CONTENT_TYPES.get(tile.group("e"), "application/octet-stream"),
+                                       truncate=truncate, validators=(etag, last_modified))
+        if zlib.crc32(url.path.encode("utf-8")) % 1000 < config.empty_glyphs * 1000:
+            body: bytes = make_glyphs(unquote(glyphs.group("font")), int(glyphs.group("begin")), int(glyphs.group("end")), 0, self.server.filler)
+        else:
+            body = make_glyphs(unquote(glyphs.group("font")), int(glyphs.group("begin")), int(glyphs.group("end")), config.glyph_size, self.server.filler)
+        self.finish_request(start, 200, body, content_type=CONTENT_TYPES["pbf"], truncate=truncate)
+    def finish_request(self, start: float, status: int, body: bytes, content_type: str = "text/plain", retry_after: bool = False, truncate: bool = False,
+                       validators: Optional[tuple] = None) -> None:
+        self.send_response(status)
+        if validators is not None:
+            self.send_header("ETag", validators[0])
+            self.send_header("Last-Modified", formatdate(validators[1], usegmt=True))
+        if status not in (204, 304):
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+        if retry_after and self.server.config.retry_after > 0:
+            self.send_header("Retry-After", f"{self.server.config.retry_after:g}")
+        self.end_headers()
+        if truncate:
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = True
+        elif status not in (204, 304):
+            self.wfile.write(body)
+        stats: MockStats = self.server.stats
+        with stats.lock:
+            stats.status_counts[status] = stats.status_counts.get(status, 0) + 1
+            stats.bytes_sent += len(body)
+            stats.latencies_ms.append((time.perf_counter() - start) * 1000.0)
+    def send_json(self, data: dict) -> None:
+        body: bytes = json.dumps(data).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+# constants:
+TILE_PATH = re.compile(r"^/tiles/(?P<t>[^/]+)/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.(?P<e>[a-z]+)$")
+FONT_PATH = re.compile(r"^/fonts/(?P<font>[^/]+)/(?P<begin>\d+)-(?P<end>\d+)\.pbf$")
+MAGIC_BYTES: Dict[str, bytes] = { # enough of each format's header for magic-byte checks
+    "jpg": b"\xff\xd8\xff\xe0",
+    "webp": b"RIFF\x00\x00\x00\x00WEBPVP8L",
+    "pbf": b"\x1a", # vector tile layer
+}
+BASE_MODIFIED: float = 1704067200.0 # 2024-01-01, when unchanged tiles were last modified
+CONTENT_TYPES: Dict[str, str] = {"jpg": "image/jpeg", "webp": "image/webp", "pbf": "application/x-protobuf"}
+
+def summarize_stats(stats: MockStats) -> dict:
+    with stats.lock:
+        latencies: List[float] = sorted(stats.latencies_ms)
+        return {
+            "requests": len(latencies),
+            "status_counts": {str(k): v for k, v in sorted(stats.status_counts.items())},
+            "bytes_sent": stats.bytes_sent,
+            "latency_ms": {"p50": percentile(latencies, 50), "p90": percentile(latencies, 90), "p99": percentile(latencies, 99),
+                           "max": latencies[-1] if latencies else 0.0},
+        }
+def percentile(sorted_values: List[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100.0))]
+def make_payload(ext: str, path: str, size: int, filler: bytes) -> bytes:
+    # magic bytes, then the path so that every tile is distinct, then filler up to the requested size
+    head: bytes = MAGIC_BYTES.get(ext, b"") + path.encode("utf-8")
+    tail: bytes = b"\xff\xd9" if ext == "jpg" else b"" # JPEG end of image marker
+    return head + filler[:max(0, size - len(head) - len(tail))] + tail
+def is_not_modified(headers, etag: str, last_modified: float) -> bool:
+    if headers.get("If-None-Match") is not None: # takes precedence over If-Modified-Since
+        return etag in [tag.strip() for tag in headers["If-None-Match"].split(",")]
+    try:
+        return headers.get("If-Modified-Since") is not None and parsedate_to_datetime(headers["If-Modified-Since"]).timestamp() >= int(last_modified)
+    except (TypeError, ValueError):
+        return False
+def make_glyphs(font: str, begin: int, end: int, size: int, filler: bytes) -> bytes:
+    # glyphs { stacks { name: font, range: "begin-end", glyphs { id, bitmap, metrics }... } }, glyphs are added until size bytes
+    stack: bytes = encode_field(1, font.encode("utf-8")) + encode_field(2, f"{begin}-{end}".encode("utf-8"))
+    bitmap_size: int = max(1, size // (end - begin + 1) - 16) # the rest of each glyph message is id, metrics and framing
+    for glyph_id in range(begin, end + 1):
+        if len(stack) + bitmap_size + 16 > size:
+            break
+        offset: int = (glyph_id * 31) % max(1, len(filler) - bitmap_size)
+        metrics: bytes = b"".join(bytes([field << 3]) + encode_varint(value) for field, value in ((3, 10), (4, 12), (5, 1), (6, 2), (7, 12)))
+        glyph: bytes = bytes([1 << 3]) + encode_varint(glyph_id) + encode_field(2, filler[offset:offset + bitmap_size]) + metrics
+        stack += encode_field(3, glyph)
+    return encode_field(1, stack)
+def start_server(config: MockConfig, host: str = "127.0.0.1", port: int = 0) -> MockServer: # port 0 picks a free port
+    server = MockServer((host, port), config)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+def parse_arguments() -> argparse.Namespace:
+    DEFAULTS = MockConfig()
+    parser = argparse.ArgumentParser(description="Local stand-in for the MapTiler tiles and fonts API.")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("-p", "--port", type=int, default=8080, help="Port to listen on")
+    parser.add_argument("--latency", type=float, default=DEFAULTS.latency_ms, help="Mean added latency per request (ms)")
+    parser.add_argument("--jitter", type=float, default=DEFAULTS.jitter_ms, help="Uniform latency jitter (ms)")
+    parser.add_argument("--p204", type=float, default=DEFAULTS.p204, help="Probability of a 204 No Content tile")
+    parser.add_argument("--p429", type=float, default=DEFAULTS.p429, help="Probability of a 429 Too Many Requests")
+    parser.add_argument("--p5xx", type=float, default=DEFAULTS.p5xx, help="Probability of a 503 Service Unavailable")
+    parser.add_argument("--ptruncate", type=float, default=DEFAULTS.ptruncate, help="Probability of a body cut off halfway")
+    parser.add_argument("--changed", type=float, default=DEFAULTS.changed, help="Fraction of tiles changed since the last download")
+    parser.add_argument("--retry-after", type=float, default=DEFAULTS.retry_after, help="Retry-After seconds sent with 429 / 503")
+    parser.add_argument("--tile-size", type=int, default=DEFAULTS.tile_size, help="Tile payload size (bytes)")
+    parser.add_argument("--glyph-size", type=int, default=DEFAULTS.glyph_size, help="Glyph range payload size (bytes)")
+    parser.add_argument("--empty-glyphs", type=float, default=DEFAULTS.empty_glyphs, help="Fraction of glyph ranges without glyphs")
+    parser.add_argument("--seed", type=int, default=None, help="Random seed for reproducible runs")
+    return parser.parse_args()
+def config_from_arguments(args: argparse.Namespace) -> MockConfig:
+    return MockConfig(latency_ms=args.latency, jitter_ms=args.jitter, p204=args.p204, p429=args.p429, p5xx=args.p5xx, ptruncate=args.ptruncate, changed=args.changed,
+                      retry_after=args.retry_after, tile_size=args.tile_size, glyph_size=args.glyph_size,
+                      empty_glyphs=args.empty_glyphs, seed=args.seed)
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    server = MockServer((args.host, args.port), config_from_arguments(args))
+    print(f"Mock MapTiler API listening on http://{args.host}:{server.server_address[1]} ...")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nStopped.")
@@ -0,0 +1,121 @@
+# local overview (parent tile) generation for the raster tile types of tiledl.py:
+# a tile at zoom z covers exactly its four children at z + 1, so once all four are downloaded the parent is built
+# by mosaicking them and downsampling by 2, instead of spending an API request on it.
+# decoding and encoding images is CPU bound, so tiles are built in a process pool; the tile store is only used from the caller's process.
+# terrain-RGB packs the elevation into the R, G, B bytes, averaging those bytes would mix high and low bytes of
+# different elevations, so terrain tiles are decoded to metres, averaged and re-encoded losslessly.
+import io
+from concurrent.futures import ProcessPoolExecutor, Future, wait, FIRST_COMPLETED
+from typing import Optional, Tuple, List, Dict, Iterator
+import journal
+import tilestore
+from tilemath import TileRange, iter_tile_coords
+try:
+    from PIL import Image
+except ImportError: # Pillow is only needed for --build-overviews
+    Image = None
+try:
+    import numpy as np
+except ImportError: # numpy is only needed for terrain-RGB overviews
+    np = None
+
+# constants:
+RASTER_EXTS: List[str] = ["jpg", "png", "webp"]
+JPEG_QUALITY: int = 90
+TERRAIN_BASE: float = -10000.0 # elevation (m) = TERRAIN_BASE + (R * 65536 + G * 256 + B) * TERRAIN_STEP
+TERRAIN_STEP: float = 0.1
+TERRAIN_MAX_CODE: int = (1 << 24) - 1
+
+def require_imaging(terrain: bool) -> None:
+    if Image is None:
+        raise ImportError("Pillow is required to build overviews, install it with 'pip install pillow'")
+    if terrain and np is None:
+        raise ImportError("numpy is required to build terrain-RGB overviews, install it with 'pip install numpy'")
+def is_terrain(name: str) -> bool: # tile type name, e.g. "terrain-rgb-v2"
+    return name.startswith("terrain-rgb")
+def child_coords(x: int, y: int) -> List[Tuple[int, int]]: # top left, top right, bottom left, bottom right
+    return [(2 * x, 2 * y), (2 * x + 1, 2 * y), (2 * x, 2 * y + 1), (2 * x + 1, 2 * y + 1)]
+def decode_terrain(image: "Image.Image") -> "np.ndarray": # elevations in metres
+    rgb = np.asarray(image.convert("RGB"), dtype=np.int64)
+    return TERRAIN_BASE + (rgb[..., 0] * 65536 + rgb[..., 1] * 256 + rgb[..., 2]) * TERRAIN_STEP
+def encode_terrain(elevation: "np.ndarray") -> "Image.Image":
+    code = np.clip(np.rint((elevation - TERRAIN_BASE) / TERRAIN_STEP), 0, TERRAIN_MAX_CODE).astype(np.uint32)
+    rgb = np.stack([code >> 16, (code >> 8) & 0xFF, code & 0xFF], axis=-1).astype(np.uint8)
+    return Image.fromarray(rgb, "RGB")
+def build_tile(ext: str, terrain: bool, children: List[bytes]) -> Optional[bytes]:
+    # runs in a pool process; children in child_coords order; None when a child cannot be decoded, so the parent is downloaded instead
+    try:
+        images: List["Image.Image"] = [Image.open(io.BytesIO(child)) for child in children]
+        width, height = images[0].size
+        images = [image if image.size == (width, height) else image.resize((width, height)) for image in images]
+        if terrain:
+            mosaic = np.block([[decode_terrain(images[0]), decode_terrain(images[1])], [decode_terrain(images[2]), decode_terrain(images[3])]])
+            parent = encode_terrain(mosaic.reshape(height, 2, width, 2).mean(axis=(1, 3))) # mean of each 2x2 block of elevations
+        else:
+            mode: str = "RGB" if ext == "jpg" else images[0].mode
+            mosaic_image = Image.new(mode, (2 * width, 2 * height))
+            for image, (dx, dy) in zip(images, ((0, 0), (width, 0), (0, height), (width, height))):
+                mosaic_image.paste(image.convert(mode), (dx, dy))
+            parent = mosaic_image.reduce(2) # mean of each 2x2 block of pixels
+        out = io.BytesIO()
+        if ext == "jpg":
+            parent.save(out, "JPEG", quality=JPEG_QUALITY)
+        elif ext == "webp" and terrain: # lossy compression would change the elevations
+            parent.save(out, "WEBP", lossless=True)
+        elif ext == "webp":
+            parent.save(out, "WEBP", quality=JPEG_QUALITY)
+        else:
+            parent.save(out, "PNG")
+        return out.getvalue()
+    except (OSError, ValueError): # e.g. PIL.UnidentifiedImageError, a truncated image
+        return None
+def has_tile(store: tilestore.DirectoryTileStore | tilestore.MBTilesTileStore, job_journal: journal.Journal, z: int, x: int, y: int) -> bool:
+    status: Optional[str] = job_journal.status(str(z), journal.tile_key(z, x, y))
+    if status is not None:
+        return status == journal.DONE # an empty (204) child leaves a hole, the parent is downloaded
+    return store.exists(z, x, y) # written before the journal existed
+def iter_buildable(store: tilestore.DirectoryTileStore | tilestore.MBTilesTileStore, job_journal: journal.Journal, tile_ranges: List[TileRange], order: str) -> Iterator[Tuple[int, int, int, List[bytes]]]:
+    # (z, x, y, children) of the missing tiles whose four children are all there
+    for tile_range in tile_ranges:
+        z: int = tile_range.zoom
+        for x, y in iter_tile_coords(tile_range, order):
+            status: Optional[str] = job_journal.status(str(z), journal.tile_key(z, x, y))
+            if status in (journal.DONE, journal.EMPTY) or (status is None and store.exists(z, x, y)):
+                continue
+            if not all(has_tile(store, job_journal, z + 1, cx, cy) for cx, cy in child_coords(x, y)):
+                continue
+            children: List[Optional[bytes]] = [store.read(z + 1, cx, cy) for cx, cy in child_coords(x, y)]
+            if all(child is not None for child in children):
+                yield z, x, y, children
+def build_overviews(store: tilestore.DirectoryTileStore | tilestore.MBTilesTileStore, job_journal: journal.Journal, tile_ranges: List[TileRange], ext: str, terrain: bool, workers: int, order: str = "column") -> Tuple[int, int]:
+    # builds every tile of tile_ranges whose children are there and records it as done; returns (built, undecodable)
+    built: int = 0
+    undecodable: int = 0
+    jobs: Iterator[Tuple[int, int, int, List[bytes]]] = iter_buildable(store, job_journal, tile_ranges, order)
+    pending: Dict[Future, Tuple[int, int, int]] = {}
+    max_pending: int = workers * 4 # children of a few tiles per process in flight, never a whole level
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        try:
+            while True:
+                while len(pending) < max_pending:
+                    job: Optional[Tuple[int, int, int, List[bytes]]] = next(jobs, None)
+                    if job is None:
+                        break
+                    z, x, y, children = job
+                    pending[pool.submit(build_tile, ext, terrain, children)] = (z, x, y)
+                if not pending:
+                    break
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    z, x, y = pending.pop(future)
+                    data: Optional[bytes] = future.result()
+                    if data is None:
+                        undecodable += 1
+                        continue
+                    store.write(z, x, y, data)
+                    job_journal.record(journal.DONE, str(z), journal.tile_key(z, x, y))
+                    built += 1
+        except KeyboardInterrupt:
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise
+    return built, undecodable
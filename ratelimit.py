@@ -0,0 +1,153 @@
+# adaptive rate controller shared by the download workers of tiledl.py and fontdl.py:
+# a token bucket paces requests, an in-flight window caps concurrency, and both adapt to the
+# responses (AIMD): clean responses grow them additively, throttling shrinks them multiplicatively.
+# Retry-After and RateLimit-* headers are honored, and the last safe rate is saved per API key.
+import os
+import json
+import time
+import hashlib
+import threading
+from email.utils import parsedate_to_datetime
+from typing import Optional, Mapping, Dict
+from dataclasses import dataclass
+
+# types, classes and data structures:
+@dataclass(frozen=True, slots=True, kw_only=True)
+class RateConfig:
+    initial_rate: float = 1.0        # requests per second when nothing is known about the key
+    min_rate: float = 0.1
+    max_rate: float = 20.0
+    rate_increase: float = 0.1       # requests per second added per second of clean responses
+    slow_start_increase: float = 0.5 # rate added per clean response until the first decrease, grows the rate ~1.5x per second
+    throttle_factor: float = 0.5     # rate and window multiplier on 429
+    error_factor: float = 0.75       # rate multiplier on 5xx and connection errors
+    max_concurrency: int = 1         # usually the number of workers
+    cooldown: float = 1.0            # seconds after a decrease during which further decreases are ignored
+    max_retry_after: float = 300.0   # ignore absurd Retry-After hints
+class RateController:
+    def __init__(self, config: RateConfig, rate: Optional[float] = None, concurrency: Optional[float] = None) -> None:
+        self.config = config
+        self.rate: float = min(config.max_rate, max(config.min_rate, rate if rate is not None else config.initial_rate))
+        self.window: float = min(config.max_concurrency, max(1.0, concurrency if concurrency is not None else config.max_concurrency))
+        self.tokens: float = 1.0
+        self.last_refill: float = time.monotonic()
+        self.blocked_until: float = 0.0 # set by Retry-After / exhausted rate limit headers
+        self.last_decrease: float = 0.0
+        self.in_flight: int = 0
+        self.slow_start: bool = rate is None # a saved rate is already known to be safe, probe upwards only slowly
+        self.condition = threading.Condition()
+    @property
+    def concurrency(self) -> int:
+        return max(1, int(self.window))
+    def refill(self, now: float) -> None: # caller holds the condition
+        self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.last_refill) * self.rate) # burst of at most one second
+        self.last_refill = now
+    def acquire(self) -> None: # blocks until a request may be sent
+        with self.condition:
+            while True:
+                now: float = time.monotonic()
+                self.refill(now)
+                if now < self.blocked_until:
+                    delay: float = self.blocked_until - now
+                elif self.in_flight >= self.concurrency:
+                    delay = 1.0 # woken up by release()
+                elif self.tokens < 1.0:
+                    delay = (1.0 - self.tokens) / self.rate
+                else:
+                    self.tokens -= 1.0
+                    self.in_flight += 1
+                    return
+                self.condition.wait(delay)
+    def release(self, status_code: Optional[int] = None, headers: Optional[Mapping[str, str]] = None, timed_out: bool = False) -> None:
+        # status_code None means the request failed without a response (connection error or timeout)
+        with self.condition:
+            self.in_flight -= 1
+            now: float = time.monotonic()
+            if headers is not None:
+                self.apply_hints(now, status_code, headers)
+            if status_code is not None and status_code < 400:
+                increase: float = self.config.slow_start_increase if self.slow_start else self.config.rate_increase / self.rate
+                self.rate = min(self.config.max_rate, self.rate + increase)
+                self.window = min(float(self.config.max_concurrency), self.window + 1.0 / self.window)
+            elif is_congestion(status_code) and now - self.last_decrease >= self.config.cooldown: # one decrease per burst of bad responses
+                self.last_decrease = now
+                self.slow_start = False
+                if status_code == 429:
+                    self.rate = max(self.config.min_rate, self.rate * self.config.throttle_factor)
+                    self.window = max(1.0, self.window * self.config.throttle_factor)
+                elif timed_out: # the server is slow rather than refusing us: send fewer requests at once
+                    self.window = max(1.0, self.window * self.config.throttle_factor)
+                else:
+                    self.rate = max(self.config.min_rate, self.rate * self.config.error_factor)
+            # other 4xx (403, 404, ...) are about the request, not the load: the rate is left as it is
+            self.condition.notify_all()
+    def apply_hints(self, now: float, status_code: Optional[int], headers: Mapping[str, str]) -> None: # caller holds the condition
+        retry_after: Optional[float] = parse_retry_after(headers.get("Retry-After"))
+        if retry_after is not None and status_code in (429, 503):
+            self.blocked_until = max(self.blocked_until, now + min(retry_after, self.config.max_retry_after))
+        remaining: Optional[float] = parse_number(headers.get("RateLimit-Remaining", headers.get("X-RateLimit-Remaining")))
+        reset: Optional[float] = parse_number(headers.get("RateLimit-Reset", headers.get("X-RateLimit-Reset")))
+        if remaining is None or reset is None or reset <= 0:
+            return
+        if reset > 1e9: # some servers send an epoch timestamp instead of seconds
+            reset = max(0.0, reset - time.time())
+        reset = min(reset, self.config.max_retry_after)
+        if remaining <= 0:
+            self.blocked_until = max(self.blocked_until, now + reset)
+        else:
+            self.rate = max(self.config.min_rate, min(self.rate, remaining / reset)) # spread the remaining quota over the window
+    def snapshot(self) -> Dict[str, float]:
+        with self.condition:
+            return {"rate": self.rate, "concurrency": self.window}
+    def gauges(self) -> Dict[str, float]: # current backoff state, for metrics
+        with self.condition:
+            return {"rate": self.rate, "concurrency": self.concurrency, "in_flight": self.in_flight,
+                    "blocked_for": max(0.0, self.blocked_until - time.monotonic())}
+
+# constants:
+DEFAULT_STATE_PATH: str = os.path.join(os.path.expanduser("~"), ".cache", "maptilerdl", "ratelimit.json")
+
+def is_congestion(status_code: Optional[int]) -> bool: # None: no response (connection error or timeout)
+    return status_code is None or status_code == 429 or status_code >= 500
+def parse_number(value: Optional[str]) -> Optional[float]:
+    if value is None:
+        return None
+    try:
+        return float(value.split(",")[0].split(";")[0]) # first policy if several are listed
+    except ValueError:
+        return None
+def parse_retry_after(value: Optional[str]) -> Optional[float]: # delay in seconds or an HTTP date
+    if value is None:
+        return None
+    seconds: Optional[float] = parse_number(value)
+    if seconds is not None:
+        return max(0.0, seconds)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+def key_id(key: str) -> str: # never store the API key itself
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+def load_controller(path: str, key: str, config: RateConfig) -> RateController:
+    state: Dict[str, float] = {}
+    try:
+        with open(path, "r") as f:
+            state = json.load(f).get(key_id(key), {})
+    except (OSError, ValueError):
+        pass # first run for this machine, start from the defaults
+    return RateController(config, rate=state.get("rate"), concurrency=state.get("concurrency"))
+def save_controller(path: str, key: str, controller: RateController) -> None:
+    states: Dict[str, Dict[str, float]] = {}
+    try:
+        with open(path, "r") as f:
+            states = json.load(f)
+    except (OSError, ValueError):
+        pass
+    states[key_id(key)] = {**controller.snapshot(), "updated": time.time()}
+    try:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path + ".tmp", "w") as f:
+            json.dump(states, f, indent=2)
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        print(f"Could not save rate limiter state to {path}: {e}")
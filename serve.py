@@ -0,0 +1,311 @@
+# offline server for the output of tiledl.py and fontdl.py, with the same URL shapes as the MapTiler API,
+# so a map style only needs its base URL changed:
+#   /tiles/{type}/{z}/{x}/{y}.{ext}  from a {z}/{x}/{y}.{ext} directory or a {type}.mbtiles file
+#   /fonts/{font stack}/{range}.pbf  from {Font Name}/{begin}-{end}.pbf directories, "Font A,Font B" stacks are combined on the fly
+# hot responses are kept in a size-bounded LRU cache and sent with an ETag and a long-lived Cache-Control header.
+# usage: python3 serve.py --tiles ~/tiles/sat ~/tiles/v4 --fonts ~/fonts/vx --port 8080
+import os
+import re
+import json
+import time
+import gzip
+import glob
+import sqlite3
+import hashlib
+import argparse
+import threading
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, unquote
+from typing import Optional, List, Dict
+from dataclasses import dataclass, replace
+import journal
+import glyphpbf
+import tilestore
+
+# types, classes and data structures:
+@dataclass(frozen=True, slots=True, kw_only=True)
+class CachedResponse:
+    status: int
+    body: bytes
+    etag: str
+    content_type: str
+    content_encoding: Optional[str] = None
+    version: Optional[str] = None # what the response was built from, a cached entry is rebuilt once this changes
+class LRUCache: # bounded by the total size of the cached bodies
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[str, CachedResponse] = OrderedDict()
+        self.size: int = 0
+        self.hits: int = 0
+        self.misses: int = 0
+        self.lock = threading.Lock()
+    def get(self, key: str) -> Optional[CachedResponse]:
+        with self.lock:
+            entry: Optional[CachedResponse] = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+    def put(self, key: str, entry: CachedResponse) -> None:
+        cost: int = len(entry.body) + len(key) + ENTRY_OVERHEAD
+        if cost > self.max_bytes:
+            return
+        with self.lock:
+            old: Optional[CachedResponse] = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old.body) + len(key) + ENTRY_OVERHEAD
+            self.entries[key] = entry
+            self.size += cost
+            while self.size > self.max_bytes:
+                old_key, old = self.entries.popitem(last=False)
+                self.size -= len(old.body) + len(old_key) + ENTRY_OVERHEAD
+    def stats(self) -> dict:
+        with self.lock:
+            return {"entries": len(self.entries), "bytes": self.size, "max_bytes": self.max_bytes, "hits": self.hits, "misses": self.misses}
+class EmptyTiles: # tiles the resume journal recorded as 204 No Content upstream, answered with 204 instead of 404
+    def __init__(self, path: str) -> None:
+        self.journal: Optional[journal.Journal] = journal.Journal(path, read_only=True) if os.path.exists(path) else None
+        self.lock = threading.Lock()
+    def is_empty(self, z: int, x: int, y: int) -> bool:
+        if self.journal is None:
+            return False
+        with self.lock:
+            self.journal.reload() # picks up tiles recorded by a download that is still running
+        return self.journal.status(str(z), journal.tile_key(z, x, y)) == journal.EMPTY
+class DirectorySource:
+    def __init__(self, root: str, name: str) -> None:
+        self.root = root
+        self.empty = EmptyTiles(os.path.join(root, f".{name}.journal"))
+    def read(self, z: int, x: int, y: int, ext: str) -> Optional[bytes]:
+        return tilestore.DirectoryTileStore(self.root, ext).read(z, x, y)
+    def version(self, z: int, x: int, y: int, ext: str) -> Optional[str]: # tiles are renamed into place, so a rewrite changes the mtime
+        return file_version(tilestore.DirectoryTileStore(self.root, ext).tile_path(z, x, y))
+class MBTilesSource:
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.empty = EmptyTiles(os.path.join(os.path.dirname(path), f".{os.path.basename(path)[:-len('.mbtiles')]}.journal")) # written next to it by tiledl.py
+        self.local = threading.local() # sqlite connections must not be shared between request threads
+        self.format: Optional[str] = dict(self.connection().execute("SELECT name, value FROM metadata").fetchall()).get("format")
+        self.has_map: bool = self.connection().execute("SELECT 1 FROM sqlite_master WHERE name = 'map'").fetchone() is not None
+    def connection(self) -> sqlite3.Connection:
+        connection: Optional[sqlite3.Connection] = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = self.local.connection = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+        return connection
+    def read(self, z: int, x: int, y: int, ext: str) -> Optional[bytes]:
+        if self.format is not None and self.format != ext:
+            return None
+        row = self.connection().execute("SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                                        (z, x, tilestore.flip_y(z, y))).fetchone()
+        return None if row is None else bytes(row[0])
+    def version(self, z: int, x: int, y: int, ext: str) -> Optional[str]:
+        if not self.has_map: # a plain tiles table, any commit to the file may have changed the tile
+            return file_version(self.path)
+        row = self.connection().execute("SELECT tile_id FROM map WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                                        (z, x, tilestore.flip_y(z, y))).fetchone()
+        return None if row is None else row[0] # the hash of the tile data in files written by tiledl.py
+class TileServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128 # map clients open many connections at once
+    def __init__(self, address: tuple, sources: Dict[str, DirectorySource | MBTilesSource], fonts_dir: str, cache: LRUCache, max_age: int) -> None:
+        super().__init__(address, TileHandler)
+        self.sources = sources
+        self.fonts_dir = fonts_dir
+        self.font_dirs: Dict[str, str] = {} # lower case font name -> directory name
+        self.font_dirs_lock = threading.Lock()
+        self.fonts_scanned: float = 0.0 # monotonic time of the last listing
+        self.cache = cache
+        self.cache_control: str = f"public, max-age={max_age}"
+        self.scan_fonts()
+    def scan_fonts(self) -> None:
+        if not self.fonts_dir:
+            return
+        names: List[str] = [name for name in os.listdir(self.fonts_dir) if os.path.isdir(os.path.join(self.fonts_dir, name))]
+        with self.font_dirs_lock:
+            self.font_dirs = {name.lower(): name for name in names}
+            self.fonts_scanned = time.monotonic()
+    def font_dir(self, font: str) -> Optional[str]:
+        key: str = font.strip().lower().replace("-", " ")
+        with self.font_dirs_lock:
+            name: Optional[str] = self.font_dirs.get(key)
+        if name is None and time.monotonic() - self.fonts_scanned >= FONT_RESCAN: # fonts downloaded while the server runs
+            self.scan_fonts()
+            with self.font_dirs_lock:
+                name = self.font_dirs.get(key)
+        return None if name is None else os.path.join(self.fonts_dir, name)
+class TileHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # keep-alive
+    disable_nagle_algorithm = True # headers and body are separate writes, Nagle + delayed ACK would add ~40 ms to each response
+    server: TileServer
+    def log_message(self, format: str, *args) -> None:
+        pass # one line per tile would be the bottleneck
+    def do_GET(self) -> None:
+        self.respond(send_body=True)
+    def do_HEAD(self) -> None:
+        self.respond(send_body=False)
+    def respond(self, send_body: bool) -> None:
+        path: str = urlsplit(self.path).path
+        if path == "/__stats":
+            body: bytes = json.dumps(self.server.cache.stats()).encode("utf-8")
+            return self.send(CachedResponse(status=200, body=body, etag="", content_type="application/json"), send_body)
+        accepts_gzip: bool = "gzip" in self.headers.get("Accept-Encoding", "")
+        key: str = path + ("|gzip" if accepts_gzip else "")
+        entry: Optional[CachedResponse] = self.server.cache.get(key)
+        try:
+            version: Optional[str] = self.version(path) # taken before loading, so a write in between only causes one more reload
+            if entry is None or entry.version != version: # e.g. rewritten by tiledl.py --refresh or --build-overviews since it was cached
+                entry = replace(self.load(path, accepts_gzip), version=version)
+                if entry.status == 200: # missing tiles are not cached, they may be downloaded while the server runs
+                    self.server.cache.put(key, entry)
+        except (OSError, sqlite3.Error, glyphpbf.GlyphPBFError) as e:
+            self.log_error("%s: %s", path, e)
+            entry = CachedResponse(status=500, body=b"", etag="", content_type="text/plain")
+        if entry.status == 200 and etag_matches(self.headers.get("If-None-Match"), entry.etag):
+            return self.send(CachedResponse(status=304, body=b"", etag=entry.etag, content_type=entry.content_type), send_body)
+        self.send(entry, send_body)
+    def version(self, path: str) -> Optional[str]: # cheap check of the files or rows a response is built from
+        tile = TILE_PATH.match(path)
+        if tile is not None:
+            source: Optional[DirectorySource | MBTilesSource] = self.server.sources.get(unquote(tile.group("t")))
+            return None if source is None else source.version(int(tile.group("z")), int(tile.group("x")), int(tile.group("y")), tile.group("e"))
+        glyphs = FONT_PATH.match(path)
+        if glyphs is not None:
+            fonts: List[str] = [font.strip() for font in unquote(glyphs.group("fontstack")).split(",")]
+            font_dirs: List[Optional[str]] = [self.server.font_dir(font) for font in fonts]
+            return ";".join(f"{font_dir}:{file_version(os.path.join(font_dir, glyphs.group('begin') + '-' + glyphs.group('end') + '.pbf'))}"
+                            for font_dir in font_dirs if font_dir is not None)
+        return None
+    def load(self, path: str, accepts_gzip: bool) -> CachedResponse:
+        tile = TILE_PATH.match(path)
+        if tile is not None:
+            source: Optional[DirectorySource | MBTilesSource] = self.server.sources.get(unquote(tile.group("t")))
+            ext: str = tile.group("e")
+            z, x, y = int(tile.group("z")), int(tile.group("x")), int(tile.group("y"))
+            data: Optional[bytes] = None if source is None else source.read(z, x, y, ext)
+            if data is None and source is not None and source.empty.is_empty(z, x, y):
+                return CachedResponse(status=204, body=b"", etag="", content_type=CONTENT_TYPES.get(ext, "application/octet-stream"))
+            return make_response(data, CONTENT_TYPES.get(ext, "application/octet-stream"), accepts_gzip)
+        glyphs = FONT_PATH.match(path)
+        if glyphs is not None:
+            glyph_range: str = f"{glyphs.group('begin')}-{glyphs.group('end')}"
+            fonts: List[str] = [font.strip() for font in unquote(glyphs.group("fontstack")).split(",")]
+            font_dirs: List[str] = [font_dir for font_dir in map(self.server.font_dir, fonts) if font_dir is not None]
+            pbfs: List[bytes] = []
+            for font_dir in font_dirs: # a range fontdl.py recorded as empty has no file
+                if os.path.exists(os.path.join(font_dir, f"{glyph_range}.pbf")):
+                    with open(os.path.join(font_dir, f"{glyph_range}.pbf"), "rb") as f:
+                        pbfs.append(decompress(f.read()))
+            if not font_dirs:
+                data = None
+            elif len(pbfs) == 1 and len(fonts) == 1:
+                data = pbfs[0]
+            else: # several fonts, or a known font without glyphs in this range
+                data = glyphpbf.combine_glyphs(pbfs, ",".join(fonts), glyph_range)
+            return make_response(data, CONTENT_TYPES["pbf"], accepts_gzip)
+        return make_response(None, "text/plain", accepts_gzip)
+    def send(self, entry: CachedResponse, send_body: bool) -> None:
+        self.send_response(entry.status)
+        if entry.status != 204: # a 204 must not carry a body or its length
+            self.send_header("Content-Type", entry.content_type)
+            self.send_header("Content-Length", str(len(entry.body)))
+        self.send_header("Access-Control-Allow-Origin", "*") # map clients are usually served from another origin
+        if entry.etag:
+            self.send_header("ETag", entry.etag)
+        if entry.status in (200, 204, 304):
+            self.send_header("Cache-Control", self.server.cache_control)
+        if entry.content_encoding is not None:
+            self.send_header("Content-Encoding", entry.content_encoding)
+        if entry.content_type == "application/x-protobuf" or entry.content_encoding is not None:
+            self.send_header("Vary", "Accept-Encoding")
+        self.end_headers()
+        if send_body and entry.body:
+            self.wfile.write(entry.body)
+
+# constants:
+TILE_PATH = re.compile(r"^/tiles/(?P<t>[^/]+)/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.(?P<e>[a-z]+)$")
+FONT_PATH = re.compile(r"^/fonts/(?P<fontstack>[^/]+)/(?P<begin>\d+)-(?P<end>\d+)\.pbf$")
+CONTENT_TYPES: Dict[str, str] = {"jpg": "image/jpeg", "png": "image/png", "webp": "image/webp", "pbf": "application/x-protobuf"}
+ENTRY_OVERHEAD: int = 300 # approximate bytes per cache entry besides the body
+FONT_RESCAN: float = 10.0 # seconds between listings of the font directory for unknown font names
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    tags: List[str] = [tag.strip() for tag in if_none_match.split(",")]
+    return etag in [tag[2:] if tag.startswith("W/") else tag for tag in tags] # weak comparison, as for GET
+def file_version(path: str) -> Optional[str]:
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return f"{stat.st_mtime_ns}-{stat.st_size}"
+def decompress(data: bytes) -> bytes:
+    return gzip.decompress(data) if data.startswith(tilestore.GZIP_MAGIC) else data
+def make_response(data: Optional[bytes], content_type: str, accepts_gzip: bool) -> CachedResponse:
+    if data is None:
+        return CachedResponse(status=404, body=b"", etag="", content_type="text/plain")
+    encoding: Optional[str] = None
+    if data.startswith(tilestore.GZIP_MAGIC): # MBTiles vector tiles are stored gzip-compressed
+        if accepts_gzip:
+            encoding = "gzip"
+        else:
+            data = gzip.decompress(data)
+    etag: str = '"' + hashlib.blake2b(data, digest_size=8).hexdigest() + '"'
+    return CachedResponse(status=200, body=data, etag=etag, content_type=content_type, content_encoding=encoding)
+def find_sources(paths: List[str]) -> Dict[str, DirectorySource | MBTilesSource]:
+    # each path is [TYPE=]PATH; without TYPE, it is taken from the MBTiles file name or the resume journal in the directory
+    sources: Dict[str, DirectorySource | MBTilesSource] = {}
+    for spec in paths:
+        name, _, path = spec.rpartition("=")
+        path = os.path.expanduser(path)
+        if path.endswith(".mbtiles"):
+            sources[name or os.path.basename(path)[:-len(".mbtiles")]] = MBTilesSource(path)
+            continue
+        if not os.path.isdir(path):
+            print(f"Tile source {path} does not exist, ignoring it.")
+            continue
+        mbtiles: List[str] = sorted(glob.glob(os.path.join(path, "*.mbtiles")))
+        journals: List[str] = sorted(os.path.basename(p)[1:-len(".journal")] for p in glob.glob(os.path.join(path, ".*.journal")))
+        if mbtiles: # written with --format mbtiles
+            for mbtiles_path in mbtiles:
+                sources[name or os.path.basename(mbtiles_path)[:-len(".mbtiles")]] = MBTilesSource(mbtiles_path)
+        else:
+            directory_name: str = name or (journals[0] if journals else os.path.basename(os.path.normpath(path)))
+            sources[directory_name] = DirectorySource(path, journals[0] if journals else directory_name)
+    return sources
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Serve downloaded tiles and fonts offline, with MapTiler API URLs.")
+    parser.add_argument("-t", "--tiles", type=str, nargs="+", default=[], metavar="[TYPE=]PATH",
+                        help="Tile directories (-d of tiledl.py) or .mbtiles files, served as /tiles/TYPE/{z}/{x}/{y}.{ext}")
+    parser.add_argument("-f", "--fonts", type=str, default="", help="Font directory (-d of fontdl.py), served as /fonts/{font stack}/{range}.pbf")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("-p", "--port", type=int, default=8080, help="Port to listen on")
+    parser.add_argument("--cache-mb", type=float, default=256.0, help="Size of the in-memory cache of hot tiles and glyphs (MB)")
+    parser.add_argument("--max-age", type=int, default=7 * 86400, help="Cache-Control max-age sent to clients (seconds)")
+    args = parser.parse_args()
+    if not args.tiles and not args.fonts:
+        parser.error("nothing to serve, give --tiles and/or --fonts")
+    return args
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    sources: Dict[str, DirectorySource | MBTilesSource] = find_sources(args.tiles)
+    fonts_dir: str = os.path.expanduser(args.fonts)
+    if fonts_dir and not os.path.isdir(fonts_dir):
+        print(f"Font directory {fonts_dir} does not exist. Exiting.")
+        exit(1)
+    server = TileServer((args.host, args.port), sources, fonts_dir, LRUCache(int(args.cache_mb * 1e6)), args.max_age)
+    for name, source in sources.items():
+        print(f"Serving {'MBTiles ' + source.path if isinstance(source, MBTilesSource) else 'directory ' + source.root} as /tiles/{name}/...")
+    if fonts_dir:
+        print(f"Serving {len(server.font_dirs)} fonts from {fonts_dir} as /fonts/...")
+    print(f"Listening on http://{args.host}:{server.server_address[1]} ...")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nStopped.")
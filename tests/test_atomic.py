@@ -0,0 +1,66 @@
+# tilestore.py atomic writes: check_tile rejects bodies that are not a complete tile of the extension, and
+# write_atomic only renames a streamed .part file into place once it passed the checks.
+# usage: python3 -m unittest discover tests
+import os
+import sys
+import tempfile
+import unittest
+ROOT: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import tilestore
+
+# constants:
+JPEG: bytes = b"\xff\xd8\xff\xe0" + b"A" * 100 + b"\xff\xd9"
+WEBP: bytes = b"RIFF" + (104).to_bytes(4, "little") + b"WEBPVP8 " + b"B" * 92
+PNG: bytes = b"\x89PNG\r\n\x1a\n" + b"C" * 100
+
+def check(ext: str, data: bytes) -> None:
+    tilestore.check_tile(ext, data[:12], data[-2:], len(data))
+
+class CheckTileTest(unittest.TestCase):
+    def test_valid(self) -> None:
+        for ext, data in (("jpg", JPEG), ("webp", WEBP), ("png", PNG), ("pbf", b"\x1a\x02ab"), ("pbf", b"\x0a\x02ab"), ("pbf", b"\x1f\x8b\x08")):
+            check(ext, data)
+        check("pbf", b"") # a vector tile without layers
+    def test_invalid(self) -> None:
+        for ext, data in (("jpg", JPEG[:-1]), ("jpg", b""), ("jpg", PNG), ("webp", b"RIFF" + b"\0" * 4 + b"WAVE" + b"\0" * 8),
+                          ("png", JPEG), ("pbf", b"<html>error</html>")):
+            with self.assertRaises(tilestore.InvalidTile, msg=f"{ext} {data[:8]!r}"):
+                check(ext, data)
+class WriteAtomicTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path: str = os.path.join(self.tmp.name, "0.jpg")
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+    def read(self) -> bytes:
+        with open(self.path, "rb") as f:
+            return f.read()
+    def test_chunks(self) -> None:
+        chunks: list = [JPEG[:3], b"", JPEG[3:50], JPEG[50:-1], JPEG[-1:]] # the magic bytes and the end marker are split across chunks
+        self.assertEqual(tilestore.write_atomic(self.path, chunks, "jpg"), len(JPEG))
+        self.assertEqual(self.read(), JPEG)
+        self.assertFalse(os.path.exists(self.path + tilestore.PART_SUFFIX))
+    def test_invalid_keeps_old_file(self) -> None:
+        tilestore.write_atomic(self.path, [JPEG], "jpg")
+        with self.assertRaises(tilestore.InvalidTile):
+            tilestore.write_atomic(self.path, [b"\xff\xd8\xff\xe0", b"cut off"], "jpg")
+        self.assertEqual(self.read(), JPEG)
+        self.assertFalse(os.path.exists(self.path + tilestore.PART_SUFFIX))
+    def test_interrupted(self) -> None: # e.g. the connection is lost mid-body
+        def chunks():
+            yield JPEG[:50]
+            raise ConnectionError("lost")
+        with self.assertRaises(ConnectionError):
+            tilestore.write_atomic(self.path, chunks(), "jpg")
+        self.assertEqual(os.listdir(self.tmp.name), [])
+    def test_directory_store(self) -> None: # truncated files left by older versions do not count as downloaded
+        store = tilestore.DirectoryTileStore(self.tmp.name, "jpg")
+        store.write(3, 1, 2, JPEG)
+        self.assertTrue(store.exists(3, 1, 2))
+        with open(store.tile_path(3, 1, 2), "r+b") as f:
+            f.truncate(60)
+        self.assertFalse(store.exists(3, 1, 2))
+
+if __name__ == "__main__":
+    unittest.main()
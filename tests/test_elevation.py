@@ -0,0 +1,58 @@
+# elevation.py mosaic lookups on a small synthetic raster: one zoom 1 tile of 4 x 4 pixels,
+# pixel (col, row) = 100 * col + 1000 * row, so every expected value can be worked out by hand.
+# usage: python3 -m unittest discover tests
+import os
+import sys
+import math
+import tempfile
+import unittest
+ROOT: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import elevation
+
+# constants:
+ZOOM: int = 1
+TILE_SIZE: int = 4
+
+def pixel_to_lnglat(col: float, row: float) -> tuple: # inverse of ElevationMosaic.pixel_coords for the tile (0, 0)
+    fx, fy = col / TILE_SIZE, row / TILE_SIZE
+    return fx / (1 << ZOOM) * 360.0 - 180.0, math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * fy / (1 << ZOOM)))))
+
+@unittest.skipIf(elevation.np is None, "numpy is not installed")
+class LookupTest(unittest.TestCase):
+    def setUp(self) -> None:
+        np = elevation.np
+        self.tmp = tempfile.TemporaryDirectory()
+        path: str = os.path.join(self.tmp.name, "test.elev")
+        header: elevation.MosaicHeader = elevation.make_header(ZOOM, TILE_SIZE, 0, 0, 0, 0)
+        elevation.write_header(path, header)
+        raster = elevation.open_raster(path, header, "r+")
+        raster[:] = 100 * np.arange(TILE_SIZE)[None, :] + 1000 * np.arange(TILE_SIZE)[:, None]
+        raster.flush()
+        del raster
+        self.mosaic = elevation.ElevationMosaic(path)
+    def tearDown(self) -> None:
+        del self.mosaic
+        self.tmp.cleanup()
+    def lookup(self, points: list, bilinear: bool) -> list:
+        lon, lat = elevation.np.array([pixel_to_lnglat(col, row) for col, row in points]).T
+        return list(self.mosaic.lookup(lon, lat, bilinear=bilinear))
+    def test_nearest(self) -> None:
+        values = self.lookup([(0.2, 0.5), (1.5, 0.5), (3.9, 3.5), (2.5, 1.2)], bilinear=False)
+        for value, expected in zip(values, [0, 100, 3300, 1200]):
+            self.assertAlmostEqual(value, expected, places=3)
+    def test_bilinear_interior(self) -> None:
+        values = self.lookup([(1.0, 0.5), (2.0, 2.0), (1.5, 2.5)], bilinear=True)
+        for value, expected in zip(values, [50, 1650, 2100]):
+            self.assertAlmostEqual(value, expected, places=3)
+    def test_bilinear_edges(self) -> None: # the outer half pixel takes the edge pixel's own value
+        values = self.lookup([(0.2, 0.5), (3.5, 0.5), (3.9, 0.5), (0.5, 3.8), (0.1, 0.1)], bilinear=True)
+        for value, expected in zip(values, [0, 300, 300, 3000, 0]):
+            self.assertAlmostEqual(value, expected, places=3)
+    def test_outside(self) -> None:
+        lon, lat = elevation.np.array([[10.0, 45.0], [-90.0, -45.0]]).T # east of the tile, south of it
+        for bilinear in (False, True):
+            self.assertTrue(all(math.isnan(value) for value in self.mosaic.lookup(lon, lat, bilinear=bilinear)))
+
+if __name__ == "__main__":
+    unittest.main()
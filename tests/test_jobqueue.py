@@ -0,0 +1,129 @@
+# jobqueue.py: batches are aligned squares, a batch is held by one worker at a time (claim, renew, complete and
+# release only act on the worker's own claim, expired leases are taken over), and merge copies every finished batch
+# from the worker that finished it.
+# usage: python3 -m unittest discover tests
+import io
+import os
+import sys
+import time
+import contextlib
+import tempfile
+import unittest
+from unittest import mock
+ROOT: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import journal
+import jobqueue
+import tilestore
+from tilemath import TileRange
+
+# constants:
+JPEG: bytes = b"\xff\xd8\xff\xe0" + b"A" * 100 + b"\xff\xd9"
+META: dict = {"type": "satellite-v2", "ext": "jpg"}
+
+def tiles_of(ranges: list) -> list:
+    return sorted((r.zoom, x, y) for r in ranges for x in range(r.minx, r.maxx + 1) for y in range(r.miny, r.maxy + 1))
+
+class SplitRangeTest(unittest.TestCase):
+    def test_aligned_squares(self) -> None:
+        tile_range: TileRange = TileRange(zoom=10, minx=5, miny=3, maxx=40, maxy=21)
+        batches: list = list(jobqueue.split_range(tile_range, 100)) # rounded down to 8 x 8
+        self.assertEqual(tiles_of(batches), tiles_of([tile_range]))
+        for batch in batches:
+            self.assertEqual((batch.minx // 8, batch.miny // 8), (batch.maxx // 8, batch.maxy // 8))
+        self.assertEqual(len(batches), 6 * 3)
+class WorkQueueTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.queue = jobqueue.WorkQueue(os.path.join(self.tmp.name, "test.queue"))
+        self.count: int = self.queue.plan([TileRange(zoom=3, minx=0, miny=0, maxx=7, maxy=3)], META, batch_size=16)
+    def tearDown(self) -> None:
+        self.queue.close()
+        self.tmp.cleanup()
+    def test_plan(self) -> None:
+        self.assertEqual(self.count, 2)
+        self.assertEqual(self.queue.meta(), META)
+        self.assertEqual(self.queue.status(), {jobqueue.PENDING: (2, 32)})
+        with self.assertRaises(ValueError): # a second plan would put tiles in two batches
+            self.queue.plan([TileRange(zoom=3, minx=0, miny=0, maxx=0, maxy=0)], META)
+    def test_claim_complete(self) -> None:
+        first: jobqueue.Batch = self.queue.claim("a")
+        second: jobqueue.Batch = self.queue.claim("b")
+        self.assertNotEqual(first.id, second.id)
+        self.assertIsNone(self.queue.claim("c"))
+        self.assertTrue(self.queue.renew("a", first.id))
+        self.assertFalse(self.queue.renew("b", first.id))
+        self.assertFalse(self.queue.complete("b", first.id, 16, 0, 0))
+        self.assertTrue(self.queue.complete("a", first.id, 16, 0, 0))
+        self.assertFalse(self.queue.renew("a", first.id)) # done, nothing left to hold
+        self.assertEqual(self.queue.status(), {jobqueue.CLAIMED: (1, 16), jobqueue.DONE: (1, 16)})
+        self.assertEqual(self.queue.done_batches(), {"a": [first.tile_range]})
+    def test_release(self) -> None:
+        batch: jobqueue.Batch = self.queue.claim("a")
+        self.queue.release("b", batch.id) # not b's claim
+        self.assertEqual(self.queue.status()[jobqueue.CLAIMED], (1, 16))
+        self.queue.release("a", batch.id)
+        self.assertEqual(self.queue.claim("b").id, batch.id)
+    def test_expired_lease_taken_over(self) -> None:
+        with mock.patch.object(jobqueue, "LEASE", -1.0): # claims that expire at once, as if the worker crashed
+            first: jobqueue.Batch = self.queue.claim("a")
+        self.queue.claim("b")
+        taken: jobqueue.Batch = self.queue.claim("c")
+        self.assertEqual(taken.id, first.id)
+        self.assertFalse(self.queue.renew("a", first.id))
+        self.assertFalse(self.queue.complete("a", first.id, 16, 0, 0))
+        self.assertTrue(self.queue.complete("c", first.id, 16, 0, 0))
+    def test_lease_renewer_lost(self) -> None:
+        batch: jobqueue.Batch = self.queue.claim("a")
+        with mock.patch.object(jobqueue, "RENEW_EVERY", 0.01):
+            with jobqueue.LeaseRenewer(self.queue, "a", batch.id) as renewer:
+                time.sleep(0.05)
+                self.assertFalse(renewer.lost)
+                self.queue.release("a", batch.id)
+                self.queue.claim("b")
+                time.sleep(0.05)
+            self.assertTrue(renewer.lost)
+class MergeTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.queue = jobqueue.WorkQueue(os.path.join(self.tmp.name, "test.queue"))
+        self.queue.plan([TileRange(zoom=2, minx=0, miny=0, maxx=3, maxy=1)], META, batch_size=4)
+    def tearDown(self) -> None:
+        self.queue.close()
+        self.tmp.cleanup()
+    def run_worker(self, worker_id: str, format: str) -> None: # downloads one batch: an empty tile, the others done
+        worker: jobqueue.WorkerOutput = jobqueue.WorkerOutput(id=worker_id, dir=os.path.join(self.tmp.name, worker_id), format=format)
+        os.makedirs(worker.dir)
+        self.queue.register(worker, "key")
+        batch: jobqueue.Batch = self.queue.claim(worker_id)
+        worker_journal = journal.Journal(os.path.join(worker.dir, ".satellite-v2.journal"), flush_every=None)
+        store = tilestore.open_tile_store(format, worker.dir, "satellite-v2", "jpg", on_commit=worker_journal.flush)
+        tile_range: TileRange = batch.tile_range
+        for x in range(tile_range.minx, tile_range.maxx + 1):
+            for y in range(tile_range.miny, tile_range.maxy + 1):
+                if (x, y) == (tile_range.minx, tile_range.miny):
+                    worker_journal.record(journal.EMPTY, "2", journal.tile_key(2, x, y))
+                else:
+                    store.write(2, x, y, JPEG)
+                    worker_journal.record(journal.DONE, "2", journal.tile_key(2, x, y))
+        store.close()
+        worker_journal.close()
+        self.queue.complete(worker_id, batch.id, 3, 1, 0)
+    def test_merge(self) -> None:
+        self.run_worker("a", "dir")
+        self.run_worker("b", "mbtiles")
+        output: str = os.path.join(self.tmp.name, "merged")
+        os.makedirs(output)
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(jobqueue.merge(self.queue, output, "dir"), (6, 2, 0))
+        store = tilestore.DirectoryTileStore(output, "jpg")
+        self.assertEqual(sum(store.exists(2, x, y) for x in range(4) for y in range(2)), 6)
+        self.assertEqual(store.read(2, 3, 1), JPEG)
+        merged_journal = journal.Journal(os.path.join(output, ".satellite-v2.journal"))
+        self.assertEqual((merged_journal.count(journal.DONE), merged_journal.count(journal.EMPTY)), (6, 2))
+        merged_journal.close()
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(jobqueue.merge(self.queue, output, "dir"), (0, 0, 0)) # already merged
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+# journal.py: the sparse Bitset, and the resume journal replayed from its log (later records win, torn lines are skipped,
+# buffered records reach the file only when flushed).
+# usage: python3 -m unittest discover tests
+import os
+import sys
+import tempfile
+import unittest
+ROOT: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import journal
+
+class BitsetTest(unittest.TestCase):
+    def test_add_discard(self) -> None:
+        bits = journal.Bitset()
+        keys: list = [0, 7, 8, journal.CHUNK_BITS - 1, journal.CHUNK_BITS, 10 * journal.CHUNK_BITS + 3, (1 << 40) + 5]
+        for key in keys:
+            bits.add(key)
+        bits.add(7) # already there, not counted twice
+        self.assertEqual(bits.count, len(keys))
+        self.assertTrue(all(key in bits for key in keys))
+        self.assertFalse(any(key in bits for key in (1, 6, 9, journal.CHUNK_BITS + 1, (1 << 40) + 4)))
+        bits.discard(8)
+        bits.discard(9) # not there
+        self.assertEqual(bits.count, len(keys) - 1)
+        self.assertNotIn(8, bits)
+        self.assertIn(7, bits)
+    def test_sparse(self) -> None:
+        bits = journal.Bitset()
+        bits.add(1 << 44) # e.g. a zoom 22 tile key
+        self.assertEqual(len(bits.chunks), 1)
+class JournalTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path: str = os.path.join(self.tmp.name, ".test.journal")
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+    def test_replay(self) -> None:
+        log = journal.Journal(self.path)
+        log.record(journal.DONE, "12", journal.tile_key(12, 3, 4))
+        log.record(journal.EMPTY, "12", journal.tile_key(12, 3, 5))
+        log.record(journal.FAILED, "noto-sans", 256)
+        log.record(journal.DONE, "noto-sans", 256) # a retried failure
+        log.close()
+        log = journal.Journal(self.path)
+        self.assertEqual(log.status("12", journal.tile_key(12, 3, 4)), journal.DONE)
+        self.assertEqual(log.status("12", journal.tile_key(12, 3, 5)), journal.EMPTY)
+        self.assertEqual(log.status("noto-sans", 256), journal.DONE)
+        self.assertIsNone(log.status("12", journal.tile_key(12, 4, 3)))
+        self.assertIsNone(log.status("13", journal.tile_key(13, 3, 4)))
+        self.assertEqual((log.count(journal.DONE), log.count(journal.EMPTY), log.count(journal.FAILED)), (2, 1, 0))
+        log.close()
+    def test_torn_lines_skipped(self) -> None:
+        with open(self.path, "w") as f:
+            f.write("D 5 17\nX 5 18\nD 5 abc\nE 5 19\nD 5")
+        log = journal.Journal(self.path)
+        self.assertEqual(log.status("5", 17), journal.DONE)
+        self.assertEqual(log.status("5", 19), journal.EMPTY)
+        self.assertEqual(log.count(journal.DONE) + log.count(journal.EMPTY) + log.count(journal.FAILED), 2)
+        log.close()
+    def test_flush_every(self) -> None:
+        log = journal.Journal(self.path, flush_every=None) # e.g. MBTiles output, flushed after each store commit
+        log.record(journal.DONE, "3", 1)
+        self.assertEqual(log.status("3", 1), journal.DONE)
+        self.assertEqual(os.path.getsize(self.path), 0)
+        log.flush()
+        self.assertGreater(os.path.getsize(self.path), 0)
+        log.close()
+    def test_tile_key(self) -> None: # unique per tile of a zoom level, the tiles of one x column are contiguous
+        keys: set = {journal.tile_key(3, x, y) for x in range(8) for y in range(8)}
+        self.assertEqual(len(keys), 64)
+        self.assertEqual(journal.tile_key(3, 2, 5) + 1, journal.tile_key(3, 2, 6))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+# overviews.py: terrain-RGB tiles are averaged as elevations and re-encoded losslessly, raster tiles as pixels,
+# and build_overviews only builds the parents whose four children are downloaded.
+# usage: python3 -m unittest discover tests
+import io
+import os
+import sys
+import tempfile
+import unittest
+ROOT: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import journal
+import overviews
+import tilestore
+from tilemath import TileRange
+
+# constants:
+SIZE: int = 4
+
+def make_terrain(elevations, ext: str) -> bytes: # elevations: SIZE x SIZE array in metres
+    out = io.BytesIO()
+    overviews.encode_terrain(elevations).save(out, "WEBP" if ext == "webp" else "PNG", lossless=True)
+    return out.getvalue()
+def make_png(color: tuple) -> bytes:
+    out = io.BytesIO()
+    overviews.Image.new("RGB", (SIZE, SIZE), color).save(out, "PNG")
+    return out.getvalue()
+def decode(data: bytes):
+    return overviews.Image.open(io.BytesIO(data))
+
+@unittest.skipIf(overviews.Image is None or overviews.np is None, "Pillow and numpy are not installed")
+class TerrainTest(unittest.TestCase):
+    def test_round_trip(self) -> None:
+        np = overviews.np
+        elevations = np.array([[-10000.0, -432.1, 0.0, 0.1], [8848.8, 255 * 0.1, 256 * 0.1, 65536 * 0.1]] * 2)
+        self.assertTrue(np.allclose(overviews.decode_terrain(overviews.encode_terrain(elevations)), elevations))
+        clipped = overviews.decode_terrain(overviews.encode_terrain(np.array([[-20000.0, 2e6]])))
+        self.assertTrue(np.allclose(clipped, [[overviews.TERRAIN_BASE, overviews.TERRAIN_BASE + overviews.TERRAIN_MAX_CODE * overviews.TERRAIN_STEP]]))
+    def test_parent_is_mean_elevation(self) -> None:
+        np = overviews.np
+        # 25.5 m and 25.6 m differ in every byte (0x0186FF, 0x018700), averaging bytes would give nonsense
+        children_elevations: list = [np.full((SIZE, SIZE), 25.5), np.full((SIZE, SIZE), 25.6), np.arange(SIZE * SIZE, dtype=float).reshape(SIZE, SIZE) * 10,
+                                     np.tile([100.0, 300.0], (SIZE, SIZE // 2))]
+        for ext in ("png", "webp"):
+            parent = overviews.decode_terrain(decode(overviews.build_tile(ext, True, [make_terrain(e, ext) for e in children_elevations])))
+            self.assertEqual(parent.shape, (SIZE, SIZE))
+            half: int = SIZE // 2
+            self.assertTrue(np.allclose(parent[:half, :half], 25.5), ext)
+            self.assertTrue(np.allclose(parent[:half, half:], 25.6), ext)
+            self.assertAlmostEqual(parent[half, 0], (0 + 10 + 40 + 50) / 4, places=3) # top left 2x2 block of the third child
+            self.assertTrue(np.allclose(parent[half:, half:], 200.0), ext)
+@unittest.skipIf(overviews.Image is None, "Pillow is not installed")
+class RasterTest(unittest.TestCase):
+    def test_mosaic_downsampled(self) -> None:
+        colors: list = [(255, 0, 0), (0, 255, 0), (0, 0, 255), (10, 20, 30)]
+        parent = decode(overviews.build_tile("png", False, [make_png(color) for color in colors]))
+        self.assertEqual(parent.size, (SIZE, SIZE))
+        for (x, y), color in zip(((0, 0), (3, 0), (0, 3), (3, 3)), colors):
+            self.assertEqual(parent.convert("RGB").getpixel((x, y)), color)
+    def test_undecodable(self) -> None:
+        self.assertIsNone(overviews.build_tile("png", False, [make_png((0, 0, 0))] * 3 + [b"\x89PNG\r\n\x1a\n junk"]))
+    def test_build_overviews(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            store = tilestore.DirectoryTileStore(tmp, "png")
+            job_journal = journal.Journal(os.path.join(tmp, ".test.journal"))
+            for x, y in overviews.child_coords(0, 0): # all children of (1, 0, 0)
+                store.write(2, x, y, make_png((x * 50, y * 50, 0)))
+            for x, y in overviews.child_coords(1, 0)[:3]: # (1, 1, 0) misses a child
+                store.write(2, x, y, make_png((0, 0, 0)))
+            for x, y in overviews.child_coords(0, 1)[:3]: # (1, 0, 1) has one child recorded as empty
+                store.write(2, x, y, make_png((0, 0, 0)))
+            job_journal.record(journal.EMPTY, "2", journal.tile_key(2, 1, 3))
+            built, undecodable = overviews.build_overviews(store, job_journal, [TileRange(zoom=1, minx=0, miny=0, maxx=1, maxy=1)], "png", False, 1)
+            self.assertEqual((built, undecodable), (1, 0))
+            self.assertTrue(store.exists(1, 0, 0))
+            self.assertFalse(any(store.exists(1, x, y) for x, y in ((1, 0), (0, 1), (1, 1))))
+            self.assertEqual(job_journal.status("1", journal.tile_key(1, 0, 0)), journal.DONE)
+            job_journal.close()
+
+if __name__ == "__main__":
+    unittest.main()
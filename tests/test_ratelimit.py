@@ -0,0 +1,74 @@
+# ratelimit.py RateController: which responses grow, shrink or leave alone the shared rate and window,
+# and how Retry-After / RateLimit-* hints are applied.
+# usage: python3 -m unittest discover tests
+import os
+import sys
+import time
+import unittest
+ROOT: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import ratelimit
+
+def make_controller(**overrides) -> ratelimit.RateController: # saved state, so no slow start and no cooldown in the way
+    config: ratelimit.RateConfig = ratelimit.RateConfig(**{"max_rate": 100.0, "max_concurrency": 8, "cooldown": 0.0, **overrides})
+    return ratelimit.RateController(config, rate=10.0, concurrency=4.0)
+def release(controller: ratelimit.RateController, status_code, headers=None, timed_out: bool = False) -> None:
+    controller.acquire()
+    controller.release(status_code, headers, timed_out=timed_out)
+
+class RateControllerTest(unittest.TestCase):
+    def test_success_grows(self) -> None:
+        controller = make_controller()
+        release(controller, 200)
+        self.assertGreater(controller.rate, 10.0)
+        self.assertGreater(controller.window, 4.0)
+    def test_429_halves_rate_and_window(self) -> None:
+        controller = make_controller()
+        release(controller, 429)
+        self.assertAlmostEqual(controller.rate, 5.0)
+        self.assertAlmostEqual(controller.window, 2.0)
+    def test_5xx_lowers_rate(self) -> None:
+        controller = make_controller()
+        release(controller, 503)
+        self.assertAlmostEqual(controller.rate, 7.5)
+        self.assertAlmostEqual(controller.window, 4.0)
+    def test_timeout_lowers_window(self) -> None:
+        controller = make_controller()
+        release(controller, None, timed_out=True)
+        self.assertAlmostEqual(controller.rate, 10.0)
+        self.assertAlmostEqual(controller.window, 2.0)
+    def test_other_4xx_leave_rate_alone(self) -> None:
+        controller = make_controller()
+        for status_code in (400, 403, 404, 410):
+            release(controller, status_code)
+        self.assertAlmostEqual(controller.rate, 10.0)
+        self.assertAlmostEqual(controller.window, 4.0)
+    def test_is_congestion(self) -> None:
+        self.assertTrue(all(ratelimit.is_congestion(status_code) for status_code in (None, 429, 500, 503)))
+        self.assertFalse(any(ratelimit.is_congestion(status_code) for status_code in (200, 204, 304, 403, 404)))
+    def test_cooldown_merges_decreases(self) -> None:
+        controller = make_controller(cooldown=60.0)
+        release(controller, 429)
+        release(controller, 429)
+        self.assertAlmostEqual(controller.rate, 5.0)
+    def test_retry_after_blocks(self) -> None:
+        controller = make_controller()
+        release(controller, 429, {"Retry-After": "30"})
+        self.assertGreater(controller.blocked_until - time.monotonic(), 29.0)
+    def test_ratelimit_headers_cap_rate(self) -> None:
+        controller = make_controller()
+        release(controller, 200, {"RateLimit-Remaining": "20", "RateLimit-Reset": "10"})
+        self.assertAlmostEqual(controller.rate, 2.0, delta=0.1) # remaining / reset, then one additive increase
+    def test_min_rate(self) -> None:
+        controller = make_controller(min_rate=4.0)
+        for _ in range(5):
+            release(controller, 429)
+        self.assertAlmostEqual(controller.rate, 4.0)
+    def test_parse_retry_after(self) -> None:
+        self.assertEqual(ratelimit.parse_retry_after("5"), 5.0)
+        self.assertEqual(ratelimit.parse_retry_after("-1"), 0.0)
+        self.assertIsNone(ratelimit.parse_retry_after("soon"))
+        self.assertAlmostEqual(ratelimit.parse_retry_after(time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime(time.time() + 60))), 60.0, delta=2.0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+# --refresh against a local mockserver.py: tiles without a validators row get one from a 304,
+# so the next run within --max-age skips them instead of revalidating them again;
+# tiles whose file is gone are downloaded again instead of being revalidated.
+# usage: python3 -m unittest discover tests
+import os
+import sys
+import json
+import sqlite3
+import tempfile
+import unittest
+import subprocess
+import urllib.request
+ROOT: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import mockserver
+import ratelimit
+
+class RefreshTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.server = mockserver.start_server(mockserver.MockConfig(latency_ms=0.0, jitter_ms=0.0, tile_size=1000))
+        self.api_url: str = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir: str = os.path.join(self.tmp.name, "tiles")
+        self.rate_state: str = os.path.join(self.tmp.name, "rate.json")
+        with open(self.rate_state, "w") as f: # skip the slow start
+            json.dump({ratelimit.key_id("test"): {"rate": 200, "concurrency": 4}}, f)
+    def tearDown(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp.cleanup()
+    def run_tiledl(self, *extra: str) -> int: # returns the number of requests the mock server saw
+        urllib.request.urlopen(f"{self.api_url}/__reset").read()
+        subprocess.run([sys.executable, os.path.join(ROOT, "tiledl.py"), "-k", "test", "-d", self.dir, "-t", "sat", "-z", "2", "-w", "4",
+                        "--api-url", self.api_url, "--rate-state", self.rate_state, *extra], check=True, capture_output=True)
+        return json.loads(urllib.request.urlopen(f"{self.api_url}/__stats").read())["requests"]
+    def validator_rows(self) -> int:
+        with sqlite3.connect(os.path.join(self.dir, ".satellite-v2.validators")) as connection:
+            return connection.execute("SELECT COUNT(*) FROM validators").fetchone()[0]
+    def test_304_creates_missing_row(self) -> None:
+        self.assertEqual(self.run_tiledl(), 16)
+        os.remove(os.path.join(self.dir, ".satellite-v2.validators")) # e.g. tiles downloaded before the index existed
+        self.assertEqual(self.run_tiledl("--refresh", "--max-age", "1"), 16) # all answered 304 via If-Modified-Since
+        self.assertEqual(self.validator_rows(), 16)
+        self.assertEqual(self.run_tiledl("--refresh", "--max-age", "1"), 0) # checked just now, within max-age
+    def test_missing_file_is_downloaded(self) -> None:
+        self.assertEqual(self.run_tiledl(), 16)
+        tile_path: str = os.path.join(self.dir, "2", "1", "1.jpg")
+        os.remove(tile_path) # journal says done, validators are fresh, but the file is gone
+        self.assertEqual(self.run_tiledl("--refresh", "--max-age", "3600"), 1) # a plain GET, not a 304 from the stored validators
+        self.assertTrue(os.path.exists(tile_path))
+        self.assertEqual(self.run_tiledl("--refresh", "--max-age", "3600"), 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,99 @@
+# serve.py: If-None-Match matching, font stack composition, and an in-process server over a directory and an MBTiles file
+# whose tiles are rewritten while it runs (cached entries must follow the files, not the cache).
+# usage: python3 -m unittest discover tests
+import os
+import sys
+import tempfile
+import unittest
+import threading
+import urllib.error
+import urllib.request
+ROOT: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import serve
+import journal
+import glyphpbf
+import tilestore
+
+# constants:
+JPEG_A: bytes = b"\xff\xd8\xff\xe0" + b"A" * 100 + b"\xff\xd9"
+JPEG_B: bytes = b"\xff\xd8\xff\xe0" + b"B" * 200 + b"\xff\xd9"
+
+def make_glyphs(name: str, glyph_range: str, glyph_ids: list) -> bytes:
+    glyphs: bytes = b"".join(glyphpbf.encode_field(3, b"\x08" + glyphpbf.encode_varint(glyph_id) + glyphpbf.encode_field(2, name.encode("utf-8")))
+                             for glyph_id in glyph_ids)
+    return glyphpbf.encode_field(1, glyphpbf.encode_field(1, name.encode("utf-8")) + glyphpbf.encode_field(2, glyph_range.encode("utf-8")) + glyphs)
+
+class EtagTest(unittest.TestCase):
+    def test_matches(self) -> None:
+        self.assertTrue(serve.etag_matches('"abc"', '"abc"'))
+        self.assertTrue(serve.etag_matches('W/"abc"', '"abc"'))
+        self.assertTrue(serve.etag_matches('"x", W/"abc" ,"y"', '"abc"'))
+        self.assertTrue(serve.etag_matches(" * ", '"abc"'))
+    def test_no_match(self) -> None:
+        self.assertFalse(serve.etag_matches(None, '"abc"'))
+        self.assertFalse(serve.etag_matches('"ab"', '"abc"'))
+        self.assertFalse(serve.etag_matches('"abcd"', '"abc"')) # no substring matches
+        self.assertFalse(serve.etag_matches('"x", "y"', '"abc"'))
+class GlyphsTest(unittest.TestCase):
+    def test_parse(self) -> None:
+        name, glyph_range, glyphs = glyphpbf.parse_glyphs(make_glyphs("Font A", "0-255", [65, 66]))
+        self.assertEqual((name, glyph_range, sorted(glyphs)), ("Font A", "0-255", [65, 66]))
+    def test_first_font_wins(self) -> None:
+        combined: bytes = glyphpbf.combine_glyphs([make_glyphs("A", "0-255", [65, 66]), make_glyphs("B", "0-255", [66, 67])], "A,B", "0-255")
+        name, glyph_range, glyphs = glyphpbf.parse_glyphs(combined)
+        self.assertEqual((name, glyph_range, sorted(glyphs)), ("A,B", "0-255", [65, 66, 67]))
+        self.assertIn(b"A", glyphs[66]) # from the first font of the stack
+        self.assertIn(b"B", glyphs[67])
+    def test_truncated(self) -> None:
+        with self.assertRaises(glyphpbf.GlyphPBFError):
+            glyphpbf.parse_glyphs(make_glyphs("Font A", "0-255", [65])[:-3])
+class ServerTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir: str = os.path.join(self.tmp.name, "sat")
+        self.dir_store = tilestore.DirectoryTileStore(self.dir, "jpg")
+        self.dir_store.write(1, 0, 0, JPEG_A)
+        empty_journal = journal.Journal(os.path.join(self.dir, ".satellite-v2.journal"))
+        empty_journal.record(journal.EMPTY, "1", journal.tile_key(1, 1, 1))
+        empty_journal.close()
+        self.mbtiles_path: str = os.path.join(self.tmp.name, "mb", "satellite-v2.mbtiles")
+        os.makedirs(os.path.dirname(self.mbtiles_path))
+        self.mbtiles = tilestore.MBTilesTileStore(self.mbtiles_path, "jpg", batch_size=1) # each write is committed for the server to see
+        self.mbtiles.set_metadata({"format": "jpg"})
+        self.mbtiles.write(1, 0, 0, JPEG_A)
+        sources = {"sat": serve.DirectorySource(self.dir, "satellite-v2"), "mb": serve.MBTilesSource(self.mbtiles_path)}
+        self.server = serve.TileServer(("127.0.0.1", 0), sources, "", serve.LRUCache(1 << 20), 60)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url: str = f"http://127.0.0.1:{self.server.server_address[1]}"
+    def tearDown(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+        self.mbtiles.close()
+        self.tmp.cleanup()
+    def get(self, path: str, headers: dict = {}) -> tuple: # (status, body, headers)
+        try:
+            with urllib.request.urlopen(urllib.request.Request(self.url + path, headers=headers)) as response:
+                return response.status, response.read(), response.headers
+        except urllib.error.HTTPError as e:
+            return e.code, e.read(), e.headers
+    def test_statuses(self) -> None:
+        status, body, headers = self.get("/tiles/sat/1/0/0.jpg")
+        self.assertEqual((status, body), (200, JPEG_A))
+        self.assertEqual(self.get("/tiles/sat/1/0/0.jpg", {"If-None-Match": headers["ETag"]})[0], 304)
+        self.assertEqual(self.get("/tiles/sat/1/1/1.jpg")[0], 204) # recorded as empty in the journal
+        self.assertEqual(self.get("/tiles/sat/1/1/0.jpg")[0], 404)
+        self.assertEqual(self.get("/tiles/nope/1/0/0.jpg")[0], 404)
+    def test_directory_rewrite(self) -> None:
+        self.assertEqual(self.get("/tiles/sat/1/0/0.jpg")[1], JPEG_A)
+        self.dir_store.write(1, 0, 0, JPEG_B) # e.g. tiledl.py --refresh
+        self.assertEqual(self.get("/tiles/sat/1/0/0.jpg")[1], JPEG_B)
+        self.dir_store.delete(1, 0, 0)
+        self.assertEqual(self.get("/tiles/sat/1/0/0.jpg")[0], 404)
+    def test_mbtiles_rewrite(self) -> None:
+        self.assertEqual(self.get("/tiles/mb/1/0/0.jpg")[1], JPEG_A)
+        self.mbtiles.write(1, 0, 0, JPEG_B)
+        self.assertEqual(self.get("/tiles/mb/1/0/0.jpg")[1], JPEG_B)
+
+if __name__ == "__main__":
+    unittest.main()
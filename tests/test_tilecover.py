@@ -0,0 +1,75 @@
+# tilecover.py: merge_ranges returns a disjoint plan of exactly the input tiles, and plan_from_region covers a
+# lon/lat rectangle with a hole (axis-aligned in tile space too, so the expected tiles can be listed by brute force).
+# usage: python3 -m unittest discover tests
+import os
+import sys
+import math
+import random
+import unittest
+ROOT: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import tilecover
+from tilemath import TileRange, lnglat_to_tile_fraction
+
+# constants:
+OUTER: tuple = (-10.3, -7.7, 12.9, 9.4) # (minlon, minlat, maxlon, maxlat), not on tile edges up to z7
+HOLE: tuple = (-4.1, -3.3, 5.2, 4.6)
+
+def box_ring(bounds: tuple) -> list:
+    minlon, minlat, maxlon, maxlat = bounds
+    return [(minlon, minlat), (maxlon, minlat), (maxlon, maxlat), (minlon, maxlat), (minlon, minlat)]
+def tiles_of(ranges: list) -> set:
+    return {(r.zoom, x, y) for r in ranges for x in range(r.minx, r.maxx + 1) for y in range(r.miny, r.maxy + 1)}
+def expected_tiles(zoom: int) -> set: # tiles touching the outer box, except those entirely inside the hole
+    (u0, v1), (u1, v0) = lnglat_to_tile_fraction(OUTER[0], OUTER[1], zoom), lnglat_to_tile_fraction(OUTER[2], OUTER[3], zoom)
+    (hu0, hv1), (hu1, hv0) = lnglat_to_tile_fraction(HOLE[0], HOLE[1], zoom), lnglat_to_tile_fraction(HOLE[2], HOLE[3], zoom)
+    return {(zoom, x, y) for x in range(math.floor(u0), math.floor(u1) + 1) for y in range(math.floor(v0), math.floor(v1) + 1)
+            if not (x >= hu0 and x + 1 <= hu1 and y >= hv0 and y + 1 <= hv1)}
+
+class MergeRangesTest(unittest.TestCase):
+    def assert_disjoint(self, ranges: list) -> None:
+        self.assertEqual(sum(r.count for r in ranges), len(tiles_of(ranges)))
+    def test_overlapping(self) -> None:
+        ranges: list = [TileRange(zoom=4, minx=0, miny=0, maxx=5, maxy=5), TileRange(zoom=4, minx=3, miny=3, maxx=8, maxy=8),
+                        TileRange(zoom=4, minx=2, miny=2, maxx=3, maxy=3), TileRange(zoom=5, minx=0, miny=0, maxx=5, maxy=5)]
+        merged: list = tilecover.merge_ranges(ranges)
+        self.assert_disjoint(merged)
+        self.assertEqual(tiles_of(merged), tiles_of(ranges))
+    def test_adjacent_coalesced(self) -> None:
+        ranges: list = [TileRange(zoom=3, minx=x, miny=2, maxx=x, maxy=4) for x in range(6)]
+        self.assertEqual(tilecover.merge_ranges(ranges), [TileRange(zoom=3, minx=0, miny=2, maxx=5, maxy=4)])
+    def test_random(self) -> None:
+        rng = random.Random(7)
+        for _ in range(20):
+            ranges: list = []
+            for _ in range(rng.randint(1, 12)):
+                zoom, minx, miny = rng.randint(5, 6), rng.randint(0, 20), rng.randint(0, 20)
+                ranges.append(TileRange(zoom=zoom, minx=minx, miny=miny, maxx=minx + rng.randint(0, 8), maxy=miny + rng.randint(0, 8)))
+            merged: list = tilecover.merge_ranges(ranges)
+            self.assert_disjoint(merged)
+            self.assertEqual(tiles_of(merged), tiles_of(ranges))
+class PlanFromRegionTest(unittest.TestCase):
+    def test_rectangle_with_hole(self) -> None:
+        plan: list = tilecover.plan_from_region([[box_ring(OUTER), box_ring(HOLE)]], 2, 7)
+        self.assertEqual(sum(r.count for r in plan), len(tiles_of(plan)))
+        for zoom in range(2, 8):
+            self.assertEqual({tile for tile in tiles_of(plan) if tile[0] == zoom}, expected_tiles(zoom), f"zoom {zoom}")
+    def test_multipolygon(self) -> None:
+        far: tuple = (100.2, 30.1, 101.7, 31.3)
+        plan: list = tilecover.plan_from_region([[box_ring(OUTER)], [box_ring(far)]], 6, 6)
+        (u0, v1), (u1, v0) = lnglat_to_tile_fraction(far[0], far[1], 6), lnglat_to_tile_fraction(far[2], far[3], 6)
+        far_tiles: set = {(6, x, y) for x in range(math.floor(u0), math.floor(u1) + 1) for y in range(math.floor(v0), math.floor(v1) + 1)}
+        self.assertTrue(far_tiles <= tiles_of(plan))
+    def test_empty(self) -> None:
+        self.assertEqual(tilecover.plan_from_region([], 0, 5), [])
+    def test_boundary_runs(self) -> None: # boundary tiles are emitted as row and column runs, not one range per tile
+        edges: list = tilecover.get_world_edges([[box_ring(OUTER)]])
+        ranges: list = []
+        tilecover.cover_node(edges, edges, 0, 0, 0, 7, 7, ranges, {})
+        xs: set = {x for _, x, _ in expected_tiles(7)}
+        ys: set = {y for _, _, y in expected_tiles(7)}
+        self.assertLess(len(ranges), 2 * (len(xs) + len(ys)) - 4) # fewer ranges than tiles along the box's edges
+        self.assertEqual(tiles_of(ranges), {(7, x, y) for x in xs for y in ys})
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+# tilestore.py MBTiles backend: byte-identical tiles share one image, replaced or deleted tiles leave no image behind
+# once the store is closed, metadata written by several runs is merged, and vector tiles get their vector_layers.
+# usage: python3 -m unittest discover tests
+import os
+import sys
+import gzip
+import json
+import sqlite3
+import tempfile
+import unittest
+ROOT: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import tilestore
+
+# constants:
+JPEG_A: bytes = b"\xff\xd8\xff\xe0" + b"A" * 100 + b"\xff\xd9"
+JPEG_B: bytes = b"\xff\xd8\xff\xe0" + b"B" * 100 + b"\xff\xd9"
+
+def encode_field(field: int, payload: bytes) -> bytes: # length-delimited, payloads under 128 bytes
+    return bytes([field << 3 | 2, len(payload)]) + payload
+def make_vector_tile(layers: dict) -> bytes: # layer name -> attribute keys, one feature per layer
+    tile: bytes = b""
+    for name, keys in layers.items():
+        layer: bytes = encode_field(1, name.encode("utf-8")) + encode_field(2, b"\x08\x01\x18\x01") # name, feature { id: 1, type: POINT }
+        layer += b"".join(encode_field(3, key.encode("utf-8")) for key in keys) + bytes([5 << 3, 0x80, 0x20]) + bytes([15 << 3, 2]) # extent, version
+        tile += encode_field(3, layer)
+    return tile
+
+class MBTilesTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path: str = os.path.join(self.tmp.name, "test.mbtiles")
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+    def count(self, table: str) -> int:
+        with sqlite3.connect(self.path) as connection:
+            return connection.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+    def test_dedup(self) -> None:
+        store = tilestore.MBTilesTileStore(self.path, "jpg")
+        for x in range(4):
+            store.write(2, x, 0, JPEG_A)
+        store.write(2, 0, 1, JPEG_B)
+        self.assertEqual(store.read(2, 3, 0), JPEG_A)
+        self.assertEqual(store.read(2, 0, 1), JPEG_B)
+        self.assertTrue(store.exists(2, 0, 1))
+        self.assertFalse(store.exists(2, 1, 1))
+        store.close()
+        self.assertEqual((self.count("map"), self.count("images")), (5, 2))
+    def test_tms_rows(self) -> None: # MBTiles stores TMS rows, the store is addressed with XYZ rows
+        store = tilestore.MBTilesTileStore(self.path, "jpg")
+        store.write(3, 1, 0, JPEG_A)
+        store.close()
+        with sqlite3.connect(self.path) as connection:
+            self.assertEqual(connection.execute("SELECT zoom_level, tile_column, tile_row FROM map").fetchall(), [(3, 1, 7)])
+    def test_pbf_gzipped(self) -> None:
+        store = tilestore.MBTilesTileStore(self.path, "pbf")
+        store.write(0, 0, 0, b"\x1a\x02ab")
+        self.assertEqual(gzip.decompress(store.read(0, 0, 0)), b"\x1a\x02ab")
+        store.close()
+    def test_replaced_images_removed(self) -> None:
+        store = tilestore.MBTilesTileStore(self.path, "jpg")
+        store.write(1, 0, 0, JPEG_A)
+        store.write(1, 1, 0, JPEG_A)
+        store.close()
+        store = tilestore.MBTilesTileStore(self.path, "jpg") # a later --refresh run
+        store.write(1, 0, 0, JPEG_B) # JPEG_A is still used by (1, 1, 0)
+        store.close()
+        self.assertEqual(self.count("images"), 2)
+        store = tilestore.MBTilesTileStore(self.path, "jpg")
+        store.write(1, 1, 0, JPEG_B)
+        store.close()
+        self.assertEqual((self.count("map"), self.count("images")), (2, 1))
+        store = tilestore.MBTilesTileStore(self.path, "jpg")
+        store.delete(1, 0, 0)
+        store.delete(1, 1, 0)
+        store.close()
+        self.assertEqual((self.count("map"), self.count("images")), (0, 0))
+    def test_metadata_merged(self) -> None:
+        store = tilestore.MBTilesTileStore(self.path, "jpg")
+        store.set_metadata({"name": "sat", "bounds": "100,0,104,2", "minzoom": "5", "maxzoom": "8", "center": "102,1,5"})
+        store.set_metadata({"name": "sat", "bounds": "103,1,106,3", "minzoom": "10", "maxzoom": "12", "center": "104.5,2,10"})
+        store.close()
+        with sqlite3.connect(self.path) as connection:
+            metadata: dict = dict(connection.execute("SELECT name, value FROM metadata").fetchall())
+        self.assertEqual([float(v) for v in metadata["bounds"].split(",")], [100, 0, 106, 3])
+        self.assertEqual((metadata["minzoom"], metadata["maxzoom"]), ("5", "12"))
+        self.assertEqual([float(v) for v in metadata["center"].split(",")], [103, 1.5, 5])
+    def test_tile_layers(self) -> None:
+        tile: bytes = make_vector_tile({"water": ["class"], "place": ["name", "rank"]})
+        self.assertEqual(tilestore.get_tile_layers(tile), {"water": {"class"}, "place": {"name", "rank"}})
+        self.assertEqual(tilestore.get_tile_layers(gzip.compress(tile)), {"water": {"class"}, "place": {"name", "rank"}})
+        self.assertEqual(tilestore.get_tile_layers(tile[:-5]), {})
+        self.assertEqual(tilestore.get_tile_layers(b""), {})
+    def test_vector_layers(self) -> None:
+        store = tilestore.MBTilesTileStore(self.path, "pbf")
+        store.write(5, 0, 0, make_vector_tile({"water": ["class"]}))
+        store.write(7, 0, 0, make_vector_tile({"water": ["intermittent"], "place": ["name"]}))
+        store.close()
+        store = tilestore.MBTilesTileStore(self.path, "pbf") # a later run adds a zoom level and a layer
+        store.write(9, 0, 0, make_vector_tile({"poi": ["name"]}))
+        store.close()
+        with sqlite3.connect(self.path) as connection:
+            layers: list = json.loads(connection.execute("SELECT value FROM metadata WHERE name = 'json'").fetchone()[0])["vector_layers"]
+        self.assertEqual(layers, [
+            {"id": "place", "fields": {"name": ""}, "minzoom": 7, "maxzoom": 7},
+            {"id": "poi", "fields": {"name": ""}, "minzoom": 9, "maxzoom": 9},
+            {"id": "water", "fields": {"class": "", "intermittent": ""}, "minzoom": 5, "maxzoom": 7},
+        ])
+    def test_metadata_unreadable_replaced(self) -> None:
+        merged: dict = tilestore.merge_metadata({"bounds": "junk", "minzoom": "1", "maxzoom": "2"}, {"bounds": "1,2,3,4", "minzoom": "5", "maxzoom": "6"})
+        self.assertEqual((merged["bounds"], merged["minzoom"]), ("1,2,3,4", "5"))
+
+if __name__ == "__main__":
+    unittest.main()
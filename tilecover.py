@@ -0,0 +1,134 @@
+# tile coverage planning for tiledl.py:
+# - merge_ranges turns overlapping tile rectangles into one deduplicated, disjoint plan
+# - plan_from_region covers (multi)polygons from a GeoJSON file by walking the quadtree down from z0
+#   and pruning every subtree that does not touch the polygons
+import json
+from typing import Optional, Tuple, List, Dict
+from tilemath import TileBounds, TileRange, lnglat_to_tile_fraction
+
+# types, classes and data structures:
+type Ring = List[Tuple[float, float]] # closed ring of (lon, lat) or world (u, v) points
+type Polygon = List[Ring] # exterior ring followed by holes
+type Edge = Tuple[float, float, float, float] # (u1, v1, u2, v2) in world coordinates, the z0 tile is [0, 1] x [0, 1]
+
+def load_geojson(path: str) -> List[Polygon]:
+    try:
+        with open(path, "r") as f:
+            geojson = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Error reading region file {path}: {e}")
+        return []
+    polygons: List[Polygon] = []
+    pending = [geojson]
+    while pending: # flatten FeatureCollection / Feature / GeometryCollection down to polygons
+        obj = pending.pop()
+        kind: Optional[str] = obj.get("type") if isinstance(obj, dict) else None
+        if kind == "FeatureCollection":
+            pending.extend(obj.get("features", []))
+        elif kind == "Feature":
+            if obj.get("geometry") is not None:
+                pending.append(obj["geometry"])
+        elif kind == "GeometryCollection":
+            pending.extend(obj.get("geometries", []))
+        elif kind == "Polygon":
+            polygons.append([[(p[0], p[1]) for p in ring] for ring in obj["coordinates"]])
+        elif kind == "MultiPolygon":
+            polygons.extend([[(p[0], p[1]) for p in ring] for ring in polygon] for polygon in obj["coordinates"])
+        else:
+            print(f"Ignoring unsupported GeoJSON object of type {kind} in {path}.")
+    return polygons
+def get_polygons_bounds(polygons: List[Polygon]) -> TileBounds:
+    points: List[Tuple[float, float]] = [p for polygon in polygons for ring in polygon for p in ring]
+    return (min(p[0] for p in points), min(p[1] for p in points), max(p[0] for p in points), max(p[1] for p in points))
+def get_world_edges(polygons: List[Polygon]) -> List[Edge]:
+    edges: List[Edge] = []
+    for polygon in polygons:
+        for ring in polygon:
+            world: Ring = [lnglat_to_tile_fraction(lon, lat, 0) for lon, lat in ring]
+            if world and world[0] != world[-1]:
+                world.append(world[0]) # close the ring
+            edges.extend((u1, v1, u2, v2) for (u1, v1), (u2, v2) in zip(world, world[1:]) if (u1, v1) != (u2, v2))
+    return edges
+def edge_touches_box(edge: Edge, u0: float, v0: float, u1: float, v1: float) -> bool:
+    eu1, ev1, eu2, ev2 = edge
+    if max(eu1, eu2) < u0 or min(eu1, eu2) > u1 or max(ev1, ev2) < v0 or min(ev1, ev2) > v1:
+        return False
+    du, dv = eu2 - eu1, ev2 - ev1
+    sides = [du * (v - ev1) - dv * (u - eu1) for u, v in ((u0, v0), (u1, v0), (u0, v1), (u1, v1))]
+    return min(sides) <= 0 <= max(sides) # the box corners are not all on one side of the edge's line
+def point_in_edges(u: float, v: float, edges: List[Edge]) -> bool: # even-odd rule, so holes are handled too
+    inside: bool = False
+    for eu1, ev1, eu2, ev2 in edges:
+        if (ev1 > v) != (ev2 > v) and u < eu1 + (v - ev1) * (eu2 - eu1) / (ev2 - ev1):
+            inside = not inside
+    return inside
+def add_boundary_tile(ranges: List[TileRange], runs: Dict[Tuple[int, int, int], int], z: int, x: int, y: int) -> None:
+    # the quadtree walk visits the tiles of a row in increasing x and those of a column in increasing y, so a tile
+    # right after the last run of its row (or column) extends that run instead of adding a 1x1 range
+    i: Optional[int] = runs.get((z, 0, y)) # last run of the row
+    if i is not None and ranges[i].miny == ranges[i].maxy and ranges[i].maxx == x - 1:
+        ranges[i] = TileRange(zoom=z, minx=ranges[i].minx, miny=y, maxx=x, maxy=y)
+        return
+    j: Optional[int] = runs.get((z, 1, x)) # last run of the column
+    if j is not None and ranges[j].minx == ranges[j].maxx and ranges[j].maxy == y - 1:
+        ranges[j] = TileRange(zoom=z, minx=x, miny=ranges[j].miny, maxx=x, maxy=y)
+        return
+    runs[(z, 0, y)] = runs[(z, 1, x)] = len(ranges)
+    ranges.append(TileRange(zoom=z, minx=x, miny=y, maxx=x, maxy=y))
+def cover_node(all_edges: List[Edge], edges: List[Edge], z: int, x: int, y: int, min_zoom: int, max_zoom: int, ranges: List[TileRange],
+               runs: Dict[Tuple[int, int, int], int]) -> None: # runs: (zoom, 0, y) or (zoom, 1, x) -> index in ranges of the row's or column's last run
+    size: float = 1.0 / (1 << z)
+    u0, v0 = x * size, y * size
+    node_edges: List[Edge] = [e for e in edges if edge_touches_box(e, u0, v0, u0 + size, v0 + size)]
+    if not node_edges: # the tile is entirely inside or entirely outside
+        if point_in_edges(u0 + size / 2, v0 + size / 2, all_edges):
+            for zoom in range(max(z, min_zoom), max_zoom + 1): # every descendant is covered, no need to walk them
+                shift: int = zoom - z
+                ranges.append(TileRange(zoom=zoom, minx=x << shift, miny=y << shift, maxx=((x + 1) << shift) - 1, maxy=((y + 1) << shift) - 1))
+        return # outside: prune the whole subtree
+    if z >= min_zoom:
+        add_boundary_tile(ranges, runs, z, x, y)
+    if z < max_zoom:
+        for cx, cy in ((2 * x, 2 * y), (2 * x + 1, 2 * y), (2 * x, 2 * y + 1), (2 * x + 1, 2 * y + 1)):
+            cover_node(all_edges, node_edges, z + 1, cx, cy, min_zoom, max_zoom, ranges, runs)
+def merge_ranges(ranges: List[TileRange]) -> List[TileRange]: # union of possibly overlapping ranges as disjoint ranges
+    merged: List[TileRange] = []
+    by_zoom: Dict[int, List[TileRange]] = {}
+    for tile_range in ranges:
+        by_zoom.setdefault(tile_range.zoom, []).append(tile_range)
+    for zoom in sorted(by_zoom):
+        # sweep over x: between two consecutive events the set of covered y intervals is constant
+        events: Dict[int, List[Tuple[int, int]]] = {} # x -> (+1 start / -1 end, index of the range)
+        zoom_ranges: List[TileRange] = by_zoom[zoom]
+        for i, tile_range in enumerate(zoom_ranges):
+            events.setdefault(tile_range.minx, []).append((1, i))
+            events.setdefault(tile_range.maxx + 1, []).append((-1, i))
+        active: Dict[int, TileRange] = {}
+        open_runs: Dict[Tuple[int, int], int] = {} # (miny, maxy) -> first x of the run
+        for x in sorted(events):
+            for kind, i in events[x]:
+                if kind > 0:
+                    active[i] = zoom_ranges[i]
+                else:
+                    active.pop(i, None)
+            intervals: List[Tuple[int, int]] = []
+            for tile_range in sorted(active.values(), key=lambda r: r.miny):
+                if intervals and tile_range.miny <= intervals[-1][1] + 1:
+                    intervals[-1] = (intervals[-1][0], max(intervals[-1][1], tile_range.maxy))
+                else:
+                    intervals.append((tile_range.miny, tile_range.maxy))
+            current: set = set(intervals)
+            for interval in list(open_runs): # close runs whose interval stops here
+                if interval not in current:
+                    merged.append(TileRange(zoom=zoom, minx=open_runs.pop(interval), miny=interval[0], maxx=x - 1, maxy=interval[1]))
+            for interval in intervals:
+                open_runs.setdefault(interval, x)
+        # every range ends at some event, so no run is left open after the last one
+    return merged
+def plan_from_region(polygons: List[Polygon], min_zoom: int, max_zoom: int) -> List[TileRange]:
+    edges: List[Edge] = get_world_edges(polygons)
+    if not edges:
+        return []
+    ranges: List[TileRange] = []
+    cover_node(edges, edges, 0, 0, 0, min_zoom, max_zoom, ranges, {})
+    return merge_ranges(ranges)
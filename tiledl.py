@@ -1,18 +1,30 @@
 import requests
+import transport
+import journal
+import ratelimit
+import tilestore
+import tilecover
+import metrics
+import cacheindex
+import overviews
+import jobqueue
+from tilemath import TileBounds, TileRange, MIN_LON, MAX_LON, MIN_LAT, MAX_LAT, MAX_BOUNDS, ORDER_CHOICES, get_tile_range, iter_tile_coords
 import os
+import json
 import time
 import argparse
-import math
-from typing import Optional, Tuple, List
-from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from typing import Optional, Tuple, List, Dict, Iterator, Callable
+from dataclasses import dataclass, replace
 
 # types, classes and data structures:
-type TileBounds = Tuple[float, float, float, float] # (minlon, minlat, maxlon, maxlat)
 @dataclass(frozen=True, slots=True, kw_only=True)
 class TileOption:
     name: str
     ext: str
     aliases: List[str]
+    max_age: float # seconds after which --refresh revalidates a tile
+    mbtiles_type: str = "baselayer" # MBTiles metadata type, "overlay" for layers drawn on top of another map
 @dataclass(frozen=True, slots=True, kw_only=True)
 class LevelConfig:
     zoom: int
@@ -25,35 +37,53 @@ class TileDLArguments:
     zoom: int
     bounds: TileBounds
     config: str
+    retry_failed: bool
+    api_url: str
+    max_rate: float
+    rate_state: str
+    pool_size: int
+    keep_alive: bool
+    workers: int
+    format: str
+    order: str
+    region: str
+    min_zoom: int
+    max_zoom: int
+    progress_interval: Optional[float]
+    metrics_file: str
+    metrics_format: str
+    metrics_interval: float
+    refresh: bool
+    max_age: float # seconds, from --max-age or the tile option
+    build_overviews: bool
+    overview_workers: int
+    plan_queue: str # write the plan to this work queue instead of downloading
+    queue: str      # download batches claimed from this work queue
+    batch_size: int
 @dataclass(frozen=True, slots=True, kw_only=True)
 class BackoffConfig:
-    initial_wait: float = 1.0
-    max_wait: float = 60.0
-    min_wait: float = 1.0
-    fail_factor: float = 1.5
-    success_factor: float = 0.9
     max_retries: int = 5
     timeout: int = 5
 @dataclass(frozen=False, slots=True, kw_only=True)
 class GlobalVariables:
-    wait_sec: float = 1.0
+    rate: ratelimit.RateController # shared by all workers, so one throttled worker slows down the whole pool
+    stats: metrics.Metrics
+    reporter: metrics.Reporter
     downloaded_count: int = 0
     total_downloaded_count: int = 0
 
 # constants:
-MIN_LON: float = -179.99999999
-MAX_LON: float = 179.99999999
-MIN_LAT: float = -85.0511
-MAX_LAT: float = 85.0511
-MAX_BOUNDS: TileBounds = (MIN_LON, MIN_LAT, MAX_LON, MAX_LAT)
-URL_TEMPLATE: str = "https://api.maptiler.com/tiles/{t}/{z}/{x}/{y}.{e}?key={k}"
+DAY: float = 86400.0
+API_URL: str = "https://api.maptiler.com"
+URL_TEMPLATE: str = "{api}/tiles/{t}/{z}/{x}/{y}.{e}?key={k}"
 TILE_OPTIONS: List[TileOption] = [
-    TileOption(name="satellite-v2", ext="jpg", aliases=["satellite", "satellite-v2", "satellitev2", "sat"]),
-    TileOption(name="contours-v2", ext="pbf", aliases=["contours", "contours-v2", "contoursv2", "cnt"]),
-    TileOption(name="terrain-rgb-v2", ext="webp", aliases=["terrain", "terrainrgb", "terrain-rgb", "terrain-rgb-v2", "terrainrgbv2", "trgb"]),
-    TileOption(name="v3", ext="pbf", aliases=["v3", "v3tiles", "v3-tiles", "tilesv3", "tiles-v3"]),
-    TileOption(name="v4", ext="pbf", aliases=["v4", "v4tiles", "v4-tiles", "tilesv4", "tiles-v4"]),
-    TileOption(name="landform", ext="pbf", aliases=["landform", "lf", "landforms", "lfs"]),
+    # max_age: imagery and elevation change rarely, OpenStreetMap based vector tiles are rebuilt often
+    TileOption(name="satellite-v2", ext="jpg", aliases=["satellite", "satellite-v2", "satellitev2", "sat"], max_age=180 * DAY),
+    TileOption(name="contours-v2", ext="pbf", aliases=["contours", "contours-v2", "contoursv2", "cnt"], max_age=365 * DAY, mbtiles_type="overlay"),
+    TileOption(name="terrain-rgb-v2", ext="webp", aliases=["terrain", "terrainrgb", "terrain-rgb", "terrain-rgb-v2", "terrainrgbv2", "trgb"], max_age=365 * DAY),
+    TileOption(name="v3", ext="pbf", aliases=["v3", "v3tiles", "v3-tiles", "tilesv3", "tiles-v3"], max_age=30 * DAY),
+    TileOption(name="v4", ext="pbf", aliases=["v4", "v4tiles", "v4-tiles", "tilesv4", "tiles-v4"], max_age=7 * DAY),
+    TileOption(name="landform", ext="pbf", aliases=["landform", "lf", "landforms", "lfs"], max_age=365 * DAY, mbtiles_type="overlay"),
 ]
 TYPE_CHOICES: List[str] = [alias for option in TILE_OPTIONS for alias in option.aliases]
 
@@ -70,14 +100,101 @@ def parse_arguments() -> TileDLArguments:
     parser.add_argument("-b", "--bounds", type=float, nargs=4, metavar=("MINLON", "MINLAT", "MAXLON", "MAXLAT"), 
                         default=MAX_BOUNDS, help="Bounding box to download tiles")
     parser.add_argument("-c", "--config", type=str, default="", help="Path to configuration file")
+    parser.add_argument("--retry-failed", action="store_true", help="Only retry items that the resume journal recorded as failed")
+    parser.add_argument("--refresh", action="store_true", help="Revalidate downloaded tiles older than --max-age with conditional requests")
+    parser.add_argument("--max-age", type=float, default=None, help="Days after which --refresh revalidates a tile (default: depends on the tile type)")
+    parser.add_argument("--api-url", type=str, default=API_URL, help="Base URL of the tile API, e.g. a local mockserver.py for testing")
+    parser.add_argument("--max-rate", type=float, default=ratelimit.RateConfig().max_rate, help="Upper limit for the adaptive request rate (requests/s)")
+    parser.add_argument("--rate-state", type=str, default=ratelimit.DEFAULT_STATE_PATH, help="File where the last safe request rate is kept per API key")
+    parser.add_argument("--pool-size", type=int, default=10, help="Max kept-alive HTTP connections in the shared pool")
+    parser.add_argument("--no-keep-alive", action="store_true", help="Close the HTTP connection after every request")
+    parser.add_argument("--format", type=str, choices=tilestore.FORMAT_CHOICES, default="dir",
+                        help="Output format: 'dir' for {z}/{x}/{y}.{ext} files, 'mbtiles' for a single {type}.mbtiles file")
+    parser.add_argument("-r", "--region", type=str, default="", help="Path to a GeoJSON file with the (multi)polygon region to download")
+    parser.add_argument("--min-zoom", type=int, choices=range(0, 23), metavar="ZOOM", default=0, help="Lowest zoom level to download for --region")
+    parser.add_argument("--max-zoom", type=int, choices=range(0, 23), metavar="ZOOM", default=None, help="Highest zoom level to download for --region")
+    parser.add_argument("--order", type=str, choices=ORDER_CHOICES, default="column",
+                        help="Tile request order within a zoom level: 'column' (x by x), or space-filling 'hilbert' / 'zorder'")
+    parser.add_argument("--build-overviews", action="store_true",
+                        help="Raster types only: build tiles from their four downloaded children instead of downloading them")
+    parser.add_argument("--overview-workers", type=int, default=os.cpu_count() or 1, help="Number of processes building overview tiles")
+    parser.add_argument("--plan-queue", type=str, default="", metavar="QUEUE",
+                        help="Write the tile plan as batches into this work queue file for --queue workers, instead of downloading")
+    parser.add_argument("--queue", type=str, default="", help="Download batches claimed from this work queue file (written by --plan-queue)")
+    parser.add_argument("--batch-size", type=int, default=jobqueue.BATCH_SIZE, help="Tiles per work queue batch for --plan-queue")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="Number of concurrent download workers")
+    parser.add_argument("--progress-interval", type=float, default=None,
+                        help=f"Seconds between progress updates (default: {metrics.TTY_REFRESH:g} on a terminal, {metrics.LOG_REFRESH:g} otherwise)")
+    parser.add_argument("--metrics-file", type=str, default="", help="File to export run metrics to")
+    parser.add_argument("--metrics-format", type=str, choices=metrics.METRICS_FORMAT_CHOICES, default="jsonl",
+                        help="Metrics file format: 'jsonl' appends a JSON snapshot per interval, 'prometheus' rewrites a text exposition file")
+    parser.add_argument("--metrics-interval", type=float, default=metrics.METRICS_INTERVAL, help="Seconds between metrics exports")
     args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.region != "" and args.max_zoom is None:
+        parser.error("--region requires --max-zoom")
+    if args.max_zoom is not None and args.max_zoom < args.min_zoom:
+        parser.error("--max-zoom must not be lower than --min-zoom")
+    if args.progress_interval is not None and args.progress_interval <= 0:
+        parser.error("--progress-interval must be positive")
+    if args.refresh and args.retry_failed:
+        parser.error("--refresh and --retry-failed cannot be combined")
+    if args.plan_queue != "" and args.queue != "":
+        parser.error("--plan-queue and --queue cannot be combined")
+    if args.queue != "" and (args.refresh or args.retry_failed or args.build_overviews):
+        parser.error("--queue cannot be combined with --refresh, --retry-failed or --build-overviews, run them on the merged output")
+    if args.batch_size < 1:
+        parser.error("--batch-size must be at least 1")
+    option: TileOption = next((option for option in TILE_OPTIONS if args.type in option.aliases), TILE_OPTIONS[0])
+    if args.queue != "": # the tile type was chosen when the queue was planned
+        if not os.path.exists(args.queue):
+            parser.error(f"work queue {args.queue} does not exist")
+        work_queue: jobqueue.WorkQueue = jobqueue.WorkQueue(args.queue)
+        queue_type: Optional[str] = work_queue.meta().get("type")
+        work_queue.close()
+        option = next((option for option in TILE_OPTIONS if option.name == queue_type), None)
+        if option is None:
+            parser.error(f"work queue {args.queue} has no plan yet")
+    if args.build_overviews:
+        if option.ext not in overviews.RASTER_EXTS:
+            parser.error(f"--build-overviews only works for raster tile types, not {option.name}")
+        if args.overview_workers < 1:
+            parser.error("--overview-workers must be at least 1")
+        try:
+            overviews.require_imaging(overviews.is_terrain(option.name))
+        except ImportError as e:
+            parser.error(str(e))
     return TileDLArguments(
         key=args.key,
         dir=args.dir,
-        option=next((option for option in TILE_OPTIONS if args.type in option.aliases), TILE_OPTIONS[0]),
+        option=option,
         zoom=args.zoom,
         bounds=tuple(args.bounds),
-        config=args.config
+        config=args.config,
+        retry_failed=args.retry_failed,
+        api_url=args.api_url.rstrip("/"),
+        max_rate=args.max_rate,
+        rate_state=args.rate_state,
+        pool_size=args.pool_size,
+        keep_alive=not args.no_keep_alive,
+        workers=args.workers,
+        format=args.format,
+        order=args.order,
+        region=args.region,
+        min_zoom=args.min_zoom,
+        max_zoom=args.max_zoom if args.max_zoom is not None else args.min_zoom,
+        progress_interval=args.progress_interval,
+        metrics_file=args.metrics_file,
+        metrics_format=args.metrics_format,
+        metrics_interval=args.metrics_interval,
+        refresh=args.refresh,
+        max_age=args.max_age * DAY if args.max_age is not None else option.max_age,
+        build_overviews=args.build_overviews,
+        overview_workers=args.overview_workers,
+        plan_queue=args.plan_queue,
+        queue=args.queue,
+        batch_size=args.batch_size
     )
 def load_config(path: str) -> List[LevelConfig]:
     file_content: str # file content is a csv with headers: zoom,minlon,minlat,maxlon,maxlat
@@ -113,111 +230,247 @@ def load_config(path: str) -> List[LevelConfig]:
             print(f"Error parsing line in configuration file: {line}. Error: {e}")
             continue
     return level_configs
-def get_response_dynamic_backoff(gvar: GlobalVariables, bcfg: BackoffConfig, url: str) -> Optional[requests.Response]:
-    for _ in range(bcfg.max_retries):
+def get_response_dynamic_backoff(gvar: GlobalVariables, bcfg: BackoffConfig, url: str, write_body: Callable[[transport.BodyStream], None], headers: Optional[Dict[str, str]] = None) -> Optional[requests.Response]:
+    # pacing between requests and after failures is left to the shared rate controller, there is no fixed sleep;
+    # failed attempts are counted in the metrics, only the final failure is logged.
+    # a 200 body is streamed into write_body within the attempt, so a truncated or invalid body is retried like any other failure
+    last_error: str = ""
+    for attempt in range(bcfg.max_retries):
+        retried: bool = attempt < bcfg.max_retries - 1
+        gvar.rate.acquire()
+        start: float = time.perf_counter()
+        response: Optional[requests.Response] = None
+        body: Optional[transport.BodyStream] = None
         try:
-            response = requests.get(url, timeout=bcfg.timeout)
-            if response.status_code == 200:
-                gvar.wait_sec = max(bcfg.min_wait, gvar.wait_sec * bcfg.success_factor)  # decrease wait time on success
-                return response
-            elif response.status_code == 204:
-                print(f"\n\tNo content (204), skipping this tile.")
-                return None
-            else:
-                print(f"\n\tError {response.status_code}.")
-                print(f"\tRetrying in {gvar.wait_sec:.2f} seconds... ", end="", flush=True)
+            response = transport.get(url, timeout=bcfg.timeout, stream=True, headers=headers)
+            with response:
+                if response.status_code == 200:
+                    body = transport.BodyStream(response)
+                    write_body(body)
+                else:
+                    response.content # small error bodies are read, so the connection goes back to the pool
         except requests.Timeout:
-            print(f"\n\tRequest timed out after {bcfg.timeout} seconds.")
-            print(f"\tRetrying in {gvar.wait_sec:.2f} seconds... ", end="", flush=True)
-        except requests.RequestException as e:
-            print(f"\n\t{e}.")
-            print(f"\tRetrying in {gvar.wait_sec:.2f} seconds... ", end="", flush=True)
-        time.sleep(gvar.wait_sec)
-        gvar.wait_sec = min(bcfg.max_wait, gvar.wait_sec * bcfg.fail_factor)  # increase wait time on failure
-    print("\n\tMax retries reached.")
+            gvar.rate.release(timed_out=True)
+            gvar.stats.observe_request("timeout", time.perf_counter() - start, retried=retried)
+            last_error = f"timed out after {bcfg.timeout} seconds"
+            continue
+        except (requests.RequestException, tilestore.InvalidTile) as e: # includes connections lost mid-body and incomplete bodies
+            gvar.rate.release()
+            gvar.stats.observe_request("error", time.perf_counter() - start, body.size if body is not None else 0, retried=retried)
+            last_error = str(e)
+            continue
+        except BaseException: # e.g. the disk is full, not the server's fault
+            gvar.rate.release(response.status_code if response is not None else None, response.headers if response is not None else None)
+            raise
+        gvar.rate.release(response.status_code, response.headers)
+        success: bool = response.status_code in (200, 204, 304) # 204: no content, the caller records it as empty; 304: not modified
+        gvar.stats.observe_request(str(response.status_code), time.perf_counter() - start, body.size if body is not None else 0, retried=retried and not success and ratelimit.is_congestion(response.status_code))
+        if success:
+            return response
+        last_error = f"error {response.status_code}"
+        if not ratelimit.is_congestion(response.status_code): # e.g. 403 or 404, retrying would get the same answer
+            gvar.reporter.log(f"\tFailed {url.split('?')[0]}: {last_error}.")
+            return None
+    gvar.reporter.log(f"\tMax retries reached for {url.split('?')[0]}: {last_error}.")
     return None
-def lnglat_to_tile_coords(lng: float, lat: float, z: int) -> Tuple[int, int]:
-    if z == 0:
-        return 0, 0
-    n = 2.0 ** z
-    deg2rad = math.pi / 180.0
-    lon = max(-179.99999999, min(179.99999999, lng)) # prevent overflow
-    lon_n = lon / 360.0 + 0.5
-    lat = max(-85.0511, min(85.0511, lat)) # prevent overflow
-    lat_rad = lat * deg2rad
-    tan_lat = math.tan(lat_rad)
-    sec_lat = 1 / math.cos(lat_rad)
-    lat_n = (1 - math.log(tan_lat + sec_lat) / math.pi) / 2.0
-    x = int(n * lon_n)
-    y = int(n * lat_n)
-    return x, y
-def get_tile_coords_list(bounds: TileBounds, zoom: int) -> List[Tuple[int, int]]:
-    minlon, minlat, maxlon, maxlat = bounds
-    tile_side_count: int = 2 ** zoom
-    if bounds == MAX_BOUNDS:
-        return [(x, y) for x in range(tile_side_count) for y in range(tile_side_count)]
-    else:
-        x1, y1 = lnglat_to_tile_coords(minlon, minlat, zoom)
-        x2, y2 = lnglat_to_tile_coords(maxlon, maxlat, zoom)
-        minx, miny = min(x1, x2), min(y1, y2)
-        maxx, maxy = max(x1, x2), max(y1, y2)
-        if minx < 0 or miny < 0 or maxx >= tile_side_count or maxy >= tile_side_count:
-            print("Coordinates are out of bounds.")
-            return []
-        print(f"Tile coordinates: ({minx}, {miny}) to ({maxx}, {maxy})")
-        return [(x, y) for x in range(minx, maxx + 1) for y in range(miny, maxy + 1)]
-def download_one_tile(gvar: GlobalVariables, args: TileDLArguments, bcfg: BackoffConfig, x: int, y: int) -> int:
-    tile_dir: str = os.path.join(args.dir, str(args.zoom), str(x))
-    tile_path: str = os.path.join(tile_dir, f"{y}.{args.option.ext}")
-    if os.path.exists(tile_path):
+def get_mbtiles_metadata(option: TileOption, level_configs: List[LevelConfig]) -> Dict[str, str]:
+    minlon: float = max(MIN_LON, min(level.bounds[0] for level in level_configs))
+    minlat: float = max(MIN_LAT, min(level.bounds[1] for level in level_configs))
+    maxlon: float = min(MAX_LON, max(level.bounds[2] for level in level_configs))
+    maxlat: float = min(MAX_LAT, max(level.bounds[3] for level in level_configs))
+    minzoom: int = min(level.zoom for level in level_configs)
+    maxzoom: int = max(level.zoom for level in level_configs)
+    return {
+        "name": option.name,
+        "format": option.ext,
+        "type": option.mbtiles_type,
+        "bounds": f"{minlon},{minlat},{maxlon},{maxlat}",
+        "center": f"{(minlon + maxlon) / 2},{(minlat + maxlat) / 2},{minzoom}",
+        "minzoom": str(minzoom),
+        "maxzoom": str(maxzoom),
+        "attribution": "&copy; MapTiler &copy; OpenStreetMap contributors",
+    }
+def download_one_tile(gvar: GlobalVariables, args: TileDLArguments, bcfg: BackoffConfig, store: tilestore.DirectoryTileStore | tilestore.MBTilesTileStore, job_journal: journal.Journal, cache_index: cacheindex.CacheIndex, x: int, y: int) -> int:
+    group: str = str(args.zoom)
+    key: int = journal.tile_key(args.zoom, x, y)
+    status: Optional[str] = job_journal.status(group, key)
+    headers: Dict[str, str] = {}
+    validators: Optional[cacheindex.Validators] = None
+    if args.refresh and status in (journal.DONE, journal.EMPTY):
+        present: bool = status == journal.DONE and store.exists(args.zoom, x, y) # the file or row may have been removed since
+        validators = cache_index.get(args.zoom, x, y)
+        if validators is not None and time.time() - validators.checked < args.max_age and (present or status == journal.EMPTY):
+            return 0 # checked recently enough, will skip revalidating
+        if present: # empty and missing tiles have nothing to compare against, a 304 would leave them missing
+            headers = cacheindex.conditional_headers(validators, store.modified_time(args.zoom, x, y))
+    elif args.retry_failed:
+        if status != journal.FAILED:
+            return 0 # only tiles that failed in an earlier run are retried
+    elif status is not None:
+        return 0 # tile finished in an earlier run (downloaded, empty or failed), will skip downloading
+    elif store.exists(args.zoom, x, y):
+        job_journal.record(journal.DONE, group, key) # tile written before the journal existed
         return 0 # tile already exists, will skip downloading
-    url: str = URL_TEMPLATE.format(t=args.option.name, z=args.zoom, x=x, y=y, e=args.option.ext, k=args.key)
-    response: Optional[requests.Response] = get_response_dynamic_backoff(gvar, bcfg, url)
-    if response is not None:
-        os.makedirs(tile_dir, exist_ok=True)
-        with open(tile_path, "wb") as f:
-            f.write(response.content)
-        return response.status_code # return status code in case of success
-    return -1 # failed to download after retries, tile not downloaded
-def download_tiles(gvar: GlobalVariables, args: TileDLArguments, bcfg: BackoffConfig) -> None:
-    tile_coords: List[Tuple[int, int]] = get_tile_coords_list(args.bounds, args.zoom)
-    len_tiles = len(tile_coords) # number of tiles to download
+    url: str = URL_TEMPLATE.format(api=args.api_url, t=args.option.name, z=args.zoom, x=x, y=y, e=args.option.ext, k=args.key)
+    response: Optional[requests.Response] = get_response_dynamic_backoff(gvar, bcfg, url, lambda body: store.write_stream(args.zoom, x, y, body), headers)
+    if response is None:
+        if status is None or status == journal.FAILED:
+            job_journal.record(journal.FAILED, group, key)
+        return -1 # failed to download after retries, tile not downloaded (a refreshed tile keeps its old copy)
+    if response.status_code == 304: # upserted, so tiles without a row (older than the index, built locally) get a checked time too
+        cache_index.put(args.zoom, x, y, response.headers.get("ETag") or (validators.etag if validators is not None else None),
+                        response.headers.get("Last-Modified") or (validators.last_modified if validators is not None else None))
+        return response.status_code # not modified, no body and nothing to write
+    cache_index.put(args.zoom, x, y, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+    if response.status_code == 204:
+        if status == journal.DONE:
+            store.delete(args.zoom, x, y) # the tile was removed upstream
+        job_journal.record(journal.EMPTY, group, key)
+        return response.status_code # no content, nothing to write
+    if status != journal.DONE:
+        job_journal.record(journal.DONE, group, key) # the tile was written (and checked) while streaming
+    return response.status_code # return status code in case of success
+def get_tile_plan(level_configs: List[LevelConfig]) -> List[TileRange]:
+    tile_ranges: List[TileRange] = []
+    for level in level_configs:
+        tile_range: Optional[TileRange] = get_tile_range(level.bounds, level.zoom)
+        if tile_range is None:
+            print(f"Skipping zoom level {level.zoom} with bounds {level.bounds}.")
+            continue
+        tile_ranges.append(tile_range)
+    return tilecover.merge_ranges(tile_ranges) # rows that overlap are downloaded once
+def iter_plan_jobs(args: TileDLArguments, tile_plan: List[TileRange]) -> Iterator[Tuple[TileDLArguments, int, int]]:
+    for tile_range in tile_plan: # tiles are generated lazily, no level is ever materialized
+        range_arguments: TileDLArguments = replace(args, zoom=tile_range.zoom)
+        for x, y in iter_tile_coords(tile_range, args.order):
+            yield range_arguments, x, y
+def download_tiles(gvar: GlobalVariables, args: TileDLArguments, bcfg: BackoffConfig, store: tilestore.DirectoryTileStore | tilestore.MBTilesTileStore, job_journal: journal.Journal, cache_index: cacheindex.CacheIndex, tile_plan: List[TileRange], abandoned: Optional[Callable[[], bool]] = None) -> None:
+    # abandoned: checked between tiles, True stops submitting tiles (in-flight ones finish), e.g. when a work queue lease was lost
+    len_tiles: int = sum(tile_range.count for tile_range in tile_plan) # number of tiles to download, computed from the spans
     if len_tiles == 0:
         print("No tiles to download.")
         return
-    len_digits = len(str(len_tiles)) # number of digits in the number of tiles
-    side_digits = len(str(2 ** args.zoom)) # number of digits in the side count
-    print(f"Downloading {len_tiles} tiles for zoom level {args.zoom}...")
-    for i, (x, y) in enumerate(tile_coords):
-        tile_progress = f"{i + 1:>{len_digits}}/{len_tiles:>{len_digits}}"
-        tile_coords_progress = f"({x:>{side_digits}}, {y:>{side_digits}})"
-        print(f"\033[2K\tDownloading {tile_progress}: {tile_coords_progress}... ", end="", flush=True)
-        status_code = download_one_tile(gvar, args, bcfg, x, y)
-        if status_code == 0: # tile already exists, skip it
-            print(f"SKP", end="\r")
-            continue
-        elif status_code == 200: # tile downloaded successfully
-            gvar.downloaded_count += 1
-            print(f"OK ", end="\r")
-        else: # error message and a new line
-            print(f"\r\tError downloading tile {args.zoom:>2}/{x:>{side_digits}}/{y:>{side_digits}}: {status_code}{' ':>{side_digits}}")
-        time.sleep(gvar.wait_sec) # wait before next request
-    print(f"\n\t...{gvar.downloaded_count} new tiles downloaded.")
+    for zoom in sorted({tile_range.zoom for tile_range in tile_plan}):
+        print(f"\tZoom level {zoom:>2}: {sum(r.count for r in tile_plan if r.zoom == zoom)} tiles.")
+    print(f"Downloading {len_tiles} tiles...")
+    gvar.stats.add_planned(len_tiles)
+    gvar.reporter.start() # progress is rendered by the reporter thread at a fixed refresh rate, not per tile
+    jobs: Iterator[Tuple[TileDLArguments, int, int]] = iter_plan_jobs(args, tile_plan)
+    pending: Dict[Future, Tuple[TileDLArguments, int, int]] = {}
+    max_pending: int = args.workers * 2 # keep the pool busy without materializing every job up front
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        try:
+            while True:
+                while len(pending) < max_pending and not (abandoned is not None and abandoned()):
+                    job: Optional[Tuple[TileDLArguments, int, int]] = next(jobs, None)
+                    if job is None:
+                        break
+                    job_args, x, y = job
+                    pending[pool.submit(download_one_tile, gvar, job_args, bcfg, store, job_journal, cache_index, x, y)] = job
+                if not pending:
+                    break
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done: # tiles may finish out of order, so progress counts completions
+                    job_args, x, y = pending.pop(future)
+                    try:
+                        status_code: int = future.result()
+                    except OSError as e:
+                        gvar.reporter.log(f"\t{e}.")
+                        status_code = -1
+                    if status_code == 0: # tile already exists, skip it
+                        gvar.stats.observe_item("skipped")
+                    elif status_code == 200: # tile downloaded successfully
+                        gvar.downloaded_count += 1
+                        gvar.stats.observe_item("ok")
+                    elif status_code == 204: # no content, recorded as empty
+                        gvar.stats.observe_item("empty")
+                    elif status_code == 304: # revalidated, not modified
+                        gvar.stats.observe_item("unchanged")
+                    else: # error message on its own line
+                        gvar.stats.observe_item("failed")
+                        gvar.reporter.log(f"\tError downloading tile {job_args.zoom}/{x}/{y}: {status_code}")
+        except KeyboardInterrupt:
+            pool.shutdown(wait=False, cancel_futures=True) # drop queued tiles, let in-flight ones finish
+            raise
+        finally:
+            gvar.reporter.stop() # final progress line and metrics snapshot
+    print(f"\t...{gvar.downloaded_count} new tiles downloaded.")
     gvar.total_downloaded_count += gvar.downloaded_count
-    gvar.downloaded_count = 0 # reset for next level
+    gvar.downloaded_count = 0
+def build_and_download_tiles(gvar: GlobalVariables, args: TileDLArguments, bcfg: BackoffConfig, store: tilestore.DirectoryTileStore | tilestore.MBTilesTileStore, job_journal: journal.Journal, cache_index: cacheindex.CacheIndex, tile_plan: List[TileRange]) -> None:
+    # deepest level first, so every level can be built from the level downloaded (or built) just before it;
+    # only the tiles with a missing child are downloaded
+    terrain: bool = overviews.is_terrain(args.option.name)
+    for zoom in sorted({tile_range.zoom for tile_range in tile_plan}, reverse=True):
+        level_plan: List[TileRange] = [tile_range for tile_range in tile_plan if tile_range.zoom == zoom]
+        start: float = time.monotonic()
+        built, undecodable = overviews.build_overviews(store, job_journal, level_plan, args.option.ext, terrain, args.overview_workers, args.order)
+        if built or undecodable:
+            print(f"Zoom level {zoom:>2}: built {built} tiles from their children in {time.monotonic() - start:.1f} s"
+                  + (f", {undecodable} with undecodable children will be downloaded." if undecodable else "."))
+        download_tiles(gvar, args, bcfg, store, job_journal, cache_index, level_plan)
+def download_queue_batches(gvar: GlobalVariables, args: TileDLArguments, bcfg: BackoffConfig, store: tilestore.DirectoryTileStore | tilestore.MBTilesTileStore, job_journal: journal.Journal, cache_index: cacheindex.CacheIndex, work_queue: jobqueue.WorkQueue) -> None:
+    # claims batches until none are left; a batch is reported done only once its tiles and journal records are on disk
+    worker: jobqueue.WorkerOutput = jobqueue.WorkerOutput(id=jobqueue.make_worker_id(), dir=args.dir, format=args.format)
+    work_queue.register(worker, ratelimit.key_id(args.key))
+    print(f"Registered as worker {worker.id}.")
+    while True:
+        batch: Optional[jobqueue.Batch] = work_queue.claim(worker.id)
+        if batch is None:
+            print("No batches left in the work queue.")
+            return
+        tile_range: TileRange = batch.tile_range
+        print(f"Batch {batch.id}: zoom {tile_range.zoom}, x {tile_range.minx}-{tile_range.maxx}, y {tile_range.miny}-{tile_range.maxy}.")
+        before: Dict[str, int] = gvar.stats.snapshot()["items"]
+        try:
+            with jobqueue.LeaseRenewer(work_queue, worker.id, batch.id) as lease:
+                download_tiles(gvar, args, bcfg, store, job_journal, cache_index, [tile_range], abandoned=lambda: lease.lost)
+                store.flush()
+                job_journal.flush()
+        except BaseException:
+            work_queue.release(worker.id, batch.id) # back to pending for the next worker
+            raise
+        if lease.lost: # another worker claimed the batch after our lease expired, it is theirs to finish
+            print(f"\tLost the lease on batch {batch.id}, abandoned it to the worker that took it over.")
+            continue
+        after: Dict[str, int] = gvar.stats.snapshot()["items"]
+        items: Dict[str, int] = {outcome: after[outcome] - before[outcome] for outcome in after}
+        if not work_queue.complete(worker.id, batch.id, items["ok"] + items["skipped"], items["empty"], items["failed"]):
+            print(f"\tLost the lease on batch {batch.id} while finishing it, another worker took it over.")
 
 if __name__ == "__main__":
     args: TileDLArguments = parse_arguments()
-    if not os.path.exists(args.dir):
+    if args.plan_queue == "" and not os.path.exists(args.dir):
         print(f"Directory {args.dir} does not exist. Creating it...")
         os.makedirs(args.dir)
-    if not os.access(args.dir, os.W_OK):
+    if args.plan_queue == "" and not os.access(args.dir, os.W_OK):
         print(f"Directory {args.dir} is not writable. Exiting.")
         exit(1)
     level_configs: List[LevelConfig] = []
+    tile_plan: List[TileRange] = []
     bcfg: BackoffConfig = BackoffConfig()
-    gvars: GlobalVariables = GlobalVariables()
-    if args.config != "":
+    transport.configure(transport.TransportConfig(pool_size=max(args.pool_size, args.workers), keep_alive=args.keep_alive))
+    rate_config: ratelimit.RateConfig = ratelimit.RateConfig(max_rate=args.max_rate, max_concurrency=args.workers)
+    rate_controller: ratelimit.RateController = ratelimit.load_controller(args.rate_state, args.key, rate_config)
+    run_metrics: metrics.Metrics = metrics.Metrics("tiledl", rate=rate_controller)
+    reporter: metrics.Reporter = metrics.Reporter(run_metrics, refresh=args.progress_interval, metrics_path=args.metrics_file,
+                                                  metrics_format=args.metrics_format, metrics_interval=args.metrics_interval)
+    gvars: GlobalVariables = GlobalVariables(rate=rate_controller, stats=run_metrics, reporter=reporter)
+    print(f"Starting at {gvars.rate.rate:.2f} requests/s with up to {gvars.rate.concurrency} concurrent requests.")
+    if args.region != "":
+        if not os.path.exists(args.region):
+            print(f"Region file {args.region} does not exist. Exiting.")
+            exit(1)
+        print(f"Region file {args.region} is provided. Computing its coverage for zoom levels {args.min_zoom} to {args.max_zoom}...")
+        polygons: List[tilecover.Polygon] = tilecover.load_geojson(args.region)
+        if not polygons:
+            print("No polygons found in the region file. Exiting.")
+            exit(1)
+        region_bounds: TileBounds = tilecover.get_polygons_bounds(polygons)
+        level_configs = [LevelConfig(zoom=zoom, bounds=region_bounds) for zoom in range(args.min_zoom, args.max_zoom + 1)]
+        tile_plan = tilecover.plan_from_region(polygons, args.min_zoom, args.max_zoom)
+        print(f"Loaded {len(polygons)} polygons from {args.region}.")
+    elif args.config != "":
         if not os.path.exists(args.config):
             print(f"Configuration file {args.config} does not exist. Exiting.")
             exit(1)
@@ -232,20 +485,52 @@ if __name__ == "__main__":
         print(f"Loaded {len(level_configs)} level configurations from {args.config}.")
     else:
         level_configs = [LevelConfig(zoom=args.zoom, bounds=args.bounds)]
-    for level in level_configs:
-        current_arguments: TileDLArguments = TileDLArguments(
-            key=args.key,
-            dir=args.dir,
-            option=args.option,
-            zoom=level.zoom,
-            bounds=level.bounds,
-            config=args.config
-        )
-        print(f"Processing zoom level {level.zoom} with bounds {level.bounds}...")
+    if args.region == "":
+        tile_plan = get_tile_plan(level_configs)
+    if args.plan_queue != "":
+        plan_queue: jobqueue.WorkQueue = jobqueue.WorkQueue(args.plan_queue)
+        queue_meta: Dict[str, str] = {"type": args.option.name, "ext": args.option.ext, "created": str(time.time()),
+                                      "mbtiles_metadata": json.dumps(get_mbtiles_metadata(args.option, level_configs))}
         try:
-            download_tiles(gvars, current_arguments, bcfg)
-        except KeyboardInterrupt:
-            print(f"\n\t...{gvars.downloaded_count} new tiles downloaded.\nInterrupted by user.")
-            gvars.total_downloaded_count += gvars.downloaded_count
-            break
-    print(f"Done. Total new tiles downloaded: {gvars.total_downloaded_count}.")
\ No newline at end of file
+            batch_count: int = plan_queue.plan(tile_plan, queue_meta, args.batch_size)
+        except ValueError as e:
+            print(f"{e}. Exiting.")
+            exit(1)
+        finally:
+            plan_queue.close()
+        print(f"Planned {sum(tile_range.count for tile_range in tile_plan)} tiles as {batch_count} batches in {args.plan_queue}.")
+        print(f"Start workers with: python3 tiledl.py -k <API_KEY> -d <dir> --queue {args.plan_queue} -w <workers>")
+        exit(0)
+    journal_path: str = os.path.join(args.dir, f".{args.option.name}.journal")
+    flush_every: Optional[int] = None if args.format == "mbtiles" else journal.FLUSH_EVERY # mbtiles: flush only once the tiles are committed
+    job_journal: journal.Journal = journal.Journal(journal_path, flush_every=flush_every)
+    print(f"Resume journal {journal_path}: {job_journal.count(journal.DONE)} done, {job_journal.count(journal.EMPTY)} empty, {job_journal.count(journal.FAILED)} failed.")
+    store: tilestore.DirectoryTileStore | tilestore.MBTilesTileStore = tilestore.open_tile_store(args.format, args.dir, args.option.name, args.option.ext, on_commit=job_journal.flush)
+    work_queue: Optional[jobqueue.WorkQueue] = jobqueue.WorkQueue(args.queue) if args.queue != "" else None
+    if work_queue is not None: # the metadata of the whole plan, not of this worker's default -z / -b
+        store.set_metadata(json.loads(work_queue.meta()["mbtiles_metadata"]))
+    else:
+        store.set_metadata(get_mbtiles_metadata(args.option, level_configs))
+    cache_index: cacheindex.CacheIndex = cacheindex.CacheIndex(os.path.join(args.dir, f".{args.option.name}.validators"))
+    if args.refresh:
+        print(f"Refreshing tiles last checked more than {args.max_age / DAY:g} days ago.")
+    print(f"Downloading with {args.workers} worker(s)...")
+    try:
+        if work_queue is not None:
+            download_queue_batches(gvars, args, bcfg, store, job_journal, cache_index, work_queue)
+        elif args.build_overviews:
+            build_and_download_tiles(gvars, args, bcfg, store, job_journal, cache_index, tile_plan)
+        else:
+            download_tiles(gvars, args, bcfg, store, job_journal, cache_index, tile_plan) # one pool serves all levels, so no level waits for the previous one to drain
+    except KeyboardInterrupt:
+        print(f"\t...{gvars.downloaded_count} new tiles downloaded.\nInterrupted by user.")
+        gvars.total_downloaded_count += gvars.downloaded_count
+    finally:
+        store.close() # commits the last MBTiles batch
+        job_journal.close()
+        cache_index.close()
+        if work_queue is not None:
+            work_queue.close()
+        ratelimit.save_controller(args.rate_state, args.key, gvars.rate) # the next run starts at the last known safe rate
+    print(f"Done. Total new tiles downloaded: {gvars.total_downloaded_count}.")
+    print(f"HTTP: {transport.format_stats()}")
\ No newline at end of file
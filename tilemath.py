@@ -0,0 +1,149 @@
+# web mercator tile math shared by the tile tools:
+# lon/lat -> tile coordinates, tile ranges and lazy tile enumeration in different orders,
+# plus NumPy versions of the coordinate math for bulk (array) conversions
+import math
+from typing import Optional, Tuple, List, Iterator
+from dataclasses import dataclass
+try:
+    import numpy as np
+except ImportError: # numpy is only needed for the *_np functions
+    np = None
+
+# types, classes and data structures:
+type TileBounds = Tuple[float, float, float, float] # (minlon, minlat, maxlon, maxlat)
+@dataclass(frozen=True, slots=True, kw_only=True)
+class TileRange: # inclusive rectangle of tiles at one zoom level
+    zoom: int
+    minx: int
+    miny: int
+    maxx: int
+    maxy: int
+    @property
+    def count(self) -> int:
+        return (self.maxx - self.minx + 1) * (self.maxy - self.miny + 1)
+
+# constants:
+MIN_LON: float = -179.99999999
+MAX_LON: float = 179.99999999
+MIN_LAT: float = -85.0511
+MAX_LAT: float = 85.0511
+MAX_BOUNDS: TileBounds = (MIN_LON, MIN_LAT, MAX_LON, MAX_LAT)
+ORDER_CHOICES: List[str] = ["column", "hilbert", "zorder"] # column: x by x, top to bottom within each column
+
+def lnglat_to_tile_coords(lng: float, lat: float, z: int) -> Tuple[int, int]:
+    if z == 0:
+        return 0, 0
+    n = 2.0 ** z
+    deg2rad = math.pi / 180.0
+    lon = max(MIN_LON, min(MAX_LON, lng)) # prevent overflow
+    lon_n = lon / 360.0 + 0.5
+    lat = max(MIN_LAT, min(MAX_LAT, lat)) # prevent overflow
+    lat_rad = lat * deg2rad
+    tan_lat = math.tan(lat_rad)
+    sec_lat = 1 / math.cos(lat_rad)
+    lat_n = (1 - math.log(tan_lat + sec_lat) / math.pi) / 2.0
+    x = int(n * lon_n)
+    y = int(n * lat_n)
+    return x, y
+def lnglat_to_tile_fraction(lng: float, lat: float, z: int) -> Tuple[float, float]: # like lnglat_to_tile_coords, without truncating
+    n = 2.0 ** z
+    lon = max(MIN_LON, min(MAX_LON, lng)) # prevent overflow
+    lat_rad = math.radians(max(MIN_LAT, min(MAX_LAT, lat))) # prevent overflow
+    lat_n = (1 - math.log(math.tan(lat_rad) + 1 / math.cos(lat_rad)) / math.pi) / 2.0
+    return n * (lon / 360.0 + 0.5), n * lat_n
+def require_numpy() -> None:
+    if np is None:
+        raise ImportError("numpy is required for vectorized tile math, install it with 'pip install numpy'")
+def lnglat_to_tile_coords_np(lng, lat, z: int) -> Tuple["np.ndarray", "np.ndarray"]:
+    # same operations in the same order as lnglat_to_tile_coords, applied to whole arrays
+    require_numpy()
+    lng, lat = np.broadcast_arrays(np.asarray(lng, dtype=np.float64), np.asarray(lat, dtype=np.float64))
+    if z == 0:
+        return np.zeros(lng.shape, dtype=np.int64), np.zeros(lat.shape, dtype=np.int64)
+    n = 2.0 ** z
+    deg2rad = math.pi / 180.0
+    lon_n = np.clip(lng, MIN_LON, MAX_LON) / 360.0 + 0.5 # prevent overflow
+    lat_c = np.clip(lat, MIN_LAT, MAX_LAT) # prevent overflow
+    lat_rad = lat_c * deg2rad
+    lat_n = (1 - np.log(np.tan(lat_rad) + 1 / np.cos(lat_rad)) / math.pi) / 2.0
+    x = (n * lon_n).astype(np.int64)
+    y_f = n * lat_n
+    y = y_f.astype(np.int64)
+    # numpy's tan/cos/log may differ from libm in the last bit, which only matters right at a tile edge:
+    # recompute those few points with the scalar path so results match lnglat_to_tile_coords exactly
+    near_edge = np.abs(y_f - np.rint(y_f)) < 1e-6
+    if near_edge.any():
+        y = np.ascontiguousarray(y)
+        y_flat, lat_flat = y.reshape(-1), lat_c.reshape(-1)
+        for i in np.flatnonzero(near_edge):
+            lat_rad_i = float(lat_flat[i]) * deg2rad
+            y_flat[i] = int(n * ((1 - math.log(math.tan(lat_rad_i) + 1 / math.cos(lat_rad_i)) / math.pi) / 2.0))
+    return x, y
+def lnglat_to_tile_fraction_np(lng, lat, z: int) -> Tuple["np.ndarray", "np.ndarray"]: # like lnglat_to_tile_fraction, applied to whole arrays
+    require_numpy()
+    n = 2.0 ** z
+    lon = np.clip(np.asarray(lng, dtype=np.float64), MIN_LON, MAX_LON) # prevent overflow
+    lat_rad = np.radians(np.clip(np.asarray(lat, dtype=np.float64), MIN_LAT, MAX_LAT)) # prevent overflow
+    lat_n = (1 - np.log(np.tan(lat_rad) + 1 / np.cos(lat_rad)) / math.pi) / 2.0
+    return n * (lon / 360.0 + 0.5), n * lat_n
+def tile_coords_to_bounds_np(x, y, z: int) -> Tuple["np.ndarray", "np.ndarray", "np.ndarray", "np.ndarray"]:
+    # (minlon, minlat, maxlon, maxlat) of each tile, clamped to MAX_BOUNDS like the forward conversion
+    require_numpy()
+    n = 2.0 ** z
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    minlon = np.clip(x / n * 360.0 - 180.0, MIN_LON, MAX_LON)
+    maxlon = np.clip((x + 1) / n * 360.0 - 180.0, MIN_LON, MAX_LON)
+    maxlat = np.clip(np.degrees(np.arctan(np.sinh(math.pi * (1 - 2 * y / n)))), MIN_LAT, MAX_LAT)
+    minlat = np.clip(np.degrees(np.arctan(np.sinh(math.pi * (1 - 2 * (y + 1) / n)))), MIN_LAT, MAX_LAT)
+    return minlon, minlat, maxlon, maxlat
+def get_tile_range(bounds: TileBounds, zoom: int) -> Optional[TileRange]:
+    minlon, minlat, maxlon, maxlat = bounds
+    tile_side_count: int = 2 ** zoom
+    if bounds == MAX_BOUNDS:
+        return TileRange(zoom=zoom, minx=0, miny=0, maxx=tile_side_count - 1, maxy=tile_side_count - 1)
+    x1, y1 = lnglat_to_tile_coords(minlon, minlat, zoom)
+    x2, y2 = lnglat_to_tile_coords(maxlon, maxlat, zoom)
+    minx, miny = min(x1, x2), min(y1, y2)
+    maxx, maxy = max(x1, x2), max(y1, y2)
+    if minx < 0 or miny < 0 or maxx >= tile_side_count or maxy >= tile_side_count:
+        print("Coordinates are out of bounds.")
+        return None
+    return TileRange(zoom=zoom, minx=minx, miny=miny, maxx=maxx, maxy=maxy)
+def iter_column_order(tile_range: TileRange) -> Iterator[Tuple[int, int]]:
+    for x in range(tile_range.minx, tile_range.maxx + 1):
+        for y in range(tile_range.miny, tile_range.maxy + 1):
+            yield x, y
+def iter_zorder(tile_range: TileRange, x0: int, y0: int, size: int) -> Iterator[Tuple[int, int]]:
+    if x0 > tile_range.maxx or y0 > tile_range.maxy or x0 + size <= tile_range.minx or y0 + size <= tile_range.miny:
+        return # quadrant does not touch the range, prune it
+    if size == 1:
+        yield x0, y0
+        return
+    half: int = size // 2
+    yield from iter_zorder(tile_range, x0, y0, half)
+    yield from iter_zorder(tile_range, x0 + half, y0, half)
+    yield from iter_zorder(tile_range, x0, y0 + half, half)
+    yield from iter_zorder(tile_range, x0 + half, y0 + half, half)
+def iter_hilbert(tile_range: TileRange, x0: int, y0: int, ax: int, ay: int, bx: int, by: int, size: int) -> Iterator[Tuple[int, int]]:
+    # visits the size x size square of cells (x0, y0) + i * a + j * b, starting at i = j = 0 and ending at i = size - 1, j = 0
+    x1, y1 = x0 + (size - 1) * (ax + bx), y0 + (size - 1) * (ay + by) # opposite corner
+    if min(x0, x1) > tile_range.maxx or min(y0, y1) > tile_range.maxy or max(x0, x1) < tile_range.minx or max(y0, y1) < tile_range.miny:
+        return # quadrant does not touch the range, prune it
+    if size == 1:
+        yield x0, y0
+        return
+    h: int = size // 2
+    yield from iter_hilbert(tile_range, x0, y0, bx, by, ax, ay, h)
+    yield from iter_hilbert(tile_range, x0 + h * bx, y0 + h * by, ax, ay, bx, by, h)
+    yield from iter_hilbert(tile_range, x0 + h * (ax + bx), y0 + h * (ay + by), ax, ay, bx, by, h)
+    yield from iter_hilbert(tile_range, x0 + (size - 1) * ax + (h - 1) * bx, y0 + (size - 1) * ay + (h - 1) * by, -bx, -by, -ax, -ay, h)
+def iter_tile_coords(tile_range: TileRange, order: str = "column") -> Iterator[Tuple[int, int]]:
+    # space-filling orders walk the whole zoom level's grid and prune untouched quadrants,
+    # so neighbouring tiles of the same parent are always requested and written together
+    side: int = 2 ** tile_range.zoom
+    if order == "hilbert":
+        return iter_hilbert(tile_range, 0, 0, 1, 0, 0, 1, side)
+    if order == "zorder":
+        return iter_zorder(tile_range, 0, 0, side)
+    return iter_column_order(tile_range)
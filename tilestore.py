@@ -0,0 +1,312 @@
+# tile storage backends for tiledl.py:
+# - DirectoryTileStore writes the classic {dir}/{z}/{x}/{y}.{ext} tree
+# - MBTilesTileStore writes a single MBTiles (SQLite) file using the map/images split,
+#   so byte-identical tiles (open sea, empty contours, ...) are stored only once
+# files are streamed to a temporary file, checked and renamed into place, so a tile path never holds a partial tile
+import os
+import gzip
+import json
+import sqlite3
+import hashlib
+import threading
+from typing import Optional, Tuple, Dict, Set, Callable, Iterable, Iterator
+
+# constants:
+FORMAT_CHOICES = ["dir", "mbtiles"]
+MBTILES_SCHEMA: str = """
+CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT);
+CREATE UNIQUE INDEX IF NOT EXISTS metadata_name ON metadata (name);
+CREATE TABLE IF NOT EXISTS map (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_id TEXT);
+CREATE UNIQUE INDEX IF NOT EXISTS map_index ON map (zoom_level, tile_column, tile_row);
+CREATE TABLE IF NOT EXISTS images (tile_data BLOB, tile_id TEXT);
+CREATE UNIQUE INDEX IF NOT EXISTS images_id ON images (tile_id);
+CREATE VIEW IF NOT EXISTS tiles AS
+    SELECT map.zoom_level AS zoom_level, map.tile_column AS tile_column, map.tile_row AS tile_row, images.tile_data AS tile_data
+    FROM map JOIN images ON images.tile_id = map.tile_id;
+"""
+GZIP_MAGIC: bytes = b"\x1f\x8b"
+MAGIC_BYTES: Dict[str, tuple] = { # accepted file starts per extension
+    "jpg": (b"\xff\xd8\xff",),
+    "png": (b"\x89PNG\r\n\x1a\n",),
+    "webp": (b"RIFF",), # followed by the size and b"WEBP", checked separately
+    "pbf": (b"\x1a", b"\x0a", GZIP_MAGIC), # vector tile layer (field 3), glyph stack (field 1), or gzip
+}
+JPEG_END: bytes = b"\xff\xd9"
+PART_SUFFIX: str = ".part"
+# types, classes and data structures:
+class InvalidTile(ValueError):
+    pass
+
+def merge_metadata(existing: Dict[str, str], metadata: Dict[str, str]) -> Dict[str, str]:
+    # union of the bounds and of the zoom ranges, the center is recomputed from them; unreadable stored values are replaced
+    merged: Dict[str, str] = dict(metadata)
+    try:
+        old_bounds = [float(v) for v in existing["bounds"].split(",")]
+        new_bounds = [float(v) for v in metadata["bounds"].split(",")]
+        minzoom: int = min(int(existing["minzoom"]), int(metadata["minzoom"]))
+        maxzoom: int = max(int(existing["maxzoom"]), int(metadata["maxzoom"]))
+    except (KeyError, ValueError):
+        return merged
+    minlon, minlat = min(old_bounds[0], new_bounds[0]), min(old_bounds[1], new_bounds[1])
+    maxlon, maxlat = max(old_bounds[2], new_bounds[2]), max(old_bounds[3], new_bounds[3])
+    merged["bounds"] = f"{minlon},{minlat},{maxlon},{maxlat}"
+    merged["center"] = f"{(minlon + maxlon) / 2},{(minlat + maxlat) / 2},{minzoom}"
+    merged["minzoom"] = str(minzoom)
+    merged["maxzoom"] = str(maxzoom)
+    return merged
+def read_varint(data: memoryview, pos: int) -> Tuple[int, int]: # value, position after it; IndexError when truncated
+    result: int = 0
+    shift: int = 0
+    while True:
+        byte: int = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+def iter_messages(data: memoryview) -> Iterator[Tuple[int, memoryview]]: # (field number, payload) of the length-delimited protobuf fields
+    pos: int = 0
+    while pos < len(data):
+        key, pos = read_varint(data, pos)
+        wire_type: int = key & 7
+        if wire_type == 0:
+            _, pos = read_varint(data, pos)
+        elif wire_type == 2:
+            length, pos = read_varint(data, pos)
+            if pos + length > len(data):
+                raise ValueError("truncated field")
+            yield key >> 3, data[pos:pos + length] # a view, features are skipped without copying them
+            pos += length
+        elif wire_type in (1, 5):
+            pos += 8 if wire_type == 1 else 4
+        else:
+            raise ValueError(f"unsupported wire type {wire_type}")
+def get_tile_layers(data: bytes) -> Dict[str, Set[str]]: # vector tile layer name -> attribute keys, {} if the tile cannot be parsed
+    layers: Dict[str, Set[str]] = {}
+    try:
+        tile = memoryview(gzip.decompress(data) if data.startswith(GZIP_MAGIC) else data)
+        for field, layer in iter_messages(tile):
+            if field != 3: # Tile.layers
+                continue
+            name: Optional[str] = None
+            keys: Set[str] = set()
+            for layer_field, value in iter_messages(layer):
+                if layer_field == 1: # Layer.name
+                    name = bytes(value).decode("utf-8")
+                elif layer_field == 3: # Layer.keys
+                    keys.add(bytes(value).decode("utf-8"))
+            if name is not None:
+                layers.setdefault(name, set()).update(keys)
+    except (IndexError, ValueError, OSError, EOFError): # including gzip.BadGzipFile and UnicodeDecodeError
+        return {}
+    return layers
+def merge_vector_layers(stored: Optional[str], layers: Dict[str, dict]) -> str:
+    # the "json" metadata of vector tiles (MBTiles 1.3): vector_layers of an earlier run extended with layers seen in this one
+    try:
+        tilejson: dict = json.loads(stored) if stored else {}
+    except ValueError:
+        tilejson = {}
+    by_id: Dict[str, dict] = {layer["id"]: layer for layer in tilejson.get("vector_layers", []) if isinstance(layer, dict) and "id" in layer}
+    for name, seen in layers.items():
+        layer: dict = by_id.setdefault(name, {"id": name, "fields": {}, "minzoom": seen["minzoom"], "maxzoom": seen["maxzoom"]})
+        layer["fields"] = {**{key: "" for key in sorted(seen["fields"])}, **layer.get("fields", {})} # keeps descriptions already there
+        layer["minzoom"] = min(layer.get("minzoom", seen["minzoom"]), seen["minzoom"])
+        layer["maxzoom"] = max(layer.get("maxzoom", seen["maxzoom"]), seen["maxzoom"])
+    tilejson["vector_layers"] = [by_id[name] for name in sorted(by_id)]
+    return json.dumps(tilejson)
+def check_tile(ext: str, head: bytes, tail: bytes, size: int) -> None: # head: first 12 bytes, tail: last 2 bytes
+    if ext == "pbf" and size == 0:
+        return # a vector tile without layers
+    magic: Optional[tuple] = MAGIC_BYTES.get(ext)
+    if magic is not None and not head.startswith(magic):
+        raise InvalidTile(f"not a {ext} file, starts with {head[:4].hex()}")
+    if ext == "webp" and head[8:12] != b"WEBP":
+        raise InvalidTile("not a webp file")
+    if ext == "jpg" and tail != JPEG_END:
+        raise InvalidTile("truncated jpg file, no end of image marker")
+def write_atomic(path: str, chunks: Iterable[bytes], ext: str) -> int:
+    # streams to {path}.part and renames it into place once complete and valid; returns the size
+    part_path: str = path + PART_SUFFIX
+    head: bytes = b""
+    tail: bytes = b""
+    size: int = 0
+    try:
+        with open(part_path, "wb") as f:
+            for chunk in chunks:
+                if not chunk:
+                    continue
+                if len(head) < 12:
+                    head += chunk[:12 - len(head)]
+                tail = (tail + chunk)[-2:]
+                size += len(chunk)
+                f.write(chunk)
+        check_tile(ext, head, tail, size)
+        os.replace(part_path, path) # atomic on POSIX and Windows
+    except BaseException:
+        try:
+            os.remove(part_path)
+        except OSError:
+            pass
+        raise
+    return size
+def is_complete_file(path: str, ext: str) -> bool: # for files written before the resume journal or atomic writes existed
+    try:
+        size: int = os.path.getsize(path)
+        with open(path, "rb") as f:
+            head: bytes = f.read(12)
+            f.seek(max(0, size - 2))
+            tail: bytes = f.read(2)
+        check_tile(ext, head, tail, size)
+        return True
+    except (OSError, InvalidTile):
+        return False
+
+def flip_y(z: int, y: int) -> int: # XYZ <-> TMS row, MBTiles stores TMS rows
+    return (1 << z) - 1 - y
+class DirectoryTileStore:
+    def __init__(self, root: str, ext: str) -> None:
+        self.root = root
+        self.ext = ext
+    def tile_path(self, z: int, x: int, y: int) -> str:
+        return os.path.join(self.root, str(z), str(x), f"{y}.{self.ext}")
+    def exists(self, z: int, x: int, y: int) -> bool:
+        return is_complete_file(self.tile_path(z, x, y), self.ext) # a truncated tile does not count
+    def read(self, z: int, x: int, y: int) -> Optional[bytes]:
+        try:
+            with open(self.tile_path(z, x, y), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+    def write(self, z: int, x: int, y: int, data: bytes) -> None:
+        self.write_stream(z, x, y, [data])
+    def write_stream(self, z: int, x: int, y: int, chunks: Iterable[bytes]) -> int: # only one chunk is held in memory
+        tile_path: str = self.tile_path(z, x, y)
+        os.makedirs(os.path.dirname(tile_path), exist_ok=True)
+        return write_atomic(tile_path, chunks, self.ext)
+    def delete(self, z: int, x: int, y: int) -> None:
+        try:
+            os.remove(self.tile_path(z, x, y))
+        except FileNotFoundError:
+            pass
+    def modified_time(self, z: int, x: int, y: int) -> Optional[float]:
+        try:
+            return os.path.getmtime(self.tile_path(z, x, y))
+        except OSError:
+            return None
+    def iter_tiles(self, z: int) -> Iterator[Tuple[int, int]]: # (x, y) of the tiles stored at zoom z
+        try:
+            columns = [entry for entry in os.scandir(os.path.join(self.root, str(z))) if entry.is_dir() and entry.name.isdigit()]
+        except FileNotFoundError:
+            return
+        suffix: str = f".{self.ext}"
+        for column in columns:
+            for entry in os.scandir(column.path):
+                if entry.name.endswith(suffix) and entry.name[:-len(suffix)].isdigit(): # not *.part files
+                    yield int(column.name), int(entry.name[:-len(suffix)])
+    def set_metadata(self, metadata: Dict[str, str]) -> None:
+        pass # the directory layout carries no metadata
+    def flush(self) -> None:
+        pass # every tile is renamed into place as soon as it is written
+    def close(self) -> None:
+        pass
+class MBTilesTileStore:
+    def __init__(self, path: str, ext: str, batch_size: int = 500, on_commit: Optional[Callable[[], None]] = None) -> None:
+        self.path = path
+        self.ext = ext
+        self.batch_size = batch_size
+        self.on_commit = on_commit # called after every commit, e.g. to flush a resume journal no earlier than the tiles
+        self.pending_count = 0 # writes since the last commit
+        self.orphans: bool = False # a map row was replaced or deleted, its image may no longer be referenced
+        self.vector_layers: Dict[str, dict] = {} # layer name -> {"fields", "minzoom", "maxzoom"} of the vector tiles written
+        self.lock = threading.Lock() # one connection shared by all download workers
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level="DEFERRED")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        self.connection.executescript(MBTILES_SCHEMA)
+        self.connection.commit()
+    def exists(self, z: int, x: int, y: int) -> bool:
+        with self.lock:
+            row = self.connection.execute("SELECT 1 FROM map WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                                          (z, x, flip_y(z, y))).fetchone()
+        return row is not None
+    def read(self, z: int, x: int, y: int) -> Optional[bytes]:
+        with self.lock:
+            row = self.connection.execute("SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                                          (z, x, flip_y(z, y))).fetchone()
+        return None if row is None else bytes(row[0])
+    def write(self, z: int, x: int, y: int, data: bytes) -> None:
+        layers: Dict[str, Set[str]] = get_tile_layers(data) if self.ext == "pbf" else {}
+        if self.ext == "pbf" and not data.startswith(GZIP_MAGIC):
+            data = gzip.compress(data) # the MBTiles spec stores vector tiles gzip-compressed
+        tile_id: str = hashlib.md5(data, usedforsecurity=False).hexdigest()
+        with self.lock:
+            for name, keys in layers.items():
+                seen: dict = self.vector_layers.setdefault(name, {"fields": set(), "minzoom": z, "maxzoom": z})
+                seen["fields"].update(keys)
+                seen["minzoom"], seen["maxzoom"] = min(seen["minzoom"], z), max(seen["maxzoom"], z)
+            old = self.connection.execute("SELECT tile_id FROM map WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                                          (z, x, flip_y(z, y))).fetchone()
+            self.orphans = self.orphans or (old is not None and old[0] != tile_id) # e.g. a tile changed upstream, seen by --refresh
+            self.connection.execute("INSERT OR IGNORE INTO images (tile_data, tile_id) VALUES (?, ?)", (sqlite3.Binary(data), tile_id))
+            self.connection.execute("INSERT OR REPLACE INTO map (zoom_level, tile_column, tile_row, tile_id) VALUES (?, ?, ?, ?)",
+                                    (z, x, flip_y(z, y), tile_id))
+            self.pending_count += 1
+            if self.pending_count >= self.batch_size:
+                self.commit()
+    def write_stream(self, z: int, x: int, y: int, chunks: Iterable[bytes]) -> int: # a blob is written whole, so the tile is buffered
+        data: bytes = b"".join(chunks)
+        check_tile(self.ext, data[:12], data[-2:], len(data))
+        self.write(z, x, y, data)
+        return len(data)
+    def delete(self, z: int, x: int, y: int) -> None: # the image row stays until close, other tiles may share it
+        with self.lock:
+            cursor = self.connection.execute("DELETE FROM map WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?", (z, x, flip_y(z, y)))
+            self.orphans = self.orphans or cursor.rowcount > 0
+            self.pending_count += 1
+    def modified_time(self, z: int, x: int, y: int) -> Optional[float]:
+        return None # not tracked per tile
+    def iter_tiles(self, z: int) -> Iterator[Tuple[int, int]]: # (x, y) of the tiles stored at zoom z
+        with self.lock:
+            rows = self.connection.execute("SELECT tile_column, tile_row FROM map WHERE zoom_level = ?", (z,)).fetchall()
+        for x, tms_y in rows:
+            yield x, flip_y(z, tms_y)
+    def commit(self) -> None: # caller holds the lock
+        self.connection.commit()
+        self.pending_count = 0
+        if self.on_commit is not None:
+            self.on_commit()
+    def set_metadata(self, metadata: Dict[str, str]) -> None: # extends the stored bounds and zoom range, a run may cover only some levels
+        with self.lock:
+            existing: Dict[str, str] = dict(self.connection.execute("SELECT name, value FROM metadata").fetchall())
+            metadata = merge_metadata(existing, metadata)
+            self.connection.executemany("INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)", list(metadata.items()))
+            self.connection.commit()
+    def flush(self) -> None: # commits the pending batch, e.g. before a work queue batch is reported as done
+        with self.lock:
+            self.commit()
+    def remove_orphans(self) -> None: # caller holds the lock; one pass over both tables, their pages are reused by later writes
+        if self.orphans:
+            self.connection.execute("DELETE FROM images WHERE tile_id NOT IN (SELECT tile_id FROM map)")
+            self.orphans = False
+    def close(self) -> None:
+        with self.lock:
+            self.remove_orphans()
+            if self.ext == "pbf": # MBTiles 1.3 requires vector_layers in the json metadata of vector tiles
+                stored = self.connection.execute("SELECT value FROM metadata WHERE name = 'json'").fetchone()
+                self.connection.execute("INSERT OR REPLACE INTO metadata (name, value) VALUES ('json', ?)",
+                                        (merge_vector_layers(stored[0] if stored else None, self.vector_layers),))
+            self.commit()
+            self.connection.close()
+class MBTilesReader: # read-only access to an MBTiles file another process wrote, nothing is created or committed
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    def read(self, z: int, x: int, y: int) -> Optional[bytes]:
+        row = self.connection.execute("SELECT images.tile_data FROM map JOIN images ON images.tile_id = map.tile_id "
+                                      "WHERE map.zoom_level = ? AND map.tile_column = ? AND map.tile_row = ?", (z, x, flip_y(z, y))).fetchone()
+        return None if row is None else bytes(row[0])
+    def close(self) -> None:
+        self.connection.close()
+def open_tile_store(format: str, root: str, name: str, ext: str, on_commit: Optional[Callable[[], None]] = None) -> DirectoryTileStore | MBTilesTileStore:
+    if format == "mbtiles":
+        return MBTilesTileStore(os.path.join(root, f"{name}.mbtiles"), ext, on_commit=on_commit)
+    return DirectoryTileStore(root, ext)
@@ -0,0 +1,86 @@
+# shared HTTP transport for tiledl.py and fontdl.py:
+# one pooled requests.Session per process, so repeated requests to api.maptiler.com
+# reuse kept-alive TCP/TLS connections instead of paying a handshake for every tile.
+# bodies can be streamed in chunks with BodyStream, which also checks that they arrived complete.
+import requests
+import threading
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from typing import Optional, Iterator
+from dataclasses import dataclass, field
+
+# types, classes and data structures:
+@dataclass(frozen=True, slots=True, kw_only=True)
+class TransportConfig:
+    pool_size: int = 10 # max kept-alive connections per host
+    keep_alive: bool = True
+@dataclass(frozen=False, slots=True, kw_only=True)
+class TransportStats:
+    requests_sent: int = 0
+    connections_opened: int = 0
+    lock: threading.Lock = field(default_factory=threading.Lock)
+    @property
+    def connections_reused(self) -> int:
+        return max(0, self.requests_sent - self.connections_opened)
+class IncompleteBody(requests.RequestException):
+    pass
+class BodyStream: # iterates over a streamed (stream=True) response body, so only one chunk is held in memory
+    def __init__(self, response: requests.Response, chunk_size: int = 64 * 1024) -> None:
+        self.response = response
+        self.chunk_size = chunk_size
+        self.size: int = 0 # decoded bytes received so far
+    def __iter__(self) -> Iterator[bytes]:
+        for chunk in self.response.iter_content(self.chunk_size):
+            self.size += len(chunk)
+            yield chunk
+        expected: Optional[str] = self.response.headers.get("Content-Length")
+        received: int = self.response.raw.tell() # bytes on the wire, before any Content-Encoding is decoded
+        if expected is not None and expected.isdigit() and received != int(expected):
+            raise IncompleteBody(f"received {received} of {expected} bytes")
+class CountingHTTPConnectionPool(HTTPConnectionPool):
+    def _new_conn(self):
+        with STATS.lock:
+            STATS.connections_opened += 1
+        return super()._new_conn()
+class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _new_conn(self):
+        with STATS.lock:
+            STATS.connections_opened += 1
+        return super()._new_conn()
+
+# constants:
+DEFAULT_HEADERS = {"Accept-Encoding": "gzip, deflate"} # requests decompresses these transparently
+STATS: TransportStats = TransportStats()
+_config: TransportConfig = TransportConfig()
+_session: Optional[requests.Session] = None
+_session_lock: threading.Lock = threading.Lock()
+
+def create_session(config: TransportConfig) -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=config.pool_size, pool_maxsize=config.pool_size)
+    adapter.poolmanager.pool_classes_by_scheme = {"http": CountingHTTPConnectionPool, "https": CountingHTTPSConnectionPool}
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update(DEFAULT_HEADERS)
+    if not config.keep_alive:
+        session.headers["Connection"] = "close"
+    return session
+def configure(config: TransportConfig) -> None: # must be called before the first request to take effect
+    global _config, _session
+    with _session_lock:
+        _config = config
+        if _session is not None:
+            _session.close()
+            _session = None
+def get_session() -> requests.Session:
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = create_session(_config)
+        return _session
+def get(url: str, timeout: float, **kwargs) -> requests.Response:
+    with STATS.lock:
+        STATS.requests_sent += 1
+    return get_session().get(url, timeout=timeout, **kwargs)
+def format_stats() -> str:
+    return f"{STATS.requests_sent} requests, {STATS.connections_opened} connections opened, {STATS.connections_reused} reused."